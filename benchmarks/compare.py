@@ -0,0 +1,53 @@
+"""Compares two benchmarks.run or benchmarks.load_test reports and fails when a result got worse than the threshold.
+
+    python -m benchmarks.compare baseline.json results.json --threshold 0.2
+"""
+import argparse
+import json
+import sys
+
+# results where a larger number is better, everything else is a time or a size
+HIGHER_IS_BETTER = ("convert_features_per_second", "load_requests_per_second", "load_sessions_per_second")
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list[tuple]:
+    rows = []
+    for key in sorted(set(baseline["results"]) & set(current["results"])):
+        before = baseline["results"][key]
+        after = current["results"][key]
+        if before == 0:
+            continue
+
+        change = (after - before) / before
+        if key.startswith(HIGHER_IS_BETTER):
+            change = -change
+
+        rows.append((key, before, after, change, change > threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark reports")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative slowdown tolerated before a result counts as a regression")
+    args = parser.parse_args()
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.current) as file:
+        current = json.load(file)
+
+    print(f"baseline {baseline['meta']['commit'][:10]}  current {current['meta']['commit'][:10]}")
+    regressions = 0
+    for key, before, after, change, regressed in compare(baseline, current, args.threshold):
+        flag = "REGRESSION" if regressed else ""
+        print(f"{key:70} {before:14.6g} {after:14.6g} {change:+8.1%} {flag}")
+        regressions += regressed
+
+    sys.exit(1 if regressions > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+"""Concurrent QGIS sessions against the app and a local stub ERDDAP.
+
+    python -m benchmarks.load_test --concurrency 1,8,32 --sessions 64 --output load.json
+    python -m benchmarks.load_test --sessions-file recorded.json
+
+A QGIS session opens the landing page and /collections, reads the
+description of the layer's collection and then pans the map over it: each
+view is an /items request with the view's bbox, paged through its next links.
+Sessions are generated from --seed, or replayed from a file holding a list of
+sessions, each a list of steps: a path, or {"path": ..., "pages": n} to follow
+n - 1 next links too. The collections a recorded session asks for are served
+by the stub with --size rows each.
+
+Every concurrency level runs the same sessions in two scenarios against a new
+app process: cold, where the first requests for a collection download it, and
+warm, where every collection was loaded before the clock starts. The app runs
+under uvicorn in its own process, so its GIL and memory are its own; the
+clients and the stub share this one. The report has the same layout as
+benchmarks.run, so two runs can be compared with benchmarks.compare.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+import requests
+
+from benchmarks.run import git_commit
+from benchmarks.stub_erddap import StubERDDAP, SyntheticGlider
+
+SCENARIOS = ["cold", "warm"]
+# seconds the app may take to start answering
+STARTUP_TIMEOUT = 60.0
+REQUEST_TIMEOUT = 120.0
+COLLECTION_PATH = re.compile(r"^/collections/([^/?]+)")
+
+
+class AppProcess:
+    """The app served by uvicorn in a child process, for as long as the context lasts."""
+
+    def __init__(self, erddap_url: str):
+        self.erddap_url = erddap_url
+        self.port = free_port()
+        self.process = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def __enter__(self):
+        env = dict(os.environ, ERDDAP=self.erddap_url)
+        # every collection is loaded by the sessions themselves, or by the warm up
+        env.pop("WARMUP", None)
+        self.process = subprocess.Popen([sys.executable, "-m", "uvicorn", "ogc_api.main:app",
+                                         "--host", "127.0.0.1", "--port", str(self.port), "--log-level", "warning"],
+                                        env=env)
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"The app exited with {self.process.returncode} on startup")
+            try:
+                if requests.get(self.url + "/ready", timeout=1).status_code == 200:
+                    return self
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.1)
+        self.__exit__(None, None, None)
+        raise RuntimeError(f"The app didn't start in {STARTUP_TIMEOUT:.0f} s")
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def memory(self) -> tuple:
+        """Resident and peak resident bytes of the app and the processes it started, None where unknown."""
+        rss = peak = 0
+        for pid in process_tree(self.process.pid):
+            status = read_status(pid)
+            if "VmRSS" not in status:
+                continue
+            rss += status["VmRSS"]
+            peak += status.get("VmHWM", status["VmRSS"])
+        if rss == 0:
+            return None, None
+        return rss, peak
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def process_tree(pid: int) -> list[int]:
+    pids = [pid]
+    for child in read_children(pid):
+        pids.extend(process_tree(child))
+    return pids
+
+
+def read_children(pid: int) -> list[int]:
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as file:
+            return [int(child) for child in file.read().split()]
+    except OSError:
+        return []
+
+
+def read_status(pid: int) -> dict:
+    """The kB sizes of /proc/<pid>/status in bytes, empty where there is no /proc."""
+    sizes = {}
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                name, _, value = line.partition(":")
+                if value.strip().endswith(" kB"):
+                    sizes[name] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return sizes
+
+
+def items_path(dataset_id: str, bbox: tuple, limit: int) -> str:
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return f"/collections/{dataset_id}/items?bbox={min_lon:.5f},{min_lat:.5f},{max_lon:.5f},{max_lat:.5f}" \
+           f"&limit={limit}"
+
+
+def synthetic_session(rng: random.Random, extents: dict, pans: int, limit: int, pages: int) -> list[dict]:
+    """A user adding one collection as a layer, then panning and zooming over the mission."""
+    dataset_id = rng.choice(sorted(extents))
+    min_lon, max_lon, min_lat, max_lat = extents[dataset_id]
+    steps = [{"path": "/"}, {"path": "/collections"}, {"path": f"/collections/{dataset_id}"}]
+
+    # the layer is first shown whole, the view then moves around inside the extent
+    center_lon, center_lat = (min_lon + max_lon) / 2, (min_lat + max_lat) / 2
+    width, height = max(max_lon - min_lon, 0.01), max(max_lat - min_lat, 0.01)
+    for _ in range(pans + 1):
+        steps.append({"path": items_path(dataset_id, (center_lon - width / 2, center_lat - height / 2,
+                                                      center_lon + width / 2, center_lat + height / 2), limit),
+                      "pages": pages})
+        center_lon = min(max(center_lon + rng.uniform(-0.5, 0.5) * width, min_lon), max_lon)
+        center_lat = min(max(center_lat + rng.uniform(-0.5, 0.5) * height, min_lat), max_lat)
+        # zooming in more often than out
+        zoom = rng.choice([0.5, 0.5, 1.0, 2.0])
+        width, height = width * zoom, height * zoom
+    return steps
+
+
+def read_sessions(path: str) -> list[list[dict]]:
+    with open(path) as file:
+        sessions = json.load(file)
+    return [[step if isinstance(step, dict) else {"path": step} for step in session] for session in sessions]
+
+
+def session_collections(sessions: list) -> list[str]:
+    """The collection ids the sessions ask for, in first use order."""
+    ids = {}
+    for session in sessions:
+        for step in session:
+            match = COLLECTION_PATH.match(step["path"])
+            if match:
+                ids[match.group(1)] = None
+    return list(ids)
+
+
+def endpoint(path: str) -> str:
+    parts = urlsplit(path).path.strip("/").split("/")
+    if parts == [""]:
+        return "landing"
+    if parts[0] == "collections" and len(parts) >= 3 and parts[2] == "items":
+        return "items"
+    if parts[0] == "collections" and len(parts) == 2:
+        return "collection"
+    return parts[0]
+
+
+class Client:
+    """Replays sessions with one keep-alive connection per thread, like a QGIS instance does."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.local = threading.local()
+        # (endpoint, status, seconds), status 0 for a request that got no answer
+        self.records = []
+        self.lock = threading.Lock()
+
+    def get(self, path: str):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+
+        start = time.perf_counter()
+        try:
+            res = session.get(self.base_url + path, timeout=REQUEST_TIMEOUT)
+            status = res.status_code
+        except requests.RequestException:
+            res, status = None, 0
+        with self.lock:
+            self.records.append((endpoint(path), status, time.perf_counter() - start))
+        return res
+
+    def replay(self, session: list[dict]):
+        for step in session:
+            path = step["path"]
+            for _ in range(step.get("pages", 1)):
+                res = self.get(path)
+                if res is None or res.status_code != 200 or step.get("pages", 1) == 1:
+                    break
+                path = next_path(res)
+                if path is None:
+                    break
+
+
+def next_path(res: requests.Response):
+    """The path of the next page, links carry the public url of the app rather than the one used here."""
+    for link in res.json().get("links", []):
+        if link.get("rel") == "next":
+            href = urlsplit(link["href"])
+            return href.path + ("?" + href.query if href.query else "")
+    return None
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def run_sessions(app: AppProcess, sessions: list, concurrency: int, name: str) -> dict:
+    client = Client(app.url)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="client") as executor:
+        for future in [executor.submit(client.replay, session) for session in sessions]:
+            future.result()
+    seconds = time.perf_counter() - start
+
+    results = {
+        f"load_requests_per_second/{name}": len(client.records) / seconds,
+        f"load_sessions_per_second/{name}": len(sessions) / seconds,
+        f"load_error_rate/{name}": sum(status == 0 or status >= 400 for _, status, _ in client.records)
+                                   / max(len(client.records), 1),
+    }
+    latencies = {"all": [seconds for _, _, seconds in client.records]}
+    for endpoint_name, _, request_seconds in client.records:
+        latencies.setdefault(endpoint_name, []).append(request_seconds)
+    for endpoint_name, values in latencies.items():
+        if len(values) > 0:
+            results[f"load_latency_seconds/{name}/{endpoint_name}/p50"] = percentile(values, 0.5)
+            results[f"load_latency_seconds/{name}/{endpoint_name}/p99"] = percentile(values, 0.99)
+
+    rss, peak = app.memory()
+    if rss is not None:
+        results[f"load_app_rss_bytes/{name}"] = rss
+        results[f"load_app_peak_rss_bytes/{name}"] = peak
+    return results
+
+
+def warm_up(app: AppProcess, dataset_ids: list[str]):
+    """Loads every collection, so no measured request waits for ERDDAP."""
+    client = Client(app.url)
+    client.get("/collections")
+    for dataset_id in dataset_ids:
+        res = client.get(f"/collections/{dataset_id}/items?limit=1")
+        if res is None or res.status_code != 200:
+            raise RuntimeError(f"Warming up {dataset_id} failed")
+
+
+def run(concurrency: list[int], sessions: list, datasets: dict, scenarios: list[str], latency: float = 0.0,
+        row_latency: float = 0.0) -> dict:
+    results = {}
+    with StubERDDAP(datasets, latency, row_latency=row_latency) as stub:
+        for scenario in scenarios:
+            for clients in concurrency:
+                with AppProcess(stub.url) as app:
+                    if scenario == "warm":
+                        warm_up(app, list(datasets))
+                    results.update(run_sessions(app, sessions, clients, f"{scenario}/c={clients}"))
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.now(timezone.utc).isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "concurrency": concurrency,
+            "sessions": len(sessions),
+            "datasets": datasets,
+            "latency": latency,
+            "row_latency": row_latency,
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the app with concurrent QGIS sessions against a stub ERDDAP")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma separated numbers of clients, one run each")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="cold, warm or both")
+    parser.add_argument("--sessions", type=int, default=32, help="synthetic sessions run at each concurrency")
+    parser.add_argument("--sessions-file", help="JSON list of recorded sessions to replay instead")
+    parser.add_argument("--datasets", type=int, default=4, help="collections the synthetic sessions pick from")
+    parser.add_argument("--size", type=int, default=5000, help="rows in each collection")
+    parser.add_argument("--pans", type=int, default=5, help="map moves after the first view of a session")
+    parser.add_argument("--limit", type=int, default=100, help="features per /items page")
+    parser.add_argument("--pages", type=int, default=3, help="most pages read of each view")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the stub adds to every response")
+    parser.add_argument("--row-latency", type=float, default=0.0, help="seconds the stub adds per row of data")
+    parser.add_argument("--output", help="file to write the results to, printed when not given")
+    args = parser.parse_args()
+
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(",")]
+    if any(scenario not in SCENARIOS for scenario in scenarios):
+        parser.error(f"--scenarios must be among {', '.join(SCENARIOS)}")
+
+    if args.sessions_file:
+        sessions = read_sessions(args.sessions_file)
+        datasets = {dataset_id: args.size for dataset_id in session_collections(sessions)}
+    else:
+        datasets = {f"glider_{i}": args.size for i in range(args.datasets)}
+        # extents come from the stub's own walks, so the views are over the data
+        extents = {dataset_id: SyntheticGlider(dataset_id, size).extent() for dataset_id, size in datasets.items()}
+        rng = random.Random(args.seed)
+        sessions = [synthetic_session(rng, extents, args.pans, args.limit, args.pages) for _ in range(args.sessions)]
+
+    report = run([int(clients) for clients in args.concurrency.split(",")], sessions, datasets, scenarios,
+                 args.latency, args.row_latency)
+    encoded = json.dumps(report, indent=2)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(encoded)
+    else:
+        print(encoded)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+"""Measures the hot paths against a local stub ERDDAP.
+
+    python -m benchmarks.run --sizes 1000,10000 --output results.json
+    python -m benchmarks.compare baseline.json results.json
+
+Every result is a flat name -> value entry, so runs from different commits can
+be compared key by key.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from benchmarks.stub_erddap import StubERDDAP
+
+ITEM_LIMITS = [10, 100, 1000]
+# small collection requested while a large one loads
+PROBE_DATASET = "probe_100"
+
+
+def median_time(func, repeats: int) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def bench_cold_load(stub: StubERDDAP, dataset_id: str, repeats: int) -> dict:
+    from erddap_proxy.erddap_matadata import ERDDAPCollections
+
+    collections = ERDDAPCollections(stub.url)
+    collections.meta.get_catalogue()
+
+    def cold_load():
+        collections.cache.clear()
+        collections.get_collection_as_data(dataset_id)
+
+    return {f"cold_load_seconds/{dataset_id}": median_time(cold_load, repeats)}
+
+
+def bench_single_download(stub: StubERDDAP, dataset_id: str, size: int, repeats: int) -> dict:
+    """Cold load and peak memory without time windows, to compare with the chunked defaults."""
+    from erddap_proxy.erddap_matadata import ERDDAPCollections
+
+    collections = ERDDAPCollections(stub.url)
+    collections.meta.get_catalogue()
+    collections.get_dataset_type(dataset_id)
+    collections.data.chunk_seconds = float("inf")
+
+    def cold_load():
+        collections.cache.clear()
+        collections.get_collection_as_data(dataset_id)
+
+    seconds = median_time(cold_load, repeats)
+
+    collections.cache.clear()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    collections.get_collection_as_data(dataset_id)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {f"cold_load_seconds/{dataset_id}/single": seconds,
+            f"peak_load_bytes_per_feature/{dataset_id}/single": (peak - before) / size}
+
+
+def bench_conversion(stub: StubERDDAP, dataset_id: str, repeats: int) -> dict:
+    from erddap_proxy.erddap_matadata import ERDDAPCollections
+
+    collections = ERDDAPCollections(stub.url)
+    dataset_type = collections.get_dataset_type(dataset_id)
+    erddap_geojson = collections.data._get_erddap_geojson(dataset_id, dataset_type)
+    size = len(erddap_geojson["features"])
+
+    def convert():
+        collection = collections.meta.create_erddap_collection(dataset_id)
+        collections.data.convert_to_collection(erddap_geojson, collection)
+
+    seconds = median_time(convert, repeats)
+    return {f"convert_features_per_second/{dataset_id}": size / seconds}
+
+
+def bench_memory(stub: StubERDDAP, dataset_id: str, size: int) -> dict:
+    from erddap_proxy.erddap_matadata import ERDDAPCollections
+
+    collections = ERDDAPCollections(stub.url)
+    collections.meta.get_catalogue()
+    collections.get_dataset_type(dataset_id)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    collection = collections.get_collection_as_data(dataset_id)
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {f"resident_bytes_per_feature/{dataset_id}": (after - before) / size,
+            f"peak_load_bytes_per_feature/{dataset_id}": (peak - before) / size,
+            f"estimated_bytes_per_feature/{dataset_id}": collection.resident_bytes() / size}
+
+
+def bench_items(stub: StubERDDAP, dataset_id: str, repeats: int) -> dict:
+    from ogc_api import index, server_handler
+
+    server = server_handler.make_web_server(index.make_index({}, "http://127.0.0.1:8000/", warmup=False))
+    server.index.erddap_collections.get_collection_as_data(dataset_id)
+
+    min_lon, max_lon, min_lat, max_lat = stub.datasets[dataset_id].extent()
+    mid_lon, mid_lat = (min_lon + max_lon) / 2, (min_lat + max_lat) / 2
+    bboxes = {
+        "none": "",
+        "all": f"{min_lon},{min_lat},{max_lon},{max_lat}",
+        "small": f"{mid_lon - 0.05},{mid_lat - 0.05},{mid_lon + 0.05},{mid_lat + 0.05}",
+        "empty": "10,10,11,11",
+    }
+
+    results = {}
+    for limit in ITEM_LIMITS:
+        for bbox_name, bbox in bboxes.items():
+            def get_page():
+                response = server.handle_items_request(dataset_id, "", 0, bbox, str(limit))
+                assert response.http_response is None
+
+            key = f"items_seconds/{dataset_id}/limit={limit}/bbox={bbox_name}"
+            results[key] = median_time(get_page, repeats)
+    return results
+
+
+def bench_responsiveness(stub: StubERDDAP, dataset_id: str) -> dict:
+    """/items latency on a loaded collection while dataset_id is loaded, converting in threads and in processes."""
+    from erddap_proxy.conversion import Converter
+    from ogc_api import index, server_handler
+
+    # answered from memory, so the stub encoding its responses in this process isn't what's measured
+    handle = stub.handle
+    responses = {}
+
+    def cached(path, query):
+        if (path, query) not in responses:
+            responses[(path, query)] = handle(path, query)
+        return responses[(path, query)]
+
+    stub.handle = cached
+    bench_cold_load(stub, dataset_id, 1)
+
+    results = {}
+    for mode, converter in (("thread", Converter(workers=0)), ("process", Converter())):
+        server = server_handler.make_web_server(index.make_index({}, "http://127.0.0.1:8000/", warmup=False))
+        collections = server.index.erddap_collections
+        collections.data.converter = converter
+        # also starts the worker processes, so their startup isn't measured
+        collections.get_collection_as_data(PROBE_DATASET)
+        collections.get_dataset_type(dataset_id)
+
+        loader = threading.Thread(target=collections.get_collection_as_data, args=(dataset_id,))
+        latencies = []
+        loader.start()
+        while loader.is_alive():
+            # a request arriving every millisecond, timed from its arrival so waiting for the GIL counts
+            arrival = time.perf_counter() + 0.001
+            time.sleep(0.001)
+            response = server.handle_items_request(PROBE_DATASET, "", 0, "", "10")
+            latencies.append(time.perf_counter() - arrival)
+            assert response.http_response is None
+        loader.join()
+        converter.shutdown()
+
+        latencies.sort()
+        results[f"items_seconds_during_load/{dataset_id}/{mode}/p50"] = latencies[len(latencies) // 2]
+        results[f"items_seconds_during_load/{dataset_id}/{mode}/p99"] = latencies[len(latencies) * 99 // 100]
+
+    stub.handle = handle
+    return results
+
+
+def bench_geometry(size: int, repeats: int) -> dict:
+    """Points per second through the scalar geometry functions and their batch versions."""
+    import numpy as np
+    import geojson
+    import s2sphere
+    from ogc_api import geometry
+
+    rng = np.random.default_rng(0)
+    lat = rng.uniform(-85, 85, size)
+    lon = rng.uniform(-180, 180, size)
+    # lines of 10 vertices
+    offsets = np.arange(0, size + 1, 10)
+    rect = s2sphere.LatLngRect.from_point_pair(s2sphere.LatLng.from_degrees(-30, -60),
+                                               s2sphere.LatLng.from_degrees(30, 60))
+    bounds = geometry.compute_point_bounds_batch(lat, lon)
+    rects = [s2sphere.LatLngRect(s2sphere.LineInterval(row[0], row[1]), s2sphere.SphereInterval(row[2], row[3]))
+             for row in bounds]
+
+    kernels = {
+        "point_bounds": (lambda: [geometry.compute_bounds(geojson.Point((x, y))) for x, y in zip(lon, lat)],
+                         lambda: geometry.compute_point_bounds_batch(lat, lon)),
+        "line_bounds": (lambda: [geometry.compute_line_bounds(list(zip(lon[i:j], lat[i:j])))
+                                 for i, j in zip(offsets[:-1], offsets[1:])],
+                        lambda: geometry.compute_line_bounds_batch(lat, lon, offsets)),
+        "project": (lambda: [geometry.project_web_mercator(s2sphere.LatLng.from_degrees(y, x))
+                             for x, y in zip(lon, lat)],
+                    lambda: geometry.project_web_mercator_batch(lat, lon)),
+        "unproject": (lambda: [geometry.unproject_web_mercator(12, x, y) for x, y in zip(lon, lat)],
+                      lambda: geometry.unproject_web_mercator_batch(12, lon, lat)),
+        "bounds_intersect": (lambda: [rect.intersects(feature) for feature in rects],
+                             lambda: geometry.bounds_mask(bounds, rect)),
+    }
+
+    results = {}
+    for name, (scalar, batch) in kernels.items():
+        results[f"geometry_per_second/{size}/{name}/scalar"] = size / median_time(scalar, repeats)
+        results[f"geometry_per_second/{size}/{name}/batch"] = size / median_time(batch, repeats)
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(sizes: list[int], repeats: int, latency: float = 0.0, row_latency: float = 0.0) -> dict:
+    datasets = {f"glider_{size}": size for size in sizes}
+    results = {}
+
+    with StubERDDAP({**datasets, PROBE_DATASET: 100}, latency, row_latency=row_latency) as stub:
+        os.environ["ERDDAP"] = stub.url
+        for dataset_id, size in datasets.items():
+            results.update(bench_cold_load(stub, dataset_id, repeats))
+            results.update(bench_single_download(stub, dataset_id, size, repeats))
+            results.update(bench_conversion(stub, dataset_id, repeats))
+            results.update(bench_memory(stub, dataset_id, size))
+            results.update(bench_items(stub, dataset_id, repeats))
+            results.update(bench_responsiveness(stub, dataset_id))
+            results.update(bench_geometry(size, repeats))
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.now(timezone.utc).isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "sizes": sizes,
+            "repeats": repeats,
+            "latency": latency,
+            "row_latency": row_latency,
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ERDDAP to OGC API hot paths against a stub ERDDAP")
+    parser.add_argument("--sizes", default="1000,10000", help="comma separated feature counts, one dataset each")
+    parser.add_argument("--repeats", type=int, default=5, help="runs per measurement, the median is kept")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the stub adds to every response")
+    parser.add_argument("--row-latency", type=float, default=0.0, help="seconds the stub adds per row of data")
+    parser.add_argument("--output", help="file to write the results to, printed when not given")
+    args = parser.parse_args()
+
+    report = run([int(size) for size in args.sizes.split(",")], args.repeats, args.latency, args.row_latency)
+    encoded = json.dumps(report, indent=2)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(encoded)
+    else:
+        print(encoded)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+"""A local stand-in for ERDDAP serving synthetic glider datasets.
+
+Serves the queries erddap_proxy.erddap_matadata makes: the allDatasets table,
+categorize/variableName listings, dataset info (json and csv) and tabledap
+downloads as geoJson, json and csv, so the server can be loaded and measured
+without a live ERDDAP.
+"""
+import csv
+import io
+import json
+import math
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote, urlparse
+
+MISSION_START = datetime(2022, 9, 12, tzinfo=timezone.utc).timestamp()
+# a glider surfaces roughly every few hours
+SURFACING_INTERVAL = 3 * 3600
+
+GLIDER_VARIABLES = ["time", "latitude", "longitude", "depth", "profile_id",
+                    "m_gps_lat", "m_gps_lon", "temperature", "salinity"]
+VARIABLE_UNITS = {"time": "UTC", "latitude": "degrees_north", "longitude": "degrees_east", "depth": "m",
+                  "m_gps_lat": "degrees_minutes_north", "m_gps_lon": "degrees_minutes_east",
+                  "temperature": "Celsius", "salinity": "1"}
+
+
+class SyntheticGlider:
+    """A deterministic random walk standing in for one glider mission."""
+
+    def __init__(self, dataset_id: str, size: int, seed: int = 0, start: float = MISSION_START):
+        self.dataset_id = dataset_id
+        self.size = size
+        self.seed = seed
+        self.start = start
+        self._rows = None
+
+    @property
+    def rows(self) -> list[dict]:
+        if self._rows is None:
+            self._rows = list(self.generate())
+        return self._rows
+
+    def generate(self):
+        rng = random.Random(f"{self.dataset_id}-{self.seed}")
+        lat, lon = 44.0 + rng.uniform(-1, 1), -63.0 + rng.uniform(-1, 1)
+        for i in range(self.size):
+            lat = min(max(lat + rng.uniform(-0.02, 0.02), -89.0), 89.0)
+            lon = (lon + rng.uniform(-0.02, 0.02) + 180.0) % 360.0 - 180.0
+            yield {
+                "time": self.start + i * SURFACING_INTERVAL,
+                "latitude": round(lat, 5),
+                "longitude": round(lon, 5),
+                "depth": 0.5,
+                "profile_id": i + 1,
+                "m_gps_lat": round(lat, 5),
+                "m_gps_lon": round(lon, 5),
+                "temperature": round(10 + 5 * math.sin(i / 50.0), 3),
+                "salinity": round(31 + rng.uniform(-0.5, 0.5), 3),
+            }
+
+    @property
+    def end(self) -> float:
+        return self.start + max(self.size - 1, 0) * SURFACING_INTERVAL
+
+    def extent(self):
+        lats = [row["latitude"] for row in self.rows]
+        lons = [row["longitude"] for row in self.rows]
+        if len(lats) == 0:
+            return None, None, None, None
+        return min(lons), max(lons), min(lats), max(lats)
+
+    def select(self, constraints: list) -> list[dict]:
+        rows = self.rows
+        for variable, op, value in constraints:
+            rows = [row for row in rows if variable in row and compare(row[variable], op, value)]
+        return rows
+
+
+class StubERDDAP:
+    """Serves SyntheticGlider datasets on localhost, use as a context manager or start/stop."""
+
+    def __init__(self, datasets: dict, latency: float = 0.0, port: int = 0, row_latency: float = 0.0):
+        self.datasets = {dataset_id: SyntheticGlider(dataset_id, size) for dataset_id, size in datasets.items()}
+        self.latency = latency
+        # seconds per row returned, ERDDAP takes longer to answer bigger queries
+        self.row_latency = row_latency
+        self.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(self))
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/erddap/"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="stub-erddap", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def handle(self, path: str, query: str):
+        """Returns (status, content type, body) for a request."""
+        self.requests.append(path + ("?" + query if query else ""))
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        parts = [part for part in path.split("/") if part != ""]
+        if len(parts) < 2 or parts[0] != "erddap":
+            return 404, "text/plain", b"Not Found"
+
+        if parts[1] == "tabledap" and len(parts) == 3:
+            dataset_id, _, response = parts[2].partition(".")
+            if dataset_id == "allDatasets":
+                return self.all_datasets(response)
+            if dataset_id in self.datasets:
+                return self.tabledap(self.datasets[dataset_id], response, query)
+
+        if parts[1] == "categorize" and len(parts) == 5 and parts[2] == "variableName":
+            return self.categorize(parts[3])
+
+        if parts[1] == "info" and len(parts) == 4 and parts[2] in self.datasets:
+            return self.info(parts[3].partition(".")[2])
+
+        return 404, "text/plain", b"Error {\n    code=404;\n    message=\"Not Found\";\n}\n"
+
+    def all_datasets(self, response: str):
+        column_names = ["datasetID", "title", "minLongitude", "maxLongitude", "minLatitude", "maxLatitude",
+                        "minTime", "maxTime"]
+        rows = [["allDatasets", "* The List of All Active Datasets in this ERDDAP *",
+                 -180.0, 180.0, -90.0, 90.0, None, None]]
+        for glider in self.datasets.values():
+            min_lon, max_lon, min_lat, max_lat = glider.extent()
+            rows.append([glider.dataset_id, f"Synthetic glider {glider.dataset_id}",
+                         min_lon, max_lon, min_lat, max_lat, iso_time(glider.start), iso_time(glider.end)])
+        return table_response(column_names, rows, response)
+
+    def categorize(self, variable: str):
+        if variable not in GLIDER_VARIABLES:
+            return 404, "text/plain", b"Error"
+        rows = [["public", f"Synthetic glider {dataset_id}", dataset_id] for dataset_id in self.datasets]
+        return table_response(["Accessible", "Title", "Dataset ID"], rows, "json")
+
+    def info(self, response: str):
+        rows = [["attribute", "NC_GLOBAL", "cdm_data_type", "String", "TrajectoryProfile"]]
+        for variable in GLIDER_VARIABLES:
+            rows.append(["variable", variable, "", "double", ""])
+            if variable in VARIABLE_UNITS:
+                rows.append(["attribute", variable, "units", "String", VARIABLE_UNITS[variable]])
+        return table_response(["Row Type", "Variable Name", "Attribute Name", "Data Type", "Value"], rows, response)
+
+    def tabledap(self, glider: SyntheticGlider, response: str, query: str):
+        variables, constraints = parse_query(query)
+        for variable in variables + [constraint[0] for constraint in constraints]:
+            if variable not in GLIDER_VARIABLES:
+                message = f"Error {{\n    code=400;\n    message=\"Query error: Unrecognized variable={variable}\";\n}}\n"
+                return 400, "text/plain", message.encode("utf8")
+        variables = variables or list(GLIDER_VARIABLES)
+        rows = glider.select(constraints)
+        if self.row_latency > 0:
+            time.sleep(self.row_latency * len(rows))
+        if len(rows) == 0:
+            return 404, "text/plain", b"Error {\n    code=404;\n    message=\"Your query produced no matching results.\";\n}\n"
+
+        if response == "geoJson":
+            return 200, "application/json", encode_geojson(rows, variables)
+
+        values = [[iso_time(row[v]) if v == "time" else row[v] for v in variables] for row in rows]
+        return table_response(variables, values, response)
+
+
+def make_handler(stub: StubERDDAP):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            status, content_type, body = stub.handle(url.path, unquote(url.query))
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def parse_query(query: str):
+    """Splits a tabledap query into its variables and (variable, operator, value) constraints."""
+    parts = query.split("&") if query else [""]
+    variables = [v for v in parts[0].split(",") if v != ""]
+    constraints = []
+    for part in parts[1:]:
+        for op in ("!=", ">=", "<=", "=~", "=", "<", ">"):
+            variable, found, value = part.partition(op)
+            if found:
+                constraints.append((variable, op, parse_value(variable, value)))
+                break
+    return variables, constraints
+
+
+def parse_value(variable: str, value: str):
+    value = value.strip('"')
+    if value.lower() == "nan":
+        return float("nan")
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    if variable == "time":
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    return value
+
+
+def compare(left, op, right) -> bool:
+    if isinstance(right, float) and math.isnan(right):
+        is_nan = isinstance(left, float) and math.isnan(left)
+        return not is_nan if op == "!=" else is_nan if op == "=" else False
+    if op == "=":
+        return left == right
+    if op == "!=":
+        return left != right
+    if op == "<":
+        return left < right
+    if op == "<=":
+        return left <= right
+    if op == ">":
+        return left > right
+    if op == ">=":
+        return left >= right
+    return True
+
+
+def iso_time(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def encode_geojson(rows: list[dict], variables: list[str]) -> bytes:
+    property_names = [v for v in variables if v not in ("latitude", "longitude")]
+    features = []
+    for row in rows:
+        properties = {v: iso_time(row[v]) if v == "time" else row[v] for v in property_names}
+        features.append({"type": "Feature",
+                         "geometry": {"type": "Point", "coordinates": [row["longitude"], row["latitude"]]},
+                         "properties": properties})
+    body = {"type": "FeatureCollection",
+            "propertyNames": property_names,
+            "propertyUnits": [VARIABLE_UNITS.get(v) for v in property_names],
+            "features": features}
+    return json.dumps(body).encode("utf8")
+
+
+def table_response(column_names: list, rows: list, response: str):
+    if response == "csv":
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(column_names)
+        writer.writerow([VARIABLE_UNITS.get(name, "") for name in column_names])
+        writer.writerows(rows)
+        return 200, "text/csv", out.getvalue().encode("utf8")
+
+    body = {"table": {"columnNames": column_names, "rows": rows}}
+    return 200, "application/json", json.dumps(body).encode("utf8")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve synthetic glider datasets like ERDDAP does")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--sizes", default="1000,10000", help="comma separated feature counts, one dataset each")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--row-latency", type=float, default=0.0, help="seconds added per row of tabledap data")
+    args = parser.parse_args()
+
+    stub = StubERDDAP({f"glider_{size}": int(size) for size in args.sizes.split(",")}, args.latency, args.port,
+                      args.row_latency)
+    print(f"Serving {', '.join(stub.datasets)} on {stub.url}")
+    stub.server.serve_forever()
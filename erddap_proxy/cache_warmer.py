@@ -0,0 +1,100 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from erddap_proxy import upstream
+from erddap_proxy.erddap_matadata import ERDDAPCollections
+
+WARMUP_WORKERS = int(os.environ.get("WARMUP_WORKERS", "2"))
+WARMUP_HOT_SET = int(os.environ.get("WARMUP_HOT_SET", "20"))
+ACTIVE_MISSION_DAYS = float(os.environ.get("ACTIVE_MISSION_DAYS", "7"))
+# longest a warmer waits for user requests to finish loading before it goes ahead anyway
+WARMUP_YIELD_TIMEOUT = float(os.environ.get("WARMUP_YIELD_TIMEOUT", "30"))
+
+logger = logging.getLogger(__name__)
+
+
+class CacheWarmer:
+    """Prefetches the most used and currently active datasets into the collection cache."""
+
+    erddap_collections: ERDDAPCollections
+    hot_set: []
+
+    def __init__(self, erddap_collections: ERDDAPCollections, workers: int = WARMUP_WORKERS,
+                 hot_set_size: int = WARMUP_HOT_SET, active_days: float = ACTIVE_MISSION_DAYS):
+        self.erddap_collections = erddap_collections
+        self.workers = workers
+        self.hot_set_size = hot_set_size
+        self.active_days = active_days
+
+        self.hot_set = []
+        self.loaded = 0
+        self.failed = 0
+        self.state = "pending"
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def order_datasets(self) -> list[str]:
+        """Dataset ids, most requested first, then active missions, then the most recently updated."""
+        now = datetime.now(timezone.utc)
+        active_since = now - timedelta(days=self.active_days)
+        catalogue = self.erddap_collections.meta.get_catalogue()
+
+        def sort_key(dataset_id):
+            metadata = catalogue[dataset_id]
+            end = None if metadata.interval is None else metadata.interval[1]
+            active = end is not None and end >= active_since
+            last_update = end.timestamp() if end is not None else 0.0
+            return -self.erddap_collections.access_counts.get(dataset_id), not active, -last_update
+
+        return sorted(catalogue.keys(), key=sort_key)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="cache-warmer", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        with self.lock:
+            self.state = "running"
+
+        try:
+            self.hot_set = self.order_datasets()[:self.hot_set_size]
+            logger.info("Warming %d datasets with %d workers", len(self.hot_set), self.workers)
+
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cache-warmer") as executor:
+                for dataset_id in self.hot_set:
+                    executor.submit(self.warm, dataset_id)
+        except Exception:
+            # never hold readiness back forever, the datasets still load on demand
+            logger.exception("Warm-up stopped early")
+        finally:
+            with self.lock:
+                self.state = "done"
+
+        logger.info("Warm-up done, %d loaded, %d failed", self.loaded, self.failed)
+
+    def warm(self, dataset_id):
+        # let user requests download first, ERDDAP serves only a few downloads well at a time
+        self.erddap_collections.wait_for_idle(WARMUP_YIELD_TIMEOUT)
+
+        try:
+            with upstream.background():
+                self.erddap_collections.get_collection_as_data(dataset_id, background=True)
+        except Exception as err:
+            logger.warning("Could not warm %s: %s", dataset_id, err)
+            with self.lock:
+                self.failed += 1
+            return
+
+        with self.lock:
+            self.loaded += 1
+
+    def is_ready(self) -> bool:
+        return self.state == "done"
+
+    def progress(self) -> dict:
+        with self.lock:
+            return dict(state=self.state, ready=self.is_ready(), hot_set=len(self.hot_set),
+                        loaded=self.loaded, failed=self.failed)
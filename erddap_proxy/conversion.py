@@ -0,0 +1,110 @@
+"""Downloaded ERDDAP geoJson parsed and converted into collections in worker processes.
+
+Conversion is CPU bound Python, in the serving process it holds the GIL for
+as long as a large dataset takes and every other request waits. Responses of
+CONVERT_OFFLOAD_BYTES or more are sent to a pool of CONVERT_WORKERS
+processes instead, which parse and convert them and send back compact
+buffers: the feature arena, the ids and numpy arrays of the bounds, points and
+columns. The serving process wraps those without building an object per
+feature. At most MAX_CONVERSIONS conversions run at once, the others wait for
+a slot, so a burst of cold loads doesn't hold every raw download in memory.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import geojson
+
+from ogc_api import geometry
+from ogc_api.data_structures import Collection, FeatureArena
+from erddap_proxy.shared_cache import MappedBounds, MappedPoints
+
+# 0 converts in the thread that downloaded the data
+CONVERT_WORKERS = int(os.environ.get("CONVERT_WORKERS", "2"))
+MAX_CONVERSIONS = int(os.environ.get("MAX_CONVERSIONS", "4"))
+# smaller responses are converted in the calling thread, sending them to a worker costs more than it saves
+CONVERT_OFFLOAD_BYTES = int(os.environ.get("CONVERT_OFFLOAD_BYTES", "65536"))
+
+logger = logging.getLogger(__name__)
+
+
+class Converter:
+    def __init__(self, workers: int = CONVERT_WORKERS, max_conversions: int = MAX_CONVERSIONS,
+                 offload_bytes: int = CONVERT_OFFLOAD_BYTES):
+        self.workers = workers
+        self.offload_bytes = offload_bytes
+        self.slots = threading.BoundedSemaphore(max_conversions)
+        # started on the first large conversion
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def get_pool(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.pool is None:
+                # spawned rather than forked, a fork of the threaded server could copy a held lock
+                self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context("spawn"))
+            return self.pool
+
+    def discard_pool(self, pool: ProcessPoolExecutor):
+        with self.lock:
+            if self.pool is pool:
+                self.pool = None
+        pool.shutdown(wait=False)
+
+    def convert(self, content: bytes, collection: Collection, default_properties=None) -> Collection:
+        """The collection filled from an ERDDAP geoJson response."""
+        with self.slots:
+            if self.workers <= 0 or len(content) < self.offload_bytes:
+                return convert_geojson(content, collection, default_properties)
+
+            pool = self.get_pool()
+            try:
+                packed = pool.submit(convert_packed, content, default_properties).result()
+            except BrokenProcessPool:
+                # a worker died, likely killed for its memory, the next conversion starts a new pool
+                logger.error("A conversion worker exited, restarting the pool")
+                self.discard_pool(pool)
+                raise
+        return unpack(packed, collection)
+
+    def shutdown(self):
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown()
+
+
+def convert_geojson(content: bytes, collection: Collection, default_properties=None) -> Collection:
+    # imported here, erddap_matadata imports this module
+    from erddap_proxy.erddap_matadata import ERDDAPData
+    return ERDDAPData.convert_to_collection(geojson.loads(content), collection, default_properties)
+
+
+def convert_packed(content: bytes, default_properties=None) -> dict:
+    """Runs in a worker process."""
+    return pack(convert_geojson(content, Collection(), default_properties))
+
+
+def pack(collection: Collection) -> dict:
+    """The parts of a converted collection as buffers and arrays, which are cheap to send between processes."""
+    features = FeatureArena.concatenate([collection.feature])
+    return dict(features=bytes(features.buffer), offsets=features.offsets, ids=collection.id,
+                bounds=geometry.bounds_array(collection.bbox), points=geometry.points_array(collection.web_mercator),
+                columns=collection.columns)
+
+
+def unpack(packed: dict, collection: Collection) -> Collection:
+    collection.feature = FeatureArena(packed["features"], packed["offsets"])
+    collection.id = packed["ids"]
+    collection.by_id = {feature_id: i for i, feature_id in enumerate(collection.id)}
+    collection.bbox = MappedBounds(memoryview(packed["bounds"].reshape(-1)))
+    collection.web_mercator = MappedPoints(memoryview(packed["points"].reshape(-1)))
+    collection.columns = packed["columns"]
+    return collection
+
+
+CONVERTER = Converter()
@@ -1,76 +1,658 @@
-from ogc_api.data_structures import Collection, CollectionMetadata
-from ceotr_erddap_proxy.erddapy_proxy import CeotrErddapProxy
+from ogc_api.data_structures import Collection, CollectionMetadata, FeatureArena, make_column
 import geojson
+import contextvars
+import fnmatch
 import json
-from datetime import datetime
+import logging
+import math
+import os
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+import numpy as np
 import requests
-from ogc_api import geometry
-import pandas as pd
+from ogc_api import geometry, metrics
+from erddap_proxy import upstream
+from erddap_proxy.conversion import CONVERTER, Converter
+from erddap_proxy.shared_cache import MappedBounds, MappedPoints, SnapshotStore, SHARED_CACHE_DIR
+
+# Columns of the ERDDAP allDatasets table used to build the collection list,
+# so extents are known without touching the datasets themselves
+CATALOGUE_VARIABLES = ["datasetID", "title",
+                       "minLongitude", "maxLongitude", "minLatitude", "maxLatitude",
+                       "minTime", "maxTime"]
+CATALOGUE_TTL = float(os.environ.get("CATALOGUE_TTL", "600"))
+ERDDAP_TIMEOUT = float(os.environ.get("ERDDAP_TIMEOUT", "120"))
+ACCESS_DECAY = float(os.environ.get("ACCESS_DECAY", "0.5"))
+# a cached collection older than this is downloaded again in the background, readers get the old one meanwhile
+COLLECTION_TTL = float(os.environ.get("COLLECTION_TTL", "3600"))
+# past the TTL plus this much, readers wait for the new version instead of getting the old one
+MAX_STALENESS = float(os.environ.get("MAX_STALENESS", "86400"))
+REFRESH_WORKERS = int(os.environ.get("REFRESH_WORKERS", "2"))
+# after a failed refresh, the stale collection is served this long before trying again
+REFRESH_RETRY_INTERVAL = float(os.environ.get("REFRESH_RETRY_INTERVAL", "60"))
+# datasets covering more than this many days are downloaded as several time windows at once
+CHUNK_DAYS = float(os.environ.get("CHUNK_DAYS", "30"))
+CHUNK_WORKERS = int(os.environ.get("CHUNK_WORKERS", "4"))
+MAX_CHUNKS = int(os.environ.get("MAX_CHUNKS", "16"))
+# times a failed window is downloaded again on its own, on top of the upstream retries
+CHUNK_RETRIES = int(os.environ.get("CHUNK_RETRIES", "1"))
+# extra ERDDAP variables loaded with some collections, eg: "otn200_*=temperature,salinity;*=conductivity"
+EXTRA_VARIABLES = os.environ.get("EXTRA_VARIABLES", "")
+
+# variables downloaded for each kind of dataset, the ones that aren't coordinates are the default properties
+DATASET_VARIABLES = {
+    "m_gps": ["time", "latitude", "longitude", "profile_id"],
+    "profile_id": ["time", "latitude", "longitude", "profile_id"],
+    "latlon": ["time", "latitude", "longitude"],
+}
+VARIABLE_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+logger = logging.getLogger(__name__)
+
 
 class ERDDAPCollections():
-    def __init__(self, erddap_server):
+    def __init__(self, erddap_server, shared_cache_dir=SHARED_CACHE_DIR, ttl=COLLECTION_TTL,
+                 max_staleness=MAX_STALENESS):
         self.erddap_server = erddap_server
-        self.e = CeotrErddapProxy(erddap_server)
-        
-        self.erddap_server = erddap_server
-        self.meta = ERDDAPMetadata(erddap_server, self.e)
-        self.data = ERDDAPData(erddap_server, self.e)
+        self.meta, self.data = self._create_sources(erddap_server)
         self.cache = {}
+        # snapshots shared with the other worker processes, None when each process keeps its own
+        self.shared = SnapshotStore(shared_cache_dir) if shared_cache_dir else None
+        self.variable_sets = parse_variable_sets(EXTRA_VARIABLES)
+        # variables users asked for, loaded again whenever the dataset is
+        self.requested_variables = {}
+        self.access_counts = AccessCounts()
+
+        # one lock per dataset so concurrent requests and warmers download it once
+        self.load_locks = {}
+        self.load_locks_lock = threading.Lock()
+        # number of loads started by user requests, background loads wait for it to drop to zero
+        self.interactive_loads = 0
+        self.idle = threading.Condition()
+
+        self.ttl = ttl
+        self.max_staleness = max_staleness
+        # the refresh running for each dataset, and when the last one failed
+        self.refreshes = {}
+        self.refresh_failures = {}
+        self.refresh_executor = None
+
+    def _create_sources(self, erddap_server):
+        self.e = LazyErddapProxy(erddap_server)
+        return ERDDAPMetadata(erddap_server, self.e), ERDDAPData(erddap_server, self.e)
 
     def get_collections(self):
         # for dataset_id in self.meta.get_erddap_datasets():
         #     self.get_collection_as_data(dataset_id)
-        return self.meta.get_erddap_as_collections()
+        collections = self.meta.get_erddap_as_collections()
+        self.prune_cache()
+        return collections
+
+    def prune_cache(self):
+        """Drop cached data of datasets that are no longer in the catalogue."""
+        catalogue = self.meta.get_catalogue()
+        for dataset_id in list(self.cache.keys()):
+            if dataset_id not in catalogue:
+                self.evict(dataset_id)
+
+    def evict(self, dataset_id):
+        if self.cache.pop(dataset_id, None) is not None:
+            metrics.CACHE_EVICTIONS.inc(collection=dataset_id)
+            metrics.CACHE_RESIDENT_BYTES.remove(collection=dataset_id)
     
     def get_collection_as_meta(self, dataset_id):
-       if dataset_id in self.meta.get_erddap_datasets():
-           return self.meta.create_erddap_collection(dataset_id)
+        if dataset_id in self.meta.get_catalogue():
+            return self.meta.create_erddap_collection(dataset_id)
+
+    def get_dataset_type(self, dataset_id):
+        dataset_type = self.meta.get_dataset_type(dataset_id)
+        if dataset_type is None:
+            # not resolved by the bulk lookup, ask for this dataset alone and remember it
+            dataset_type = self.data.detect_dataset_type(dataset_id)
+            self.meta.set_dataset_type(dataset_id, dataset_type)
+        return dataset_type
+
+    def get_collection_as_data(self, dataset_id, background=False):
+        if not background:
+            self.access_counts.record(dataset_id)
+            if dataset_id in self.cache:
+                metrics.CACHE_HITS.inc(collection=dataset_id)
+            else:
+                metrics.CACHE_MISSES.inc(collection=dataset_id)
 
-    def get_collection_as_data(self, dataset_id):
-        collection = self.get_collection_as_meta(dataset_id)
         if dataset_id not in self.cache:
-            self.cache[dataset_id] = self.data.get_erddap_as_collection(dataset_id, collection)
-        return self.cache[dataset_id]
+            if not background:
+                with self.idle:
+                    self.interactive_loads += 1
+            try:
+                with self._get_load_lock(dataset_id):
+                    if dataset_id not in self.cache:
+                        self.cache[dataset_id] = self._load_collection(dataset_id)
+                        metrics.CACHE_RESIDENT_BYTES.set(self.cache[dataset_id].resident_bytes(),
+                                                         collection=dataset_id)
+            finally:
+                if not background:
+                    with self.idle:
+                        self.interactive_loads -= 1
+                        self.idle.notify_all()
+
+        collection = self.cache[dataset_id]
+        age = collection.age()
+        if age > self.ttl:
+            if age > self.ttl + self.max_staleness:
+                # too old to serve, wait for the new version
+                return self.schedule_refresh(dataset_id, force=True).result()
+            self.schedule_refresh(dataset_id)
+        return collection
+
+    def schedule_refresh(self, dataset_id, force=False) -> Future:
+        """Starts downloading a new version of a cached collection, once however many readers ask."""
+        with self.load_locks_lock:
+            future = self.refreshes.get(dataset_id)
+            if future is not None:
+                return future
+
+            failed_at = self.refresh_failures.get(dataset_id)
+            if not force and failed_at is not None and time.monotonic() - failed_at < REFRESH_RETRY_INTERVAL:
+                future = Future()
+                future.set_result(self.cache.get(dataset_id))
+                return future
+
+            if self.refresh_executor is None:
+                self.refresh_executor = ThreadPoolExecutor(max_workers=REFRESH_WORKERS,
+                                                           thread_name_prefix="collection-refresh")
+            future = self.refresh_executor.submit(self.refresh, dataset_id)
+            self.refreshes[dataset_id] = future
+            return future
+
+    def refresh(self, dataset_id) -> Collection:
+        """Builds the new version of a cached collection and swaps it in, the old one is served meanwhile."""
+        try:
+            return self._refresh(dataset_id)
+        finally:
+            # whatever happened, the next reader past the TTL may start another one
+            with self.load_locks_lock:
+                self.refreshes.pop(dataset_id, None)
+
+    def _refresh(self, dataset_id) -> Collection:
+        current = self.cache.get(dataset_id)
+        try:
+            with upstream.background():
+                collection = self._load_collection(dataset_id, None if current is None else current.fetched_at)
+        except Exception as err:
+            # any failure, a conversion worker dying included, leaves the cached version in place
+            logger.warning("Could not refresh %s, serving the cached version: %s", dataset_id, err)
+            metrics.COLLECTION_REFRESHES.inc(collection=dataset_id, outcome="failed")
+            with self.load_locks_lock:
+                self.refresh_failures[dataset_id] = time.monotonic()
+            return current
+
+        with self._get_load_lock(dataset_id):
+            # evicted while downloading, don't bring it back
+            if dataset_id in self.cache:
+                # readers holding the old collection keep using it, it is never modified
+                self.cache[dataset_id] = collection
+                metrics.CACHE_RESIDENT_BYTES.set(collection.resident_bytes(), collection=dataset_id)
+
+        metrics.COLLECTION_REFRESHES.inc(collection=dataset_id, outcome="refreshed")
+        with self.load_locks_lock:
+            self.refresh_failures.pop(dataset_id, None)
+        return collection
+
+    def _load_collection(self, dataset_id, newer_than=None) -> Collection:
+        if self.shared is None:
+            return self._fetch_collection(dataset_id)
+
+        # whichever worker process gets the lock first fetches, the others map its snapshot
+        with self.shared.fetch_lock(dataset_id):
+            collection = self.shared.load(dataset_id, self.get_collection_as_meta(dataset_id), newer_than)
+            if collection is not None:
+                return collection
+
+            collection = self._fetch_collection(dataset_id)
+            self.shared.save(dataset_id, collection)
+
+        # drop the private copy for the mapped one every process shares
+        return self.shared.load(dataset_id, self.get_collection_as_meta(dataset_id))
+
+    def _fetch_collection(self, dataset_id, more_variables=()) -> Collection:
+        fetched_at = time.time()
+        collection = self.get_collection_as_meta(dataset_id)
+        dataset_type = self.get_dataset_type(dataset_id)
+        extra_variables = self.get_extra_variables(dataset_id)
+        extra_variables += [variable for variable in more_variables if variable not in extra_variables]
+        collection = self.data.get_erddap_as_collection(dataset_id, collection, dataset_type, extra_variables)
+        collection.fetched_at = fetched_at
+        return collection
+
+    def get_extra_variables(self, dataset_id) -> list[str]:
+        variables = []
+        for pattern, names in self.variable_sets:
+            if fnmatch.fnmatchcase(dataset_id, pattern):
+                variables.extend(name for name in names if name not in variables)
+        variables.extend(sorted(self.requested_variables.get(dataset_id, set()) - set(variables)))
+        return variables
+
+    def get_collection_with_variables(self, dataset_id, variables: list[str]) -> Collection:
+        """The cached collection, with the columns of any of the variables it doesn't hold yet downloaded."""
+        collection = self.get_collection_as_data(dataset_id)
+        if all(variable in collection.columns for variable in variables):
+            return collection
+
+        with self._get_load_lock(dataset_id):
+            collection = self.cache[dataset_id]
+            missing = [variable for variable in variables if variable not in collection.columns]
+            if len(missing) == 0:
+                return collection
+
+            columns = self.data.get_erddap_columns(dataset_id, self.get_dataset_type(dataset_id), missing,
+                                                   collection.columns.get("time"))
+            if columns is None:
+                # the dataset changed since it was loaded, load all of it again with the new variables
+                collection = self._fetch_collection(dataset_id, missing)
+            else:
+                # a new collection rather than adding to the cached one, readers may be using it
+                collection = collection.with_columns(columns)
+
+            # only once ERDDAP has them, a refused name would make every later load of the dataset fail
+            self.requested_variables.setdefault(dataset_id, set()).update(missing)
+
+            self.cache[dataset_id] = collection
+            metrics.CACHE_RESIDENT_BYTES.set(collection.resident_bytes(), collection=dataset_id)
+            return collection
+
+    def get_filtered_collection(self, dataset_id, variables: list[str], constraints: list) -> Collection:
+        """Only the rows matching constraints, downloaded for this one request and not cached."""
+        for variable in variables:
+            if not VARIABLE_NAME.match(variable):
+                raise ValueError(f"Malformed variable name: {variable}")
+
+        fetched_at = time.time()
+        extra_variables = self.get_extra_variables(dataset_id)
+        extra_variables += [variable for variable in variables if variable not in extra_variables]
+        collection = self.data.get_erddap_as_collection(dataset_id, self.get_collection_as_meta(dataset_id),
+                                                        self.get_dataset_type(dataset_id), extra_variables,
+                                                        constraints)
+        collection.fetched_at = fetched_at
+        return collection
+
+    def wait_for_idle(self, timeout=None) -> bool:
+        """Block until no user request is loading a dataset, used by background loaders to yield."""
+        with self.idle:
+            return self.idle.wait_for(lambda: self.interactive_loads == 0, timeout)
+
+    def _get_load_lock(self, dataset_id) -> threading.Lock:
+        with self.load_locks_lock:
+            if dataset_id not in self.load_locks:
+                self.load_locks[dataset_id] = threading.Lock()
+            return self.load_locks[dataset_id]
+
+class AccessCounts():
+    """How often each dataset was requested, optionally carried over from previous runs."""
+
+    def __init__(self, decay: float = ACCESS_DECAY):
+        self.decay = decay
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def record(self, dataset_id):
+        with self.lock:
+            self.counts[dataset_id] = self.counts.get(dataset_id, 0) + 1
+
+    def get(self, dataset_id) -> float:
+        return self.counts.get(dataset_id, 0)
+
+    def load(self, path: str):
+        try:
+            with open(path, "r") as file:
+                saved = json.load(file)
+        except (OSError, ValueError) as err:
+            logger.info("No access counts loaded from %s: %s", path, err)
+            return
+
+        # older runs weigh less, so the order follows recent use
+        with self.lock:
+            for dataset_id, count in saved.items():
+                self.counts[dataset_id] = self.counts.get(dataset_id, 0) + count * self.decay
+
+    def save(self, path: str):
+        with self.lock:
+            counts = dict(self.counts)
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(counts, file)
+        os.replace(tmp_path, path)
+
 
 class ERDDAPMetadata():
-    def __init__(self, erddap_server: str, erddap_proxy: CeotrErddapProxy):
+    def __init__(self, erddap_server: str, erddap_proxy: 'LazyErddapProxy', ttl: float = CATALOGUE_TTL):
         self.erddap_server = erddap_server
         self.e = erddap_proxy
-        
+        self.ttl = ttl
+        self.catalogue = {}
+        self.catalogue_time = None
+        # when the last allDatasets download failed, it isn't tried again for REFRESH_RETRY_INTERVAL
+        self.failed_at = None
+        self.dataset_types = {}
+        self.lock = threading.Lock()
+        # started on the first refresh past the TTL
+        self.refresh_executor = None
+        self.refreshing = None
+
+    def get_catalogue(self) -> dict[str, CollectionMetadata]:
+        """Dataset metadata by dataset id, past the TTL it is served while allDatasets is downloaded again."""
+        if self.catalogue_time is None:
+            with self.lock:
+                # nothing to serve yet, wait for it unless another thread just failed to get it
+                if self.catalogue_time is None and not self.backing_off():
+                    self.refresh_catalogue()
+        elif time.monotonic() - self.catalogue_time > self.ttl:
+            self.schedule_refresh()
+        return self.catalogue
+
+    def backing_off(self) -> bool:
+        return self.failed_at is not None and time.monotonic() - self.failed_at < REFRESH_RETRY_INTERVAL
+
+    def schedule_refresh(self) -> Future:
+        """Starts downloading allDatasets in the background, None while backing off from a failure."""
+        with self.lock:
+            if self.refreshing is not None and not self.refreshing.done():
+                return self.refreshing
+            if self.backing_off():
+                return None
+
+            if self.refresh_executor is None:
+                self.refresh_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="catalogue-refresh")
+            self.refreshing = self.refresh_executor.submit(self._refresh_in_background)
+            return self.refreshing
+
+    def _refresh_in_background(self):
+        with upstream.background():
+            self.refresh_catalogue()
+
+    def refresh_catalogue(self):
+        try:
+            rows = self._get_all_datasets()
+        except (requests.RequestException, ValueError, KeyError) as err:
+            # keep serving the previous catalogue, retried once REFRESH_RETRY_INTERVAL has passed
+            logger.warning("Could not refresh the ERDDAP catalogue from %s: %s", self.erddap_server, err)
+            self.failed_at = time.monotonic()
+            return
+
+        catalogue = {}
+        for row in rows:
+            metadata = parse_catalogue_row(row)
+            if metadata.name != "allDatasets":
+                catalogue[metadata.name] = metadata
+
+        dataset_types = self._resolve_dataset_types(catalogue)
+
+        # swap the whole catalogue at once so readers never see a partial one
+        self.catalogue = catalogue
+        self.dataset_types = dataset_types
+        self.catalogue_time = time.monotonic()
+        self.failed_at = None
+
+    def get_dataset_type(self, dataset_id):
+        return self.dataset_types.get(dataset_id)
+
+    def set_dataset_type(self, dataset_id, dataset_type):
+        self.dataset_types[dataset_id] = dataset_type
+
+    def _resolve_dataset_types(self, catalogue: dict) -> dict[str, str]:
+        try:
+            m_gps = self._get_datasets_with_variable("m_gps_lat")
+            profile = self._get_datasets_with_variable("profile_id")
+        except (requests.RequestException, ValueError, KeyError) as err:
+            # keep what previous refreshes and per dataset lookups found
+            logger.warning("Could not resolve dataset types from %s: %s", self.erddap_server, err)
+            return {dataset_id: dataset_type for dataset_id, dataset_type in self.dataset_types.items()
+                    if dataset_id in catalogue}
+
+        dataset_types = {}
+        for dataset_id in catalogue:
+            if dataset_id in m_gps:
+                dataset_types[dataset_id] = "m_gps"
+            elif dataset_id in profile:
+                dataset_types[dataset_id] = "profile_id"
+            else:
+                dataset_types[dataset_id] = "latlon"
+        return dataset_types
+
+    def _get_datasets_with_variable(self, variable: str) -> set[str]:
+        categorize_url = self.e.get_categorize_url("variableName", variable.lower(), response="json")
+        rows = table_rows(get_json(categorize_url, "categorize", missing_ok=True))
+        return set(row["Dataset ID"] for row in rows)
+
+    def _get_all_datasets(self) -> list[dict]:
+        # built without touching the shared proxy state, which dataset downloads modify
+        all_datasets_url = get_download_url(self.e.server, dataset_id="allDatasets", response="json",
+                                            protocol="tabledap", variables=CATALOGUE_VARIABLES)
+        return table_rows(get_json(all_datasets_url, "catalogue"))
+
     def get_erddap_datasets(self) -> list[str]:
-        self.e.constraints = {}
-        dataset_ids = self.e.get_dataset_ids()
-        dataset_ids.remove("allDatasets")
-        return dataset_ids
+        return list(self.get_catalogue().keys())
     
     def create_erddap_collection(self, dataset_id) -> Collection:
         collection = Collection()
-        c_meta = CollectionMetadata(dataset_id, 
-                                    dataset_id,
-                                    None)
+        c_meta = self.get_catalogue().get(dataset_id)
+        if c_meta is None:
+            c_meta = CollectionMetadata(dataset_id,
+                                        dataset_id,
+                                        None)
         collection.metadata = c_meta
         return collection
         
         
     def get_erddap_as_collections(self):
         collections = []
-        dataset_ids = self.get_erddap_datasets()
-        # dataset_ids = [dataset_ids[50]]
-        for dataset_id in dataset_ids:
+        for dataset_id in self.get_catalogue():
             collection = self.create_erddap_collection(dataset_id)
             collections.append(collection)
         return collections
 
+
+class LazyErddapProxy():
+    """The CeotrErddapProxy, created the first time a url needs it.
+
+    erddapy imports pandas, which is most of the startup time, and plain
+    downloads only need the server url.
+    """
+
+    def __init__(self, erddap_server):
+        # as erddapy keeps it
+        self.server = erddap_server.rstrip("/")
+        self._proxy = None
+
+    def __getattr__(self, name):
+        if self._proxy is None:
+            from ceotr_erddap_proxy.erddapy_proxy import CeotrErddapProxy
+            self._proxy = CeotrErddapProxy(self.server)
+        return getattr(self._proxy, name)
+
+
+def get_download_url(*args, **kwargs) -> str:
+    # erddapy's, imported on first use for the same reason as LazyErddapProxy
+    from erddapy.core.url import get_download_url as erddapy_download_url
+    return erddapy_download_url(*args, **kwargs)
+
+
+def get_json(url: str, kind: str, missing_ok: bool = False):
+    res = download(url, kind)
+    # ERDDAP answers 404 when a query matches nothing
+    if missing_ok and res.status_code == 404:
+        return None
+    res.raise_for_status()
+    return res.json()
+
+
+def download(url: str, kind: str) -> requests.Response:
+    logger.info("Downloading %s", url)
+    with metrics.ERDDAP_DOWNLOAD_SECONDS.time(kind=kind):
+        res = upstream.UPSTREAM.get(url, timeout=ERDDAP_TIMEOUT)
+    metrics.ERDDAP_DOWNLOAD_BYTES.observe(len(res.content), kind=kind)
+    return res
+
+
+def table_rows(erddap_json) -> list[dict]:
+    if erddap_json is None:
+        return []
+    table = erddap_json["table"]
+    column_names = table["columnNames"]
+    return [dict(zip(column_names, row)) for row in table["rows"]]
+
+
+def parse_variable_sets(value: str) -> list[tuple[str, list[str]]]:
+    """Parses "pattern=variable,variable;pattern=variable" into (dataset id pattern, variables) pairs."""
+    variable_sets = []
+    for variable_set in value.split(";"):
+        pattern, _, names = variable_set.partition("=")
+        names = [name.strip() for name in names.split(",") if name.strip() != ""]
+        if pattern.strip() == "" or len(names) == 0:
+            continue
+
+        for name in names:
+            if not VARIABLE_NAME.match(name):
+                raise ValueError(f"Malformed variable name in EXTRA_VARIABLES: {name}")
+        variable_sets.append((pattern.strip(), names))
+    return variable_sets
+
+
+def parse_erddap_time(value: str) -> float:
+    """Seconds since 1970 of an ERDDAP ISO 8601 time, which is UTC unless it says otherwise."""
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def parse_catalogue_row(row: dict) -> CollectionMetadata:
+    dataset_id = row["datasetID"]
+
+    bbox = [_parse_float(row.get(name)) for name in ("minLongitude", "minLatitude", "maxLongitude", "maxLatitude")]
+    interval = [_parse_time(row.get("minTime")), _parse_time(row.get("maxTime"))]
+
+    return CollectionMetadata(dataset_id, dataset_id, None,
+                              title=row.get("title") or None,
+                              bbox=None if None in bbox else bbox,
+                              interval=None if interval == [None, None] else interval)
+
+
+def _parse_float(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(value) else value
+
+
+def _parse_time(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        if math.isnan(value):
+            return None
+        return datetime.fromtimestamp(value, tz=timezone.utc)
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
     
+def time_windows(metadata: CollectionMetadata, chunk_seconds: float, max_chunks: int = MAX_CHUNKS) -> list:
+    """(start, end) seconds since 1970 splitting the dataset's time coverage, the first and last are open ended.
+
+    One window, (None, None), when the coverage is unknown or shorter than chunk_seconds.
+    """
+    interval = None if metadata is None else metadata.interval
+    if interval is None or interval[0] is None or interval[1] is None:
+        return [(None, None)]
+
+    start, end = interval[0].timestamp(), interval[1].timestamp()
+    count = min(math.ceil((end - start) / chunk_seconds), max_chunks)
+    if count <= 1:
+        return [(None, None)]
+
+    # whole seconds, feature ids are whole seconds too so no feature falls between two windows
+    bounds = [math.floor(start + (end - start) * i / count) for i in range(1, count)]
+    # open ended so rows added after the catalogue was read are still in the last window
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def window_constraints(window: tuple) -> list:
+    start, end = window
+    constraints = []
+    if start is not None:
+        constraints.append(("time>=", datetime.fromtimestamp(start, tz=timezone.utc)))
+    if end is not None:
+        constraints.append(("time<", datetime.fromtimestamp(end, tz=timezone.utc)))
+    return constraints
+
+
+def is_retryable(err: requests.RequestException) -> bool:
+    if isinstance(err, upstream.UpstreamBusy):
+        return False
+    # ERDDAP refusing the query will refuse it again
+    response = getattr(err, "response", None)
+    return response is None or response.status_code >= 500
+
+
+def merge_collections(collection: Collection, parts: list) -> Collection:
+    """Appends the parts to collection in order, offsetting their ids and joining their columns."""
+    columns = {}
+    features = [collection.feature]
+    bounds = [collection.bbox]
+    points = [collection.web_mercator]
+    offset = len(collection.feature)
+    for part in parts:
+        if part is None or len(part.feature) == 0:
+            continue
+
+        collection.id.extend(part.id)
+        for feature_id, i in part.by_id.items():
+            collection.by_id[feature_id] = offset + i
+        offset += len(part.feature)
+        features.append(part.feature)
+        bounds.append(part.bbox)
+        points.append(part.web_mercator)
+        for name, column in part.columns.items():
+            columns.setdefault(name, []).append(column)
+
+    collection.feature = FeatureArena.concatenate(features)
+    if all(isinstance(part_bounds, list) for part_bounds in bounds):
+        collection.bbox = [rect for part_bounds in bounds for rect in part_bounds]
+        collection.web_mercator = [point for part_points in points for point in part_points]
+    else:
+        # parts converted in worker processes are arrays, joined without making an object per feature
+        collection.bbox = MappedBounds(memoryview(
+            np.concatenate([geometry.bounds_array(part_bounds) for part_bounds in bounds]).reshape(-1)))
+        collection.web_mercator = MappedPoints(memoryview(
+            np.concatenate([geometry.points_array(part_points) for part_points in points]).reshape(-1)))
+    collection.columns = {name: np.concatenate(column_parts) for name, column_parts in columns.items()}
+    return collection
+
+
 class ERDDAPData():
-    def __init__(self, erddap_server, erddap_proxy: CeotrErddapProxy):
+    def __init__(self, erddap_server, erddap_proxy: 'LazyErddapProxy', chunk_seconds: float = CHUNK_DAYS * 86400,
+                 chunk_workers: int = CHUNK_WORKERS, max_chunks: int = MAX_CHUNKS, converter: Converter = CONVERTER):
         self.e = erddap_proxy
         self.erddap_server = erddap_server
+        self.chunk_seconds = chunk_seconds
+        self.chunk_workers = chunk_workers
+        self.max_chunks = max_chunks
+        self.converter = converter
 
     def detect_dataset_type(self, dataset_id):
-        metadata_url = self.e.get_info_url(dataset_id, response="csv")
-        df = pd.read_csv(metadata_url)
-        variable_values = df["Variable Name"].values
+        metadata_url = self.e.get_info_url(dataset_id, response="json")
+        variable_values = set(row["Variable Name"] for row in table_rows(get_json(metadata_url, "info"))
+                              if row["Row Type"] == "variable")
         if "m_gps_lat" in variable_values:
             return "m_gps"
         elif "profile_id" in variable_values:
@@ -78,36 +660,83 @@ class ERDDAPData():
         else:
             return "latlon"
 
-    def _get_erddap_geojson(self, dataset_id) -> geojson:
-        self.e.dataset_id = dataset_id
-
-        dataset_type = self.detect_dataset_type(dataset_id)
+    def _get_download_url(self, dataset_id, dataset_type, variables: list[str], response: str,
+                          constraints=()) -> str:
+        # the url is built from locals rather than the shared proxy attributes,
+        # datasets can be downloaded from several threads at once
         download_url = ""
-        self.e.constraints = {}
-        self.e.response = "geoJson"
+        dataset_constraints = {}
         if dataset_type == "m_gps":
-            self.e.variables = ["time", "latitude", "longitude", "profile_id"]
-            self.e.constraints = {
+            dataset_constraints = {
                 "m_gps_lat!=": float('NaN')
             }
-            download_url = self.e.get_download_url()
-            download_url = download_url.replace("!=nan", "!=NaN")
         elif dataset_type == "profile_id":
-            self.e.variables = ["time", "latitude", "longitude", "profile_id"]
-            self.e.constraints = {
+            dataset_constraints = {
                 "depth<": 10 
             }
-            download_url = self.e.get_download_url()
-        elif dataset_type == "latlon":
-            self.e.variables = ["time", "latitude", "longitude"]
-            download_url = self.e.get_download_url()
-            
-        print(download_url)
+        elif dataset_type != "latlon":
+            return download_url
+
+        for key, value in constraints:
+            # a repeated key would replace the earlier one, skipping it only widens the download
+            dataset_constraints.setdefault(key, value)
+
+        download_url = get_download_url(self.e.server, dataset_id=dataset_id, protocol="tabledap",
+                                        response=response, variables=variables,
+                                        constraints=dataset_constraints or None)
+        return download_url.replace("!=nan", "!=NaN")
+
+    def _download_geojson(self, dataset_id, dataset_type=None, extra_variables=(), constraints=(),
+                          kind="filtered") -> bytes:
+        """The geoJson response body, parsed where it is converted."""
+        if dataset_type is None:
+            dataset_type = self.detect_dataset_type(dataset_id)
+
+        variables = DATASET_VARIABLES[dataset_type]
+        variables = variables + [variable for variable in extra_variables if variable not in variables]
+        download_url = self._get_download_url(dataset_id, dataset_type, variables, "geoJson", constraints)
+
+        if constraints:
+            res = download(download_url, kind)
+            # a filter matching nothing is an empty collection, not an error
+            if res.status_code == 404:
+                return None
+            res.raise_for_status()
+            return res.content
 
-        res = requests.get(download_url)
-        return geojson.loads(json.dumps(res.json()))
+        res = download(download_url, "data")
+        # an error page would otherwise be parsed as the dataset
+        res.raise_for_status()
+        return res.content
 
-    def convert_to_collection(self, erddap_geojson: geojson, collection: Collection) -> Collection:
+    def _get_erddap_geojson(self, dataset_id, dataset_type=None, extra_variables=(), constraints=(),
+                            kind="filtered") -> geojson:
+        content = self._download_geojson(dataset_id, dataset_type, extra_variables, constraints, kind)
+        return None if content is None else geojson.loads(content)
+
+    def _convert(self, content: bytes, collection: Collection, default_properties) -> Collection:
+        with metrics.CONVERT_SECONDS.time():
+            return self.converter.convert(content, collection, default_properties)
+
+    def get_erddap_columns(self, dataset_id, dataset_type, variables: list[str], times=None):
+        """Downloads just the given variables, None when the rows no longer line up with times."""
+        for variable in variables:
+            if not VARIABLE_NAME.match(variable):
+                raise ValueError(f"Malformed variable name: {variable}")
+
+        # same constraints as the collection was loaded with, so the rows come back in the same order
+        download_url = self._get_download_url(dataset_id, dataset_type, ["time"] + variables, "json")
+        rows = table_rows(get_json(download_url, "columns"))
+
+        loaded_times = np.array([parse_erddap_time(row["time"]) for row in rows], dtype=np.float64)
+        if times is not None and not np.array_equal(loaded_times, times):
+            return None
+
+        return {variable: make_column([row[variable] for row in rows]) for variable in variables}
+
+    @staticmethod
+    def convert_to_collection(erddap_geojson: geojson, collection: Collection,
+                              default_properties=None) -> Collection:
         # last_profile_id = 0
         # index_offset = 0
         # latlons = []
@@ -144,6 +773,13 @@ class ERDDAPData():
 
         last_profile_id = 0
         index_offset = 0
+        values = {}
+        times = []
+        lats = []
+        lons = []
+        # every encoded feature goes into one buffer, see FeatureArena
+        features = bytearray()
+        offsets = [0]
         for index, feature in enumerate(erddap_geojson.features):
             # if "profile_id" in feature.properties:
             #     profile_id = feature.properties["profile_id"]
@@ -152,27 +788,91 @@ class ERDDAPData():
             #         continue
             #     else:
             #         last_profile_id = profile_id
-            id_int = int(datetime.fromisoformat(feature.properties["time"].removesuffix("Z")).timestamp())
+            time_value = parse_erddap_time(feature.properties["time"])
+            id_int = int(time_value)
             id_str = str(id_int)
             collection.id.append(id_str)
             collection.by_id[id_str] = index - index_offset
+
+            times.append(time_value)
+            lons.append(feature.geometry["coordinates"][0])
+            lats.append(feature.geometry["coordinates"][1])
+            for name, value in feature.properties.items():
+                if name != "time":
+                    values.setdefault(name, []).append(value)
+
+            # every variable is kept as a column, only the default ones are in the encoded feature
+            if default_properties is not None:
+                feature["properties"] = {name: value for name, value in feature.properties.items()
+                                         if name in default_properties}
             feature["id"] = id_str
-            collection.feature.append(geojson.dumps(feature, ensure_ascii=False, separators=(',', ':')))
-            collection.bbox.append(geometry.compute_bounds(feature.geometry))
-            # 
-            center = collection.bbox[index-index_offset].get_center()
-            collection.web_mercator.append(geometry.project_web_mercator(center))
+            features += geojson.dumps(feature, ensure_ascii=False, separators=(',', ':')).encode("utf8")
+            features += b","
+            offsets.append(len(features))
+
+        collection.feature = FeatureArena(features, offsets)
+        # every feature is a point, its bounds and projected center are computed for all of them at once
+        bounds = geometry.compute_point_bounds_batch(lats, lons)
+        x, y = geometry.project_web_mercator_batch(np.degrees(bounds[:, 0]), np.degrees(bounds[:, 2]))
+        collection.bbox = MappedBounds(memoryview(bounds.reshape(-1)))
+        collection.web_mercator = MappedPoints(memoryview(np.stack([x, y], axis=1).reshape(-1)))
+        collection.columns = {"time": np.array(times, dtype=np.float64),
+                              "latitude": make_column(lats),
+                              "longitude": make_column(lons)}
+        for name, column_values in values.items():
+            collection.columns[name] = make_column(column_values)
         return collection
 # 
 
 
-    def get_erddap_as_collection(self, dataset_id, collection):
-        erddap_geojson = self._get_erddap_geojson(dataset_id)
-        if erddap_geojson:
-            collection = self.convert_to_collection(erddap_geojson, collection)
+    def get_erddap_as_collection(self, dataset_id, collection, dataset_type=None, extra_variables=(),
+                                 constraints=()):
+        if dataset_type is None:
+            dataset_type = self.detect_dataset_type(dataset_id)
+
+        if len(constraints) == 0:
+            windows = time_windows(getattr(collection, "metadata", None), self.chunk_seconds, self.max_chunks)
+            if len(windows) > 1:
+                return self._get_chunked_collection(dataset_id, collection, dataset_type, extra_variables, windows)
+
+        content = self._download_geojson(dataset_id, dataset_type, extra_variables, constraints)
+        if content:
+            default_properties = [v for v in DATASET_VARIABLES[dataset_type] if v not in ("latitude", "longitude")]
+            return self._convert(content, collection, default_properties)
+        elif constraints:
             return collection
         else:
             return Collection()
+
+    def _get_chunked_collection(self, dataset_id, collection, dataset_type, extra_variables, windows):
+        """Downloads and converts the time windows at once, then joins them in time order."""
+        default_properties = [v for v in DATASET_VARIABLES[dataset_type] if v not in ("latitude", "longitude")]
+
+        def load_window(window):
+            constraints = window_constraints(window)
+            for attempt in range(CHUNK_RETRIES + 1):
+                try:
+                    content = self._download_geojson(dataset_id, dataset_type, extra_variables,
+                                                     constraints, "chunk")
+                    break
+                except requests.RequestException as err:
+                    if attempt == CHUNK_RETRIES or not is_retryable(err):
+                        raise
+                    logger.warning("Downloading %s %s again: %s", dataset_id, window, err)
+
+            if not content:
+                return None
+            # converted as soon as it lands, so only the windows in flight are held as geoJson
+            return self._convert(content, Collection(), default_properties)
+
+        with ThreadPoolExecutor(max_workers=self.chunk_workers, thread_name_prefix="chunk") as executor:
+            # each window keeps the caller's upstream priority
+            futures = [executor.submit(contextvars.copy_context().run, load_window, window) for window in windows]
+            parts = [future.result() for future in futures]
+
+        if all(part is None for part in parts):
+            return Collection()
+        return merge_collections(collection, parts)
             
 
     
@@ -0,0 +1,179 @@
+"""Several ERDDAP servers served as one, under namespaced collection ids.
+
+ERDDAP_SERVERS="otn=https://erddap.oceantrack.org/erddap/,ioos=https://gliders.ioos.us/erddap/"
+serves the datasets of the first server as otn:<datasetID> and of the second
+as ioos:<datasetID>. Each server keeps its own catalogue and dataset types,
+refreshed in the background while the previous ones are served. Only a server
+with no catalogue yet is waited for, at most FEDERATION_TIMEOUT, its download
+goes on in the background after that, so one slow partner doesn't hold up
+requests. Collections are
+cached, refreshed and warmed by ERDDAPCollections like a single server's, and
+downloads are limited per host by erddap_proxy.upstream.
+"""
+import copy
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from ogc_api.data_structures import Collection, CollectionMetadata
+from erddap_proxy.erddap_matadata import ERDDAPCollections, ERDDAPData, ERDDAPMetadata, LazyErddapProxy
+
+# seconds a request waits for the servers that have no catalogue yet
+FEDERATION_TIMEOUT = float(os.environ.get("FEDERATION_TIMEOUT", "10"))
+
+SEPARATOR = ":"
+NAMESPACE = re.compile(r"^[A-Za-z0-9_]+$")
+
+logger = logging.getLogger(__name__)
+
+
+def parse_servers(value: str) -> dict[str, str]:
+    """ERDDAP url by namespace, from "name=url,name=url"."""
+    servers = {}
+    for server in value.split(","):
+        if server.strip() == "":
+            continue
+        namespace, found, url = server.partition("=")
+        namespace, url = namespace.strip(), url.strip()
+        if not found or url == "":
+            raise ValueError(f"Expected name=url in ERDDAP_SERVERS: {server}")
+        if not NAMESPACE.match(namespace):
+            raise ValueError(f"Malformed server name in ERDDAP_SERVERS: {namespace}")
+        if namespace in servers:
+            raise ValueError(f"Server name used twice in ERDDAP_SERVERS: {namespace}")
+        servers[namespace] = url
+    return servers
+
+
+def join_id(namespace: str, dataset_id: str) -> str:
+    return namespace + SEPARATOR + dataset_id
+
+
+def split_id(collection_id: str) -> tuple[str, str]:
+    """The namespace and ERDDAP dataset id of a collection, ("", collection_id) when it has no namespace."""
+    namespace, found, dataset_id = collection_id.partition(SEPARATOR)
+    if not found:
+        return "", collection_id
+    return namespace, dataset_id
+
+
+class FederatedMetadata:
+    """The catalogues of several ERDDAPMetadata merged, with namespaced collection ids."""
+
+    def __init__(self, members: dict[str, ERDDAPMetadata], timeout: float = FEDERATION_TIMEOUT):
+        self.members = members
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=len(members), thread_name_prefix="federation")
+        # the first catalogue download running for each server, so a slow one isn't asked again while it works
+        self.refreshes = {}
+        self.lock = threading.Lock()
+        # merged catalogue and the member catalogues it was made from
+        self.catalogue = {}
+        self.merged_from = None
+
+    def get_catalogue(self) -> dict[str, CollectionMetadata]:
+        """Every server's datasets by namespaced id, waiting at most timeout for the ones with no catalogue yet."""
+        pending = []
+        with self.lock:
+            for namespace, member in self.members.items():
+                if member.catalogue_time is not None:
+                    # returns at once, past its TTL the member refreshes in the background
+                    member.get_catalogue()
+                    continue
+                if member.backing_off():
+                    continue
+                refresh = self.refreshes.get(namespace)
+                if refresh is None or refresh.done():
+                    refresh = self.executor.submit(member.get_catalogue)
+                    self.refreshes[namespace] = refresh
+                pending.append(refresh)
+
+        if len(pending) > 0:
+            _, not_done = wait(pending, timeout=self.timeout)
+            if len(not_done) > 0:
+                logger.warning("%d ERDDAP servers didn't send their catalogue in %.0f s, listed without them",
+                               len(not_done), self.timeout)
+
+        return self.merge()
+
+    def merge(self) -> dict[str, CollectionMetadata]:
+        # member catalogues are replaced whole when refreshed, so the same objects mean nothing changed
+        catalogues = tuple(member.catalogue for member in self.members.values())
+        with self.lock:
+            if self.merged_from is not None and all(a is b for a, b in zip(catalogues, self.merged_from)):
+                return self.catalogue
+
+            catalogue = {}
+            for namespace, member_catalogue in zip(self.members, catalogues):
+                for dataset_id, metadata in member_catalogue.items():
+                    collection_id = join_id(namespace, dataset_id)
+                    metadata = copy.copy(metadata)
+                    metadata.name = collection_id
+                    metadata.path = collection_id
+                    catalogue[collection_id] = metadata
+
+            self.catalogue = catalogue
+            self.merged_from = catalogues
+            return catalogue
+
+    def get_dataset_type(self, collection_id):
+        namespace, dataset_id = split_id(collection_id)
+        member = self.members.get(namespace)
+        return None if member is None else member.get_dataset_type(dataset_id)
+
+    def set_dataset_type(self, collection_id, dataset_type):
+        namespace, dataset_id = split_id(collection_id)
+        self.members[namespace].set_dataset_type(dataset_id, dataset_type)
+
+    def get_erddap_datasets(self) -> list[str]:
+        return list(self.get_catalogue().keys())
+
+    def create_erddap_collection(self, collection_id) -> Collection:
+        collection = Collection()
+        collection.metadata = self.get_catalogue().get(collection_id)
+        if collection.metadata is None:
+            collection.metadata = CollectionMetadata(collection_id, collection_id, None)
+        return collection
+
+    def get_erddap_as_collections(self):
+        return [self.create_erddap_collection(collection_id) for collection_id in self.get_catalogue()]
+
+
+class FederatedData:
+    """Downloads a namespaced collection from its own server."""
+
+    def __init__(self, members: dict[str, ERDDAPData]):
+        self.members = members
+
+    def member(self, collection_id) -> tuple[ERDDAPData, str]:
+        namespace, dataset_id = split_id(collection_id)
+        if namespace not in self.members:
+            raise KeyError(collection_id)
+        return self.members[namespace], dataset_id
+
+    def detect_dataset_type(self, collection_id):
+        member, dataset_id = self.member(collection_id)
+        return member.detect_dataset_type(dataset_id)
+
+    def get_erddap_as_collection(self, collection_id, collection, dataset_type=None, extra_variables=(),
+                                 constraints=()):
+        member, dataset_id = self.member(collection_id)
+        return member.get_erddap_as_collection(dataset_id, collection, dataset_type, extra_variables, constraints)
+
+    def get_erddap_columns(self, collection_id, dataset_type, variables: list[str], times=None):
+        member, dataset_id = self.member(collection_id)
+        return member.get_erddap_columns(dataset_id, dataset_type, variables, times)
+
+
+class FederatedCollections(ERDDAPCollections):
+    """ERDDAPCollections over several servers, erddap_server is the url of each by namespace."""
+
+    def _create_sources(self, erddap_server: dict[str, str]):
+        meta, data = {}, {}
+        for namespace, url in erddap_server.items():
+            proxy = LazyErddapProxy(url)
+            meta[namespace] = ERDDAPMetadata(url, proxy)
+            data[namespace] = ERDDAPData(url, proxy)
+        return FederatedMetadata(meta), FederatedData(data)
@@ -0,0 +1,186 @@
+"""Newly surfaced features pushed to clients as Server-Sent Events.
+
+Every subscriber to a collection shares one poller thread, which asks ERDDAP
+for the rows newer than the last one it saw every LIVE_POLL_INTERVAL seconds.
+New rows are converted and encoded once, then the same event is handed to
+each subscriber's queue on its event loop. The poller stops when the last
+subscriber leaves. A subscriber too slow to keep up with LIVE_QUEUE_SIZE
+events is disconnected rather than buffered without limit.
+"""
+import asyncio
+import io
+import logging
+import os
+import threading
+import time
+
+from ogc_api import metrics
+from ogc_api.cql2 import to_datetime
+from ogc_api.data_structures import Collection
+from erddap_proxy import upstream
+from erddap_proxy.erddap_matadata import ERDDAPCollections
+
+LIVE_POLL_INTERVAL = float(os.environ.get("LIVE_POLL_INTERVAL", "60"))
+LIVE_QUEUE_SIZE = int(os.environ.get("LIVE_QUEUE_SIZE", "16"))
+# seconds between keep-alive comments on a quiet stream, so proxies don't close it
+LIVE_HEARTBEAT = float(os.environ.get("LIVE_HEARTBEAT", "15"))
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    def __init__(self, dataset_id: str, loop: asyncio.AbstractEventLoop, queue_size: int = LIVE_QUEUE_SIZE):
+        self.dataset_id = dataset_id
+        self.loop = loop
+        # encoded events, None once the subscriber has been dropped
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = False
+        # unsubscribed, possibly before it was added to its poller
+        self.closed = False
+
+    def deliver(self, event):
+        """Queues event from any thread."""
+        self.loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        if self.dropped:
+            return
+        if self.queue.full():
+            # fell behind, end its stream instead of holding every event for it
+            self.dropped = True
+            self.queue.get_nowait()
+            self.queue.put_nowait(None)
+            return
+        self.queue.put_nowait(event)
+
+
+class Poller:
+    """Polls one dataset for new rows while it has subscribers."""
+
+    def __init__(self, erddap_collections: ERDDAPCollections, dataset_id: str, interval: float, last_time: float):
+        self.erddap_collections = erddap_collections
+        self.dataset_id = dataset_id
+        self.interval = interval
+        self.subscriptions = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        # only rows after it are sent
+        self.last_time = last_time
+        self.thread = threading.Thread(target=self.run, name=f"live-{dataset_id}", daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as err:
+                # tried again next interval
+                logger.warning("Polling %s for new rows failed: %s", self.dataset_id, err)
+
+    def poll(self) -> int:
+        """Sends the rows newer than the last poll to every subscriber, returns how many there were."""
+        dataset_type = self.erddap_collections.get_dataset_type(self.dataset_id)
+        with upstream.background():
+            coll = self.erddap_collections.data.get_erddap_as_collection(
+                self.dataset_id, Collection(), dataset_type, constraints=[("time>", to_datetime(self.last_time))])
+
+        count = len(coll.feature)
+        if count == 0:
+            return 0
+
+        self.last_time = float(coll.columns["time"].max())
+        event = encode_event(coll)
+        metrics.LIVE_EVENTS.inc(collection=self.dataset_id)
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            subscription.deliver(event)
+        return count
+
+
+class LiveTail:
+    def __init__(self, erddap_collections: ERDDAPCollections, interval: float = LIVE_POLL_INTERVAL):
+        self.erddap_collections = erddap_collections
+        self.interval = interval
+        self.pollers = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, dataset_id: str, loop: asyncio.AbstractEventLoop) -> Subscription:
+        subscription = Subscription(dataset_id, loop)
+        self.add(subscription)
+        return subscription
+
+    def add(self, subscription: Subscription):
+        """Hands the subscription to its dataset's poller, started if it has none."""
+        dataset_id = subscription.dataset_id
+        last_time = None
+        while True:
+            with self.lock:
+                if subscription.closed:
+                    return
+                poller = self.pollers.get(dataset_id)
+                if poller is None and last_time is not None:
+                    poller = Poller(self.erddap_collections, dataset_id, self.interval, last_time)
+                    self.pollers[dataset_id] = poller
+                    poller.thread.start()
+                if poller is not None:
+                    with poller.lock:
+                        poller.subscriptions.add(subscription)
+                        metrics.LIVE_SUBSCRIBERS.set(len(poller.subscriptions), collection=dataset_id)
+                    return
+            # looked up without the lock, the catalogue can wait on ERDDAP and unsubscribing takes the lock
+            last_time = initial_time(self.erddap_collections, dataset_id)
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            subscription.closed = True
+            poller = self.pollers.get(subscription.dataset_id)
+            if poller is None:
+                return
+            with poller.lock:
+                poller.subscriptions.discard(subscription)
+                remaining = len(poller.subscriptions)
+            metrics.LIVE_SUBSCRIBERS.set(remaining, collection=subscription.dataset_id)
+            if remaining == 0:
+                poller.stopped.set()
+                del self.pollers[subscription.dataset_id]
+
+    async def stream(self, dataset_id: str, heartbeat: float = LIVE_HEARTBEAT):
+        """The event stream of one subscriber, it unsubscribes when the client goes away."""
+        subscription = Subscription(dataset_id, asyncio.get_running_loop())
+        try:
+            # a new poller may look the dataset up in the catalogue, which can wait on ERDDAP, so not on the event loop
+            await asyncio.to_thread(self.add, subscription)
+            # a comment so the client knows the stream is open before the first surfacing
+            yield ": subscribed\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if event is None:
+                    break
+                yield event
+        finally:
+            self.unsubscribe(subscription)
+
+
+def initial_time(erddap_collections: ERDDAPCollections, dataset_id: str) -> float:
+    """The time of the newest row known."""
+    coll = erddap_collections.cache.get(dataset_id)
+    if coll is not None and len(coll.feature) > 0 and "time" in coll.columns:
+        return float(coll.columns["time"].max())
+
+    metadata = erddap_collections.meta.get_catalogue().get(dataset_id)
+    if metadata is not None and metadata.interval is not None and metadata.interval[1] is not None:
+        return metadata.interval[1].timestamp()
+    return time.time()
+
+
+def encode_event(coll: Collection) -> str:
+    """A features event with the new features as a FeatureCollection, its id is the last feature's."""
+    data = io.BytesIO()
+    data.write(b'{"type":"FeatureCollection","features":[')
+    coll.write_features(data, range(len(coll.feature)))
+    data.write(b']}')
+    return f"id: {coll.id[-1]}\nevent: features\ndata: {data.getvalue().decode('utf8')}\n\n"
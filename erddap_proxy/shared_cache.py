@@ -0,0 +1,182 @@
+"""Converted collections shared between worker processes through snapshot files.
+
+The first process needing a dataset takes a file lock, downloads and converts it
+and writes a snapshot; the others wait on the lock and then map the snapshot.
+The feature arena is read straight from the memory mapped file, so every worker
+shares the same pages instead of holding its own copy. Put the directory on a
+tmpfs such as /dev/shm to keep the snapshots in memory.
+"""
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import s2sphere
+
+from ogc_api import geometry
+from ogc_api.data_structures import Collection, FeatureArena, make_column
+
+SHARED_CACHE_DIR = os.environ.get("SHARED_CACHE_DIR")
+# snapshots left by an earlier run are downloaded again once older than this
+SHARED_CACHE_MAX_AGE = float(os.environ.get("SHARED_CACHE_MAX_AGE", "86400"))
+
+MAGIC = b"E2WSNAP3"
+HEADER = struct.Struct("<8sQ")
+
+logger = logging.getLogger(__name__)
+
+
+class MappedBounds:
+    """Read only sequence of feature bounds, stored as radians lat lo/hi and lng lo/hi."""
+
+    def __init__(self, values: memoryview):
+        self.values = values
+
+    def __len__(self):
+        return len(self.values) // 4
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        lat_lo, lat_hi, lng_lo, lng_hi = self.values[4 * i:4 * i + 4]
+        return s2sphere.LatLngRect(s2sphere.LineInterval(lat_lo, lat_hi), s2sphere.SphereInterval(lng_lo, lng_hi))
+
+
+class MappedPoints:
+    """Read only sequence of projected feature centers."""
+
+    def __init__(self, values: memoryview):
+        self.values = values
+
+    def __len__(self):
+        return len(self.values) // 2
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        from Geometry import Point
+        return Point(self.values[2 * i], self.values[2 * i + 1])
+
+
+class SnapshotStore:
+    def __init__(self, directory: str, max_age: float = SHARED_CACHE_MAX_AGE):
+        self.directory = directory
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    def snapshot_path(self, dataset_id: str) -> str:
+        return os.path.join(self.directory, safe_name(dataset_id) + ".snap")
+
+    @contextmanager
+    def fetch_lock(self, dataset_id: str):
+        """Held by the one process fetching a dataset, across all processes using the directory."""
+        with open(os.path.join(self.directory, safe_name(dataset_id) + ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def save(self, dataset_id: str, collection: Collection):
+        count = len(collection.feature)
+        # the arena is written as it is, features loaded from a local file are put in one first
+        features = FeatureArena.concatenate([collection.feature])
+
+        bounds = geometry.bounds_array(collection.bbox)
+        points = geometry.points_array(collection.web_mercator)
+
+        # numeric columns are mapped like the rest, anything else is rare enough to live in the header
+        numeric_columns = {name: column for name, column in collection.columns.items()
+                           if column.dtype.kind in "fi"}
+        object_columns = {name: column.tolist() for name, column in collection.columns.items()
+                          if name not in numeric_columns}
+
+        created = collection.fetched_at if collection.fetched_at is not None else time.time()
+        header = json.dumps(dict(dataset_id=dataset_id, count=count, ids=collection.id, created=created,
+                                 columns=[[name, column.dtype.kind] for name, column in numeric_columns.items()],
+                                 object_columns=object_columns)).encode("utf8")
+
+        path = self.snapshot_path(dataset_id)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(HEADER.pack(MAGIC, len(header)))
+            file.write(header)
+            file.write(b"\0" * (-(HEADER.size + len(header)) % 8))
+            # fixed width sections first so they stay 8 byte aligned for memoryview casts
+            file.write(features.offsets.astype("<i8").tobytes())
+            file.write(bounds.astype("<f8").tobytes())
+            file.write(points.astype("<f8").tobytes())
+            for column in numeric_columns.values():
+                file.write(column.astype("<f8" if column.dtype.kind == "f" else "<i8").tobytes())
+            file.write(features.buffer[:features.nbytes])
+
+        # readers either map the old file or the complete new one
+        os.replace(tmp_path, path)
+
+    def load(self, dataset_id: str, collection: Collection, newer_than: float = None):
+        """Fills collection from the snapshot, None when there is no usable one.
+
+        newer_than skips a snapshot of data fetched at or before that time, to refresh a collection.
+        """
+        path = self.snapshot_path(dataset_id)
+        try:
+            with open(path, "rb") as file:
+                if os.fstat(file.fileno()).st_size < HEADER.size:
+                    return None
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+
+        magic, header_len = HEADER.unpack_from(mapped, 0)
+        if magic != MAGIC:
+            logger.warning("Ignoring %s, not a snapshot", path)
+            return None
+
+        header = json.loads(mapped[HEADER.size:HEADER.size + header_len])
+        if time.time() - header["created"] > self.max_age:
+            return None
+        if newer_than is not None and header["created"] <= newer_than:
+            return None
+
+        count = header["count"]
+        view = memoryview(mapped)
+        position = HEADER.size + header_len
+        position += -position % 8
+
+        offsets = np.frombuffer(mapped, dtype="<i8", count=count + 1, offset=position)
+        position += 8 * (count + 1)
+        bounds = view[position:position + 32 * count].cast("d")
+        position += 32 * count
+        points = view[position:position + 16 * count].cast("d")
+        position += 16 * count
+
+        columns = {}
+        for name, kind in header["columns"]:
+            columns[name] = np.frombuffer(mapped, dtype="<f8" if kind == "f" else "<i8", count=count,
+                                          offset=position)
+            position += 8 * count
+        for name, values in header["object_columns"].items():
+            columns[name] = make_column(values)
+
+        collection.feature = FeatureArena(view[position:position + int(offsets[-1])], offsets)
+        collection.bbox = MappedBounds(bounds)
+        collection.web_mercator = MappedPoints(points)
+        collection.id = header["ids"]
+        collection.by_id = {feature_id: i for i, feature_id in enumerate(collection.id)}
+        collection.columns = columns
+        collection.fetched_at = header["created"]
+        return collection
+
+
+def safe_name(dataset_id: str) -> str:
+    # ERDDAP ids and federation namespaces are letters, digits and _, so namespace:id can't collide with another
+    return "".join(c if c.isalnum() or c in "-_." else "-" if c == ":" else "_" for c in dataset_id)
@@ -0,0 +1,176 @@
+"""Bounded access to ERDDAP: per host concurrency, priorities, backpressure and retries.
+
+Every request to ERDDAP goes through Upstream.get. Each host gets a few
+concurrent requests, the rest wait in a priority queue where interactive
+requests go before background ones (cache warming and refreshes). When the
+queue is full, or a request waits too long, UpstreamBusy is raised so the
+user gets a 503 with Retry-After rather than a request that times out.
+Connection errors, timeouts and 5xx answers are retried with backoff.
+"""
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import requests
+
+from ogc_api import metrics
+
+UPSTREAM_CONCURRENCY = int(os.environ.get("UPSTREAM_CONCURRENCY", "4"))
+UPSTREAM_QUEUE_DEPTH = int(os.environ.get("UPSTREAM_QUEUE_DEPTH", "32"))
+# seconds a request waits for its turn before giving up with a 503
+UPSTREAM_QUEUE_TIMEOUT = float(os.environ.get("UPSTREAM_QUEUE_TIMEOUT", "30"))
+UPSTREAM_RETRIES = int(os.environ.get("UPSTREAM_RETRIES", "2"))
+# seconds before the first retry, doubled for each one after
+UPSTREAM_BACKOFF = float(os.environ.get("UPSTREAM_BACKOFF", "0.5"))
+MAX_BACKOFF = 30.0
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# the priority of requests made from the current context, set by background jobs
+_priority = contextvars.ContextVar("upstream_priority", default=INTERACTIVE)
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamBusy(requests.RequestException):
+    """ERDDAP has more queued requests than it can serve soon, try again after retry_after seconds."""
+
+    def __init__(self, host: str, retry_after: float):
+        super().__init__(f"Too many requests queued for {host}")
+        self.host = host
+        self.retry_after = retry_after
+
+
+@contextmanager
+def background():
+    """Requests made inside wait behind the interactive ones."""
+    token = _priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class HostLimiter:
+    """Lets concurrency requests through at once, the others wait in priority then arrival order."""
+
+    def __init__(self, host: str, concurrency: int, queue_depth: int):
+        self.host = host
+        self.concurrency = concurrency
+        self.queue_depth = queue_depth
+        self.active = 0
+        self.waiting = []
+        self.order = itertools.count()
+        self.changed = threading.Condition()
+        # moving average of how long a request holds its slot, to estimate Retry-After
+        self.average_seconds = 1.0
+
+    def acquire(self, priority: int, timeout: float):
+        with self.changed:
+            if self.active < self.concurrency and len(self.waiting) == 0:
+                self.active += 1
+                return
+
+            if len(self.waiting) >= self.queue_depth:
+                metrics.UPSTREAM_REJECTED.inc(host=self.host)
+                raise UpstreamBusy(self.host, self.retry_after())
+
+            entry = (priority, next(self.order))
+            heapq.heappush(self.waiting, entry)
+            metrics.UPSTREAM_QUEUED.set(len(self.waiting), host=self.host)
+
+            deadline = time.monotonic() + timeout
+            while not (self.active < self.concurrency and self.waiting[0] == entry):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.waiting.remove(entry)
+                    heapq.heapify(self.waiting)
+                    metrics.UPSTREAM_QUEUED.set(len(self.waiting), host=self.host)
+                    metrics.UPSTREAM_REJECTED.inc(host=self.host)
+                    # the next in line may be able to go now
+                    self.changed.notify_all()
+                    raise UpstreamBusy(self.host, self.retry_after())
+                self.changed.wait(remaining)
+
+            heapq.heappop(self.waiting)
+            metrics.UPSTREAM_QUEUED.set(len(self.waiting), host=self.host)
+            self.active += 1
+            self.changed.notify_all()
+
+    def release(self, seconds: float):
+        with self.changed:
+            self.active -= 1
+            self.average_seconds = 0.8 * self.average_seconds + 0.2 * seconds
+            self.changed.notify_all()
+
+    def retry_after(self) -> int:
+        # roughly when the requests ahead will be done
+        return max(1, round(self.average_seconds * (len(self.waiting) + 1) / max(self.concurrency, 1)))
+
+
+class Upstream:
+    def __init__(self, concurrency: int = UPSTREAM_CONCURRENCY, queue_depth: int = UPSTREAM_QUEUE_DEPTH,
+                 queue_timeout: float = UPSTREAM_QUEUE_TIMEOUT, retries: int = UPSTREAM_RETRIES,
+                 backoff: float = UPSTREAM_BACKOFF):
+        self.concurrency = concurrency
+        self.queue_depth = queue_depth
+        self.queue_timeout = queue_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def get_limiter(self, host: str) -> HostLimiter:
+        with self.lock:
+            if host not in self.limiters:
+                self.limiters[host] = HostLimiter(host, self.concurrency, self.queue_depth)
+            return self.limiters[host]
+
+    def get(self, url: str, timeout: float) -> requests.Response:
+        host = urlparse(url).netloc
+        limiter = self.get_limiter(host)
+        priority = _priority.get()
+
+        attempt = 0
+        while True:
+            limiter.acquire(priority, self.queue_timeout)
+            start = time.perf_counter()
+            try:
+                res = requests.get(url, timeout=timeout)
+                error = None
+            except (requests.ConnectionError, requests.Timeout) as err:
+                res = None
+                error = err
+            finally:
+                limiter.release(time.perf_counter() - start)
+
+            retryable = error is not None or res.status_code in (429, 502, 503, 504)
+            if not retryable or attempt >= self.retries:
+                if error is not None:
+                    raise error
+                return res
+
+            # the slot is given back while waiting so others aren't held up by a failing request
+            delay = self.retry_delay(attempt, res)
+            attempt += 1
+            metrics.UPSTREAM_RETRIES.inc(host=host)
+            logger.info("Retrying %s in %.1f s, attempt %d: %s", url, delay, attempt,
+                        error if error is not None else res.status_code)
+            time.sleep(delay)
+
+    def retry_delay(self, attempt: int, res) -> float:
+        if res is not None and res.headers.get("Retry-After", "").isdigit():
+            return min(float(res.headers["Retry-After"]), MAX_BACKOFF)
+        # full jitter, so retries from a burst don't arrive together
+        return random.uniform(0, min(self.backoff * 2 ** attempt, MAX_BACKOFF))
+
+
+UPSTREAM = Upstream()
@@ -0,0 +1,619 @@
+"""CQL2 filters (OGC API - Features - Part 3) for collections held as columns.
+
+A filter, in CQL2 text or JSON, is parsed once per request into an expression
+tree. The tree is evaluated as a numpy boolean mask over the collection columns,
+and the parts of it that ERDDAP can apply itself are turned into ERDDAP
+constraints for when the data still has to be downloaded.
+
+Supported: and, or, not, =, <>, <, <=, >, >=, between, in, is null, like,
+s_intersects with a bbox, and t_after, t_before, t_intersects, t_during with
+timestamps, dates and intervals.
+"""
+import json
+import math
+import re
+from datetime import datetime, timezone
+
+import numpy as np
+
+from ogc_api.geometry import bbox_mask
+
+COMPARISONS = {"=": "=", "<>": "!=", "<": "<", "<=": "<=", ">": ">", ">=": ">="}
+FLIPPED = {"=": "=", "<>": "<>", "<": ">", "<=": ">=", ">": "<", ">=": "<="}
+TEMPORAL = ("t_after", "t_before", "t_intersects", "t_during")
+
+
+class FilterError(ValueError):
+    pass
+
+
+class Property:
+    def __init__(self, name: str):
+        self.name = name
+
+
+class Timestamp:
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+
+class Interval:
+    def __init__(self, start, end):
+        # None is an open end
+        self.start = start
+        self.end = end
+
+
+class BBox:
+    def __init__(self, edges: list):
+        if len(edges) == 6:
+            edges = [edges[0], edges[1], edges[3], edges[4]]
+        if len(edges) != 4:
+            raise FilterError("A bbox needs 4 or 6 numbers")
+        self.min_lon, self.min_lat, self.max_lon, self.max_lat = [float(edge) for edge in edges]
+
+
+class Expression:
+    def mask(self, columns: dict, count: int) -> np.ndarray:
+        raise NotImplementedError
+
+    def constraints(self) -> list[tuple[str, object]]:
+        """ERDDAP constraints selecting a superset of the matches, empty if none can be pushed down."""
+        return []
+
+    def properties(self) -> set[str]:
+        return set()
+
+
+class And(Expression):
+    def __init__(self, args: list):
+        self.args = args
+
+    def mask(self, columns, count):
+        result = np.ones(count, dtype=bool)
+        for arg in self.args:
+            result &= arg.mask(columns, count)
+        return result
+
+    def constraints(self):
+        # each side of an and narrows the result on its own, so every pushable part can go
+        return [constraint for arg in self.args for constraint in arg.constraints()]
+
+    def properties(self):
+        return set().union(*[arg.properties() for arg in self.args])
+
+
+class Or(Expression):
+    def __init__(self, args: list):
+        self.args = args
+
+    def mask(self, columns, count):
+        result = np.zeros(count, dtype=bool)
+        for arg in self.args:
+            result |= arg.mask(columns, count)
+        return result
+
+    def properties(self):
+        return set().union(*[arg.properties() for arg in self.args])
+
+
+class Not(Expression):
+    def __init__(self, arg: Expression):
+        self.arg = arg
+
+    def mask(self, columns, count):
+        return ~self.arg.mask(columns, count)
+
+    def properties(self):
+        return self.arg.properties()
+
+
+class Comparison(Expression):
+    def __init__(self, op: str, name: str, value):
+        self.op = op
+        self.name = name
+        self.value = value
+
+    def mask(self, columns, count):
+        column, value = column_and_value(columns, self.name, self.value)
+        if value is None:
+            return np.zeros(count, dtype=bool)
+
+        with np.errstate(invalid="ignore"):
+            if self.op == "=":
+                return np.asarray(column == value, dtype=bool)
+            if self.op == "<>":
+                return np.asarray(column != value, dtype=bool) & ~null_mask(column)
+            if self.op == "<":
+                return np.asarray(column < value, dtype=bool)
+            if self.op == "<=":
+                return np.asarray(column <= value, dtype=bool)
+            if self.op == ">":
+                return np.asarray(column > value, dtype=bool)
+            return np.asarray(column >= value, dtype=bool)
+
+    def constraints(self):
+        value = erddap_value(self.name, self.value)
+        if value is None:
+            return []
+        return [(self.name + COMPARISONS[self.op], value)]
+
+    def properties(self):
+        return {self.name}
+
+
+class Between(Expression):
+    def __init__(self, name: str, low, high):
+        self.low = Comparison(">=", name, low)
+        self.high = Comparison("<=", name, high)
+
+    def mask(self, columns, count):
+        return self.low.mask(columns, count) & self.high.mask(columns, count)
+
+    def constraints(self):
+        return self.low.constraints() + self.high.constraints()
+
+    def properties(self):
+        return self.low.properties()
+
+
+class In(Expression):
+    def __init__(self, name: str, values: list):
+        self.name = name
+        self.values = values
+
+    def mask(self, columns, count):
+        result = np.zeros(count, dtype=bool)
+        for value in self.values:
+            result |= Comparison("=", self.name, value).mask(columns, count)
+        return result
+
+    def constraints(self):
+        if len(self.values) == 1:
+            return Comparison("=", self.name, self.values[0]).constraints()
+        return []
+
+    def properties(self):
+        return {self.name}
+
+
+class IsNull(Expression):
+    def __init__(self, name: str):
+        self.name = name
+
+    def mask(self, columns, count):
+        return null_mask(get_column(columns, self.name))
+
+    def properties(self):
+        return {self.name}
+
+
+class Like(Expression):
+    def __init__(self, name: str, pattern: str):
+        self.name = name
+        # % and _ are the CQL2 wildcards, anything else is literal
+        self.regex = "".join(".*" if c == "%" else "." if c == "_" else re.escape(c) for c in pattern)
+        self.compiled = re.compile(self.regex, re.DOTALL)
+
+    def mask(self, columns, count):
+        column = get_column(columns, self.name)
+        return np.fromiter((value is not None and self.compiled.fullmatch(str(value)) is not None
+                            for value in column), dtype=bool, count=count)
+
+    def constraints(self):
+        return [(self.name + "=~", self.regex)]
+
+    def properties(self):
+        return {self.name}
+
+
+class BBoxIntersects(Expression):
+    def __init__(self, bbox: BBox):
+        self.bbox = bbox
+
+    def mask(self, columns, count):
+        lat = get_column(columns, "latitude")
+        lon = get_column(columns, "longitude")
+        return bbox_mask(lat, lon, self.bbox.min_lat, self.bbox.min_lon, self.bbox.max_lat, self.bbox.max_lon)
+
+    def constraints(self):
+        constraints = [("latitude>=", self.bbox.min_lat), ("latitude<=", self.bbox.max_lat)]
+        if self.bbox.min_lon <= self.bbox.max_lon:
+            # across the antimeridian it would take two queries, leave longitude to the mask
+            constraints += [("longitude>=", self.bbox.min_lon), ("longitude<=", self.bbox.max_lon)]
+        return constraints
+
+    def properties(self):
+        return {"latitude", "longitude"}
+
+
+class TimeRange(Expression):
+    """start <= time <= end, either end can be open, exclusive ends are for t_after and t_before."""
+
+    def __init__(self, start=None, end=None, include_start=True, include_end=True):
+        self.start = start
+        self.end = end
+        self.include_start = include_start
+        self.include_end = include_end
+
+    def mask(self, columns, count):
+        time = get_column(columns, "time")
+        result = np.ones(count, dtype=bool)
+        with np.errstate(invalid="ignore"):
+            if self.start is not None:
+                result &= time >= self.start if self.include_start else time > self.start
+            if self.end is not None:
+                result &= time <= self.end if self.include_end else time < self.end
+        return result
+
+    def constraints(self):
+        constraints = []
+        if self.start is not None:
+            constraints.append(("time>=" if self.include_start else "time>", to_datetime(self.start)))
+        if self.end is not None:
+            constraints.append(("time<=" if self.include_end else "time<", to_datetime(self.end)))
+        return constraints
+
+    def properties(self):
+        return {"time"}
+
+
+def parse(text: str, lang: str = "") -> Expression:
+    """Parses a filter, lang is cql2-text or cql2-json, guessed from the text when empty."""
+    lang = lang.strip().lower()
+    if lang == "":
+        lang = "cql2-json" if text.lstrip().startswith("{") else "cql2-text"
+
+    if lang == "cql2-json":
+        try:
+            return from_json(json.loads(text))
+        except (ValueError, TypeError, KeyError, IndexError) as err:
+            raise FilterError(f"Malformed cql2-json filter: {err}") from err
+    if lang == "cql2-text":
+        return TextParser(text).parse()
+
+    raise FilterError(f"Unsupported filter-lang {lang}")
+
+
+def combine(expressions: list):
+    expressions = [expression for expression in expressions if expression is not None]
+    if len(expressions) == 0:
+        return None
+    if len(expressions) == 1:
+        return expressions[0]
+    return And(expressions)
+
+
+# region evaluation helpers
+
+def get_column(columns: dict, name: str) -> np.ndarray:
+    if name not in columns:
+        raise FilterError(f"Unknown property {name}")
+    return columns[name]
+
+
+def column_and_value(columns: dict, name: str, value):
+    column = get_column(columns, name)
+    if isinstance(value, Timestamp):
+        value = value.seconds
+    elif name == "time" and isinstance(value, str):
+        value = parse_time(value)
+
+    if column.dtype == object:
+        # comparing mixed python objects, None is treated like a SQL null
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            column = np.array([np.nan if v is None else float(v) if isinstance(v, (int, float)) else np.nan
+                               for v in column], dtype=np.float64)
+        else:
+            column = np.array(["" if v is None else str(v) for v in column], dtype=object)
+            value = str(value)
+    elif isinstance(value, str):
+        raise FilterError(f"{name} is a number, it can't be compared with '{value}'")
+
+    return column, value
+
+
+def null_mask(column: np.ndarray) -> np.ndarray:
+    if column.dtype.kind == "f":
+        return np.isnan(column)
+    if column.dtype == object:
+        return np.array([v is None for v in column], dtype=bool)
+    return np.zeros(len(column), dtype=bool)
+
+
+def erddap_value(name: str, value):
+    if isinstance(value, Timestamp):
+        return to_datetime(value.seconds)
+    if name == "time" and isinstance(value, str):
+        return to_datetime(parse_time(value))
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def parse_time(value: str) -> float:
+    value = value.strip()
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError as err:
+        raise FilterError(f"Malformed time {value}") from err
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def to_datetime(seconds: float) -> datetime:
+    return datetime.fromtimestamp(seconds, tz=timezone.utc)
+
+# endregion
+
+
+# region cql2-json
+
+def from_json(node) -> Expression:
+    op = node["op"].lower()
+    args = node.get("args", [])
+
+    if op in ("and", "or"):
+        children = [from_json(arg) for arg in args]
+        return And(children) if op == "and" else Or(children)
+    if op == "not":
+        return Not(from_json(args[0]))
+    if op in COMPARISONS:
+        return comparison(op, json_operand(args[0]), json_operand(args[1]))
+    if op == "between":
+        return Between(property_name(json_operand(args[0])), json_operand(args[1]), json_operand(args[2]))
+    if op == "in":
+        return In(property_name(json_operand(args[0])), [json_operand(arg) for arg in args[1]])
+    if op == "isnull":
+        return IsNull(property_name(json_operand(args[0])))
+    if op == "like":
+        return Like(property_name(json_operand(args[0])), json_operand(args[1]))
+    if op == "s_intersects":
+        return spatial(json_operand(args[0]), json_operand(args[1]))
+    if op in TEMPORAL:
+        return temporal(op, json_operand(args[0]), json_operand(args[1]))
+
+    raise FilterError(f"Unsupported operator {op}")
+
+
+def json_operand(node):
+    if isinstance(node, dict):
+        if "property" in node:
+            return Property(node["property"])
+        if "timestamp" in node:
+            return Timestamp(parse_time(node["timestamp"]))
+        if "date" in node:
+            return Timestamp(parse_time(node["date"]))
+        if "interval" in node:
+            return interval(*[json_instant(value) for value in node["interval"]])
+        if "bbox" in node:
+            return BBox(node["bbox"])
+        if "op" in node:
+            raise FilterError(f"Nested {node['op']} is not supported as an operand")
+    return node
+
+
+def json_instant(value):
+    if isinstance(value, dict):
+        value = value.get("timestamp", value.get("date"))
+    return value
+
+# endregion
+
+
+# region cql2-text
+
+TOKEN = re.compile(r"""
+    \s*(?:
+        (?P<number>-?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+      | '(?P<string>(?:[^']|'')*)'
+      | "(?P<quoted>[^"]+)"
+      | (?P<op><>|<=|>=|=|<|>|\(|\)|,)
+      | (?P<word>[A-Za-z_][A-Za-z0-9_:.]*)
+    )""", re.VERBOSE)
+
+
+class TextParser:
+    def __init__(self, text: str):
+        self.tokens = []
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            match = TOKEN.match(text, position)
+            if match is None or match.end() == position:
+                raise FilterError(f"Unexpected character at {position} in filter")
+            kind = match.lastgroup
+            value = match.group(kind)
+            if kind == "string":
+                value = value.replace("''", "'")
+            elif kind == "number":
+                value = float(value) if any(c in value for c in ".eE") else int(value)
+            self.tokens.append((kind, value))
+            position = match.end()
+        self.position = 0
+
+    def parse(self) -> Expression:
+        expression = self.parse_or()
+        if self.position != len(self.tokens):
+            raise FilterError(f"Unexpected {self.tokens[self.position][1]} in filter")
+        return expression
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise FilterError("Filter ended early")
+        self.position += 1
+        return token
+
+    def keyword(self, *words) -> bool:
+        kind, value = self.peek()
+        if kind == "word" and value.upper() in words:
+            self.position += 1
+            return True
+        return False
+
+    def expect(self, op: str):
+        kind, value = self.next()
+        if kind != "op" or value != op:
+            raise FilterError(f"Expected {op} in filter, got {value}")
+
+    def parse_or(self):
+        args = [self.parse_and()]
+        while self.keyword("OR"):
+            args.append(self.parse_and())
+        return args[0] if len(args) == 1 else Or(args)
+
+    def parse_and(self):
+        args = [self.parse_not()]
+        while self.keyword("AND"):
+            args.append(self.parse_not())
+        return args[0] if len(args) == 1 else And(args)
+
+    def parse_not(self):
+        if self.keyword("NOT"):
+            return Not(self.parse_not())
+        return self.parse_predicate()
+
+    def parse_predicate(self):
+        kind, value = self.peek()
+        if kind == "op" and value == "(":
+            self.next()
+            expression = self.parse_or()
+            self.expect(")")
+            return expression
+
+        if kind == "word" and value.upper() == "S_INTERSECTS":
+            self.next()
+            left, right = self.parse_arguments(2)
+            return spatial(left, right)
+
+        if kind == "word" and value.lower() in TEMPORAL:
+            self.next()
+            left, right = self.parse_arguments(2)
+            return temporal(value.lower(), left, right)
+
+        left = self.parse_operand()
+
+        kind, value = self.peek()
+        if kind == "op" and value in COMPARISONS:
+            self.next()
+            return comparison(value, left, self.parse_operand())
+
+        negated = self.keyword("NOT")
+        if self.keyword("BETWEEN"):
+            low = self.parse_operand()
+            if not self.keyword("AND"):
+                raise FilterError("Expected AND in BETWEEN")
+            expression = Between(property_name(left), low, self.parse_operand())
+        elif self.keyword("IN"):
+            expression = In(property_name(left), self.parse_arguments())
+        elif self.keyword("LIKE"):
+            expression = Like(property_name(left), self.parse_operand())
+        elif not negated and self.keyword("IS"):
+            negated = self.keyword("NOT")
+            if not self.keyword("NULL"):
+                raise FilterError("Expected NULL after IS")
+            expression = IsNull(property_name(left))
+        else:
+            raise FilterError(f"Expected a predicate in filter, got {value}")
+
+        return Not(expression) if negated else expression
+
+    def parse_arguments(self, count: int = None) -> list:
+        self.expect("(")
+        args = [self.parse_operand()]
+        while self.peek() == ("op", ","):
+            self.next()
+            args.append(self.parse_operand())
+        self.expect(")")
+
+        if count is not None and len(args) != count:
+            raise FilterError(f"Expected {count} arguments, got {len(args)}")
+        return args
+
+    def parse_operand(self):
+        kind, value = self.next()
+        if kind in ("number", "string"):
+            return value
+        if kind == "quoted":
+            return Property(value)
+        if kind != "word":
+            raise FilterError(f"Unexpected {value} in filter")
+
+        word = value.upper()
+        if word in ("TRUE", "FALSE"):
+            return word == "TRUE"
+        if word in ("TIMESTAMP", "DATE"):
+            (instant,) = self.parse_arguments(1)
+            return Timestamp(parse_time(instant))
+        if word == "INTERVAL":
+            start, end = self.parse_arguments(2)
+            return interval(start, end)
+        if word == "BBOX":
+            return BBox(self.parse_arguments())
+
+        return Property(value)
+
+# endregion
+
+
+# region building expressions
+
+def comparison(op: str, left, right) -> Expression:
+    if not isinstance(left, Property) and isinstance(right, Property):
+        op = FLIPPED[op]
+        left, right = right, left
+    if not isinstance(left, Property) or isinstance(right, Property):
+        raise FilterError("Comparisons need one property and one value")
+    return Comparison(op, left.name, right)
+
+
+def property_name(operand) -> str:
+    if not isinstance(operand, Property):
+        raise FilterError("Expected a property")
+    return operand.name
+
+
+def spatial(left, right) -> Expression:
+    bbox = right if isinstance(right, BBox) else left
+    if not isinstance(bbox, BBox):
+        raise FilterError("S_INTERSECTS is only supported with a BBOX")
+    return BBoxIntersects(bbox)
+
+
+def interval(start, end) -> Interval:
+    return Interval(None if start in (None, "..", "") else time_of(start),
+                    None if end in (None, "..", "") else time_of(end))
+
+
+def time_of(value):
+    if isinstance(value, Timestamp):
+        return value.seconds
+    if isinstance(value, str):
+        return parse_time(value)
+    raise FilterError("Expected a time")
+
+
+def temporal(op: str, left, right) -> Expression:
+    value = right if not isinstance(right, Property) else left
+    if isinstance(value, Timestamp):
+        start = end = value.seconds
+    elif isinstance(value, Interval):
+        start, end = value.start, value.end
+    else:
+        raise FilterError(f"{op} needs a timestamp or an interval")
+
+    # datasets have a single time per feature, so every relation reduces to a range
+    if op == "t_after":
+        return TimeRange(start=end, include_start=False)
+    if op == "t_before":
+        return TimeRange(end=start, include_end=False)
+    return TimeRange(start, end)
+
+# endregion
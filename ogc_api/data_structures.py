@@ -1,3 +1,11 @@
+import copy
+import json
+import mmap
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
 from fastapi import HTTPException
 
 
@@ -5,11 +13,102 @@ class CollectionMetadata:
     name: str
     path: str
     last_modified: str
+    title: str
+    bbox: []
+    interval: []
 
-    def __init__(self, name, path, last_modified):
+    def __init__(self, name, path, last_modified, title=None, bbox=None, interval=None):
         self.name = name
         self.path = path
         self.last_modified = last_modified
+        self.title = title
+        self.bbox = bbox
+        self.interval = interval
+
+    def extent_to_json(self):
+        extent = {}
+
+        if self.bbox is not None:
+            extent["spatial"] = dict(bbox=[self.bbox], crs="http://www.opengis.net/def/crs/OGC/1.3/CRS84")
+
+        if self.interval is not None:
+            interval = [None if t is None else t.isoformat().replace("+00:00", "Z") for t in self.interval]
+            extent["temporal"] = dict(interval=[interval], trs="http://www.opengis.net/def/uom/ISO-8601/0/Gregorian")
+
+        return extent if len(extent) > 0 else None
+
+
+class FeatureArena:
+    """Read only sequence of encoded features stored one after the other in one buffer.
+
+    Each feature is followed by a comma, so a run of consecutive features is a
+    single slice of the buffer that is already a valid JSON list body, written
+    out without copying or encoding anything per feature. Feature i is
+    buffer[offsets[i]:offsets[i + 1] - 1].
+    """
+
+    def __init__(self, buffer, offsets):
+        self.buffer = memoryview(buffer)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_encoded(cls, encoded: list[bytes]):
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(feature) + 1 for feature in encoded], out=offsets[1:])
+        return cls(b"".join(feature + b"," for feature in encoded), offsets)
+
+    @classmethod
+    def concatenate(cls, parts: list):
+        """One arena with the features of every part in order, parts may also be lists of str."""
+        parts = [part if isinstance(part, FeatureArena) else
+                 cls.from_encoded([feature.encode("utf8") for feature in part]) for part in parts]
+        if len(parts) == 1:
+            return parts[0]
+        offsets = [np.zeros(1, dtype=np.int64)]
+        end = 0
+        for part in parts:
+            offsets.append(part.offsets[1:] + end)
+            end += part.nbytes
+        return cls(b"".join(part.buffer[:part.nbytes] for part in parts), np.concatenate(offsets))
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.offsets[-1])
+
+    @property
+    def mapped(self) -> bool:
+        """The buffer is a memory mapped snapshot, shared with other processes."""
+        return is_mapped(self.buffer)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return str(self.encoded(i), "utf8")
+
+    def encoded(self, i) -> bytes:
+        if i < 0:
+            i += len(self)
+        return bytes(self.run(i, i + 1))
+
+    def run(self, start: int, stop: int) -> memoryview:
+        """Features start to stop - 1 separated by commas, a view of the buffer."""
+        if not 0 <= start < stop <= len(self):
+            raise IndexError(start)
+        return self.buffer[int(self.offsets[start]):int(self.offsets[stop]) - 1]
+
+    def write(self, writer, indices):
+        """Writes the features at indices separated by commas, one slice per run of consecutive indices."""
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) == 0:
+            return
+        breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+        starts = indices[np.concatenate(([0], breaks))]
+        stops = indices[np.concatenate((breaks - 1, [len(indices) - 1]))] + 1
+        for num_runs, (start, stop) in enumerate(zip(starts, stops)):
+            if num_runs > 0:
+                writer.write(b",")
+            writer.write(self.run(int(start), int(stop)))
 
 
 class Collection:
@@ -20,6 +119,8 @@ class Collection:
     id: []
     by_id: {}
     feature: []
+    columns: {}
+    fetched_at: float
 
     def __init__(self):
         self.offset = []
@@ -28,6 +129,122 @@ class Collection:
         self.id = []
         self.by_id = {}
         self.feature = []
+        # one array per variable, in feature order, "time" holds seconds since 1970
+        self.columns = {}
+        # when the data was downloaded from ERDDAP, seconds since 1970
+        self.fetched_at = None
+
+    def age(self) -> float:
+        """Seconds since the data was downloaded, 0 when it wasn't."""
+        if self.fetched_at is None:
+            return 0.0
+        return max(time.time() - self.fetched_at, 0.0)
+
+    def with_columns(self, columns: dict):
+        """A copy of the collection with more columns, the collection itself is left as it is."""
+        collection = copy.copy(self)
+        collection.columns = dict(self.columns)
+        collection.columns.update(columns)
+        return collection
+
+    def encode_feature(self, i: int, properties: list[str]) -> str:
+        """The point feature at i with just the given properties, which must all be columns."""
+        feature_properties = {}
+        for name in properties:
+            feature_properties[name] = column_value(self.columns[name], i, name == "time")
+
+        feature = {
+            "type": "Feature",
+            "geometry": {
+                "type": "Point",
+                "coordinates": [column_value(self.columns["longitude"], i),
+                                column_value(self.columns["latitude"], i)]
+            },
+            "properties": feature_properties,
+            "id": self.id[i],
+        }
+        return json.dumps(feature, ensure_ascii=False, separators=(',', ':'), allow_nan=False)
+
+    def encoded_feature(self, i: int) -> bytes:
+        """The stored feature at i as UTF-8, ready to be written out."""
+        if isinstance(self.feature, list):
+            return self.feature[i].encode("utf8")
+        # arena features are already bytes, no need to decode them first
+        return self.feature.encoded(i)
+
+    def write_features(self, writer, indices):
+        """Writes the stored features at indices separated by commas."""
+        if isinstance(self.feature, FeatureArena):
+            self.feature.write(writer, indices)
+            return
+        for num_features, i in enumerate(indices):
+            if num_features > 0:
+                writer.write(b",")
+            writer.write(self.encoded_feature(i))
+
+    def resident_bytes(self) -> int:
+        """Rough size of the collection, the per feature bounds and points are sized from the first one.
+
+        Memory mapped features, bounds and points are shared with other processes and not counted.
+        """
+        size = sum(sys.getsizeof(i) for i in self.id) + sys.getsizeof(self.id) + sys.getsizeof(self.by_id)
+
+        if isinstance(self.feature, list):
+            size += sys.getsizeof(self.feature) + sum(sys.getsizeof(f) for f in self.feature)
+        elif isinstance(self.feature, FeatureArena) and not self.feature.mapped:
+            size += self.feature.buffer.nbytes + self.feature.offsets.nbytes
+        if isinstance(self.bbox, list) and len(self.bbox) > 0:
+            size += sys.getsizeof(self.bbox) + len(self.bbox) * deep_sizeof(self.bbox[0])
+        if isinstance(self.web_mercator, list) and len(self.web_mercator) > 0:
+            size += sys.getsizeof(self.web_mercator) + len(self.web_mercator) * deep_sizeof(self.web_mercator[0])
+        # bounds and points converted in a worker process are arrays this process owns
+        for values in (getattr(self.bbox, "values", None), getattr(self.web_mercator, "values", None)):
+            if values is not None and not is_mapped(values):
+                size += values.nbytes
+        for column in self.columns.values():
+            if column.flags.owndata:
+                size += column.nbytes
+                if column.dtype == object:
+                    size += sum(sys.getsizeof(value) for value in column)
+
+        return size
+
+
+def make_column(values: list) -> np.ndarray:
+    """Numbers become a float64 or int64 array with missing values as NaN, anything else an object array."""
+    if all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+        return np.array(values, dtype=np.int64)
+    if all(v is None or (isinstance(v, (int, float)) and not isinstance(v, bool)) for v in values):
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+
+def column_value(column: np.ndarray, i: int, is_time: bool = False):
+    """The JSON value of a column entry, times are formatted like ERDDAP does."""
+    value = column[i]
+    if column.dtype.kind == "f":
+        if np.isnan(value):
+            return None
+        if is_time:
+            return datetime.fromtimestamp(float(value), tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        return float(value)
+    if column.dtype.kind == "i":
+        return int(value)
+    return value
+
+
+def is_mapped(buffer: memoryview) -> bool:
+    return isinstance(buffer.obj, mmap.mmap)
+
+
+def deep_sizeof(obj, depth: int = 3) -> int:
+    size = sys.getsizeof(obj)
+    if depth > 0 and hasattr(obj, "__dict__"):
+        size += sum(deep_sizeof(value, depth - 1) for value in vars(obj).values())
+    return size
 
 
 class WFSLink:
@@ -40,18 +257,45 @@ class WFSLink:
         return dict(href=self.href, rel=self.rel, type=self.type, title=self.title)
 
 
+class ItemsQuery:
+    """What an items request selects besides the page and bbox, and the parameters its links repeat."""
+    properties: list
+    filter: object
+    link_params: list
+
+    hits: bool
+    thin_interval: float
+    thin_max: int
+
+    def __init__(self, properties: list = None, filter=None, link_params: list = None, hits: bool = False,
+                 thin_interval: float = None, thin_max: int = None):
+        self.properties = properties
+        # a compiled cql2 expression, the filter and datetime parameters combined
+        self.filter = filter
+        self.link_params = link_params or []
+        # resultType=hits, only count the matching features
+        self.hits = hits
+        # thin=, keep one feature per thin_interval seconds, or at most thin_max spread over time
+        self.thin_interval = thin_interval
+        self.thin_max = thin_max
+
+
 HTTP_RESPONSES = {
     "NOT_MODIFIED": HTTPException(status_code=304, detail="Not Modified"),
     "BAD_REQUEST": HTTPException(status_code=400, detail="Malformed parameters"),
     "NOT_FOUND": HTTPException(status_code=404, detail="Collection not found"),
     "INTERNAL_ERROR": HTTPException(status_code=500, detail="Internal server error occurred"),
+    "NOT_READY": HTTPException(status_code=503, detail="Warming up"),
+    "UPSTREAM_BUSY": HTTPException(status_code=503, detail="ERDDAP is busy"),
 }
 
 
 class APIResponse:
     content: object
     http_response: HTTPException
+    headers: dict
 
-    def __init__(self, content, http_response):
+    def __init__(self, content, http_response, headers=None):
         self.content = content
         self.http_response = http_response
+        self.headers = headers or {}
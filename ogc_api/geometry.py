@@ -1,8 +1,8 @@
 import math
 import sys
 
-import Geometry
 import geojson
+import numpy as np
 import s2sphere
 
 DBL_EPSILON = sys.float_info.epsilon
@@ -17,13 +17,14 @@ def compute_bounds(geometry: geojson.geometry.Geometry):
 
     elif isinstance(geometry, geojson.geometry.Point):
         if len(geometry['coordinates']) >= 2:
-            feature = feature.from_point(s2sphere.LatLng.from_degrees(geometry['coordinates'][1],
-                                                                      geometry['coordinates'][0]))
+            ret = feature.from_point(s2sphere.LatLng.from_degrees(geometry['coordinates'][1],
+                                                                  geometry['coordinates'][0]))
 
     elif isinstance(geometry, geojson.geometry.MultiPoint):
         for point in geometry['coordinates']:
             if len(point) >= 2:
-                feature = feature.from_point(s2sphere.LatLng.from_degrees(point[1], point[0]))
+                feature = feature.union(feature.from_point(s2sphere.LatLng.from_degrees(point[1], point[0])))
+        ret = feature
 
     elif isinstance(geometry, geojson.geometry.LineString):
         ret = compute_line_bounds(geometry['coordinates'])
@@ -31,6 +32,7 @@ def compute_bounds(geometry: geojson.geometry.Geometry):
     elif isinstance(geometry, geojson.geometry.MultiLineString):
         for line in geometry['coordinates']:
             feature = feature.union((compute_line_bounds(line)))
+        ret = feature
 
     elif isinstance(geometry, geojson.geometry.Polygon):
         for ring in geometry['coordinates']:
@@ -46,8 +48,9 @@ def compute_bounds(geometry: geojson.geometry.Geometry):
         ret = expand_for_sub_regions(feature)
 
     elif isinstance(geometry, geojson.geometry.GeometryCollection):
-        for geometry_object in geometry['Geometries']:
+        for geometry_object in geometry['geometries']:
             feature = feature.union(compute_bounds(geometry_object))
+        ret = feature
 
     return ret
 
@@ -56,7 +59,7 @@ def compute_line_bounds(line):
     rect = s2sphere.LatLngRect()
     for point in line:
         if len(point) >= 2:
-            rect = rect.from_point(s2sphere.LatLng.from_degrees(point[1], point[0]))
+            rect = rect.union(rect.from_point(s2sphere.LatLng.from_degrees(point[1], point[0])))
     return rect
 
 
@@ -82,7 +85,9 @@ def project_web_mercator(p: s2sphere.LatLng):
     x = 256 * (0.5 + p.lng().degrees / 360)
     y = 256 * (0.5 - math.log((1 + siny) / (1 - siny)) / (4 * math.pi))
 
-    return Geometry.Point(x=x, y=y)
+    # Geometry imports pkg_resources, which takes longer than the rest of startup
+    from Geometry import Point
+    return Point(x=x, y=y)
 
 
 def unproject_web_mercator(zoom: int, x: float, y: float):
@@ -131,3 +136,133 @@ def polar_closure(rect: s2sphere.LatLngRect):
     if rect.lat_lo().radians == -math.pi / 2 or rect.lat_hi().radians == math.pi / 2:
         return s2sphere.LatLngRect(rect.lat(), s2sphere.SphereInterval.full())
     return rect
+
+
+# Batch versions of the above over numpy arrays of coordinates in degrees.
+# Bounds are rows of radians lat lo/hi and lng lo/hi, the layout of snapshot bounds,
+# an inverted lng interval (lo > hi) crosses the antimeridian like s2sphere.SphereInterval.
+
+EMPTY_BOUNDS = (1.0, 0.0, math.pi, -math.pi)
+
+
+def compute_point_bounds_batch(lat, lon) -> np.ndarray:
+    """Bounds of each point, like compute_bounds of a Point."""
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lng = normalize_lng(np.radians(np.asarray(lon, dtype=np.float64)))
+    return np.stack([lat, lat, lng, lng], axis=1)
+
+
+def compute_line_bounds_batch(lat, lon, offsets) -> np.ndarray:
+    """Bounds of each line, line i is lat/lon[offsets[i]:offsets[i + 1]], like compute_line_bounds.
+
+    The lng interval is the shortest one holding every vertex, the same as s2sphere
+    accumulates for lines spanning less than half the globe.
+    """
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lng = normalize_lng(np.radians(np.asarray(lon, dtype=np.float64)))
+    offsets = np.asarray(offsets, dtype=np.int64)
+    count = len(offsets) - 1
+
+    bounds = np.tile(np.array(EMPTY_BOUNDS), (count, 1))
+    lengths = np.diff(offsets)
+    lines = np.flatnonzero(lengths > 0)
+    if len(lines) == 0:
+        return bounds
+
+    starts = offsets[lines]
+    ends = offsets[lines + 1] - 1
+    bounds[lines, 0] = np.minimum.reduceat(lat, starts)
+    bounds[lines, 1] = np.maximum.reduceat(lat, starts)
+
+    # sorted within each line, the interval is everything but the widest gap between neighbours
+    line_of_vertex = np.repeat(np.arange(count), lengths)
+    order = np.lexsort((lng, line_of_vertex))
+    sorted_lng = lng[order]
+    lng_lo, lng_hi = sorted_lng[starts], sorted_lng[ends]
+
+    gaps = np.full(len(sorted_lng), -np.inf)
+    gaps[:-1] = sorted_lng[1:] - sorted_lng[:-1]
+    gaps[ends] = -np.inf
+    widest = np.maximum.reduceat(gaps, starts)
+
+    # the gap across the antimeridian, from the last vertex round to the first
+    wraps = (lng_lo + 2 * math.pi - lng_hi) < widest
+    if wraps.any():
+        is_widest = gaps == np.repeat(np.where(wraps, widest, np.nan), lengths[lines])
+        first = np.unique(line_of_vertex[is_widest], return_index=True)[1]
+        gap_at = np.flatnonzero(is_widest)[first]
+        wrapped = np.flatnonzero(wraps)
+        lng_lo[wrapped] = sorted_lng[gap_at + 1]
+        lng_hi[wrapped] = sorted_lng[gap_at]
+
+    bounds[lines, 2] = lng_lo
+    bounds[lines, 3] = lng_hi
+    return bounds
+
+
+def bounds_array(rects) -> np.ndarray:
+    """The rects of a collection as bounds rows, without copying snapshot bounds."""
+    values = getattr(rects, "values", None)
+    if values is not None:
+        return np.frombuffer(values, dtype=np.float64).reshape(-1, 4)
+    bounds = np.empty((len(rects), 4), dtype=np.float64)
+    for i, rect in enumerate(rects):
+        bounds[i] = (rect.lat().lo(), rect.lat().hi(), rect.lng().lo(), rect.lng().hi())
+    return bounds
+
+
+def points_array(points) -> np.ndarray:
+    """The projected centers of a collection as x, y rows, without copying snapshot points."""
+    values = getattr(points, "values", None)
+    if values is not None:
+        return np.frombuffer(values, dtype=np.float64).reshape(-1, 2)
+    return np.array([(point.x, point.y) for point in points], dtype=np.float64).reshape(-1, 2)
+
+
+def bounds_mask(bounds: np.ndarray, rect: s2sphere.LatLngRect) -> np.ndarray:
+    """Which bounds intersect rect, like LatLngRect.intersects."""
+    lat_lo, lat_hi, lng_lo, lng_hi = bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3]
+    if rect.is_empty():
+        return np.zeros(len(bounds), dtype=bool)
+
+    result = (lat_lo <= lat_hi) & (lat_lo <= rect.lat().hi()) & (lat_hi >= rect.lat().lo())
+
+    lo, hi = rect.lng().lo(), rect.lng().hi()
+    empty = lng_lo - lng_hi == 2 * math.pi
+    inverted = lng_lo > lng_hi
+    if lo > hi:
+        lng = inverted | (lng_lo <= hi) | (lng_hi >= lo)
+    else:
+        lng = np.where(inverted, (lng_lo <= hi) | (lng_hi >= lo), (lng_lo <= hi) & (lng_hi >= lo))
+    return result & lng & ~empty
+
+
+def bbox_mask(lat: np.ndarray, lon: np.ndarray, min_lat: float, min_lon: float, max_lat: float, max_lon: float):
+    """Which points are inside the box, in any unit, min_lon > max_lon for a box across the antimeridian."""
+    with np.errstate(invalid="ignore"):
+        result = (lat >= min_lat) & (lat <= max_lat)
+        if min_lon <= max_lon:
+            return result & (lon >= min_lon) & (lon <= max_lon)
+        # the box crosses the antimeridian
+        return result & ((lon >= min_lon) | (lon <= max_lon))
+
+
+def project_web_mercator_batch(lat, lon) -> tuple[np.ndarray, np.ndarray]:
+    """x and y of each point, like project_web_mercator."""
+    siny = np.clip(np.sin(np.radians(np.asarray(lat, dtype=np.float64))), -0.9999, 0.9999)
+    x = 256 * (0.5 + np.asarray(lon, dtype=np.float64) / 360)
+    y = 256 * (0.5 - np.log((1 + siny) / (1 - siny)) / (4 * math.pi))
+    return x, y
+
+
+def unproject_web_mercator_batch(zoom: int, x, y) -> tuple[np.ndarray, np.ndarray]:
+    """lat and lng in degrees of each tile coordinate, like unproject_web_mercator."""
+    n = math.pi - 2.0 * math.pi * np.asarray(y, dtype=np.float64) / 2 ** (float(zoom))
+    lat = 180.0 / math.pi * np.arctan(0.5 * (np.exp(n) - np.exp(-n)))
+    lng = np.asarray(x, dtype=np.float64) / 2 ** (float(zoom)) * 360.0 - 180.0
+    return lat, lng
+
+
+def normalize_lng(lng: np.ndarray) -> np.ndarray:
+    # s2sphere keeps -180 as 180
+    return np.where(lng == -math.pi, math.pi, lng)
@@ -1,33 +1,67 @@
+import atexit
 import io
 import json
 import os
-from collections import OrderedDict
 from datetime import datetime
 
 import geojson
+import numpy as np
+import requests
 import s2sphere
-from Geometry import Point
-from apscheduler.schedulers.background import BackgroundScheduler
 
-from ogc_api import geometry
-from ogc_api.data_structures import Collection, CollectionMetadata, WFSLink, APIResponse, HTTP_RESPONSES
-from erddap_proxy.erddap_matadata import ERDDAPMetadata, ERDDAPData, ERDDAPCollections
+from ogc_api import cql2, geometry
+from ogc_api.search import SearchIndex
+from ogc_api.data_structures import Collection, CollectionMetadata, ItemsQuery, WFSLink, APIResponse, HTTP_RESPONSES
+from erddap_proxy.erddap_matadata import ERDDAPMetadata, ERDDAPData, ERDDAPCollections, VARIABLE_NAME
+from erddap_proxy.federation import FederatedCollections, parse_servers
+from erddap_proxy.cache_warmer import CacheWarmer
+from erddap_proxy.live_tail import LiveTail
+from erddap_proxy.upstream import UpstreamBusy
+
+WARMUP_ENV = os.environ.get("WARMUP", "").lower() in ("1", "true", "yes")
+ACCESS_COUNTS_FILE = os.environ.get("ACCESS_COUNTS_FILE")
+ACCESS_COUNTS_SAVE_INTERVAL = int(os.environ.get("ACCESS_COUNTS_SAVE_INTERVAL", "300"))
+
+# columns every ERDDAP collection has, never downloaded as extra variables
+COORDINATES = ("time", "latitude", "longitude")
 
 
 class Footer:
     links: []
     bbox: []
+    numberMatched: int
+    numberReturned: int
 
     def __init__(self):
         self.bbox = []
+        self.numberMatched = 0
+        self.numberReturned = 0
 
 
 class Index:
     collections: ERDDAPCollections
     public_path: str
+    warmer: CacheWarmer
 
     def __init__(self):
-        self.erddap_collections = ERDDAPCollections(os.environ.get("ERDDAP", "https://erddap.oceantrack.org/erddap/"))
+        servers = parse_servers(os.environ.get("ERDDAP_SERVERS", ""))
+        if len(servers) > 0:
+            self.erddap_collections = FederatedCollections(servers)
+        else:
+            self.erddap_collections = ERDDAPCollections(os.environ.get("ERDDAP", "https://erddap.oceantrack.org/erddap/"))
+        self.warmer = None
+        self.search_index = SearchIndex()
+        self.live_tail = LiveTail(self.erddap_collections)
+
+    def get_readiness(self):
+        if self.warmer is None:
+            return APIResponse(dict(ready=True), None)
+
+        progress = self.warmer.progress()
+        if not progress["ready"]:
+            return APIResponse(progress, HTTP_RESPONSES["NOT_READY"])
+
+        return APIResponse(progress, None)
 
     def get_collection_metadata(self, path: str):
         for coll in self.collections:
@@ -60,45 +94,61 @@ class Index:
 
     def get_items(self,
                   collection: str, start_id: str, start_index: int, limit: int,
-                  bbox: s2sphere.LatLngRect, include_links: bool, writer: io.BytesIO):
-        if collection not in self.erddap_collections.meta.get_erddap_datasets():
+                  bbox: s2sphere.LatLngRect, include_links: bool, writer: io.BytesIO, query: ItemsQuery = None):
+        if collection not in self.erddap_collections.meta.get_catalogue():
             return APIResponse(None, HTTP_RESPONSES["NOT_FOUND"])
 
-        # coll = self.collections[collection]
-        coll = self.erddap_collections.get_collection_as_data(collection)
-        # return APIResponse({}, None)
+        if start_index < 0:
+            # a negative slice start would count from the end
+            return APIResponse(None, HTTP_RESPONSES["BAD_REQUEST"])
+
+        if query is None:
+            query = ItemsQuery()
+        properties = query.properties
+
+        try:
+            coll = self.get_queried_collection(collection, query)
+            selected = select_features(coll, bbox, query.filter)
+            selected = thin_features(coll, selected, query.thin_interval, query.thin_max)
+        except UpstreamBusy as err:
+            return upstream_busy(err)
+        except cql2.FilterError:
+            return APIResponse(None, HTTP_RESPONSES["BAD_REQUEST"])
+        except requests.HTTPError as err:
+            # ERDDAP refuses variables the dataset doesn't have, and filters can name them too
+            if refused_query(err, query):
+                return APIResponse(None, HTTP_RESPONSES["BAD_REQUEST"])
+            raise
 
         bounds = s2sphere.LatLngRect()
-        num_features = 0
 
         if len(start_id) > 0:
-            start_index = coll.by_id[start_id]
+            if start_id not in coll.by_id:
+                return APIResponse(None, HTTP_RESPONSES["BAD_REQUEST"])
+            # start at the feature itself, or the first match after it
+            start_index = int(np.searchsorted(selected, coll.by_id[start_id]))
+
+        # counted from the mask, no feature needs encoding to know how many match
+        page = selected[start_index:start_index + limit] if not query.hits else selected[:0]
 
         writer.write(bytearray('{"type":"FeatureCollection","features":[', 'utf8'))
-        skip = start_index
         next_id = ''
         next_index = 0
-        for i, feature_bounds in enumerate(coll.bbox):
-            if not bbox.is_empty() and not bbox.intersects(feature_bounds):
-                continue
-
-            if num_features >= limit:
-                next_id = coll.id[i]
-                next_index = i
-                break
-
-            if skip > 0:
-                skip -= 1
-                continue
-
-            if num_features > 0:
-                writer.write(bytearray(',', 'utf8'))
-
-            writer.write(bytearray(coll.feature[i], encoding='utf8'))
-
-            num_features += 1
-
-            bounds = bounds.union(feature_bounds)
+        if properties is None:
+            # slices of the stored features, consecutive ones in a single write
+            coll.write_features(writer, page)
+        else:
+            for num_features, i in enumerate(page):
+                if num_features > 0:
+                    writer.write(bytearray(',', 'utf8'))
+                writer.write(bytearray(coll.encode_feature(i, properties), encoding='utf8'))
+
+        for i in page:
+            bounds = bounds.union(coll.bbox[i])
+
+        if not query.hits and start_index + limit < len(selected):
+            next_index = start_index + limit
+            next_id = coll.id[selected[next_index]]
 
         writer.write(bytearray('],', 'utf8'))
 
@@ -111,7 +161,7 @@ class Index:
 
             self_link = WFSLink()
             self_link.href = server_handler.format_items_url(public_path, collection, start_id, start_index, bbox,
-                                                             limit)
+                                                             limit, query)
             self_link.rel = "self"
             self_link.title = "self"
             self_link.type = "application/geo+json"
@@ -121,7 +171,7 @@ class Index:
             if next_index > 0:
                 next_link = WFSLink()
                 next_link.href = server_handler.format_items_url(public_path, collection, next_id, next_index, bbox,
-                                                                 limit)
+                                                                 limit, query)
                 next_link.rel = "next"
                 next_link.title = "next"
                 next_link.type = "application/geo+json"
@@ -129,30 +179,125 @@ class Index:
                 footer.links.append(next_link.to_json())
 
         footer.bbox = geometry.encode_bbox(bounds)
-        encoded_footer = json.dumps(footer.__dict__)
+        footer.numberMatched = len(selected)
+        footer.numberReturned = len(page)
+        encoded_footer = json.dumps(footer.__dict__, ensure_ascii=False, separators=(',', ':'))
 
         writer.write(bytearray(encoded_footer[1:], 'utf8'))
 
-        features = geojson.loads(writer.getvalue().decode('utf8'), object_hook=OrderedDict)
+        # sent as written, the stored features are never decoded
+        return APIResponse(writer.getvalue(), None, freshness_headers(coll))
+
+    def get_queried_collection(self, collection: str, query: ItemsQuery) -> Collection:
+        """The collection holding every column query needs, filtered by ERDDAP when it isn't cached yet."""
+        variables = query_variables(query)
+        for variable in variables:
+            # cql2-json can name any string, it would end up in the ERDDAP query
+            if not VARIABLE_NAME.match(variable):
+                raise cql2.FilterError(f"Malformed property name {variable}")
+
+        if query.filter is not None and collection not in self.erddap_collections.cache:
+            # rather than the whole dataset, download what the filter lets through for this request
+            return self.erddap_collections.get_filtered_collection(collection, variables,
+                                                                   query.filter.constraints())
 
-        return APIResponse(features, None)
+        if len(variables) == 0:
+            return self.erddap_collections.get_collection_as_data(collection)
+        return self.erddap_collections.get_collection_with_variables(collection, variables)
 
     def get_item(self, collection: str, feature_id: str):
-        if collection not in self.collections:
+        """The stored feature as encoded bytes, found through the collection's id index."""
+        if collection not in self.erddap_collections.meta.get_catalogue():
+            return APIResponse(None, HTTP_RESPONSES["NOT_FOUND"])
+
+        try:
+            coll = self.erddap_collections.get_collection_as_data(collection)
+        except UpstreamBusy as err:
+            return upstream_busy(err)
+
+        coll_index = coll.by_id.get(feature_id)
+        if coll_index is None:
             return APIResponse(None, HTTP_RESPONSES["NOT_FOUND"])
 
-        coll = self.collections[collection]
+        return APIResponse(coll.encoded_feature(coll_index), None, freshness_headers(coll))
+
+    def get_items_by_id(self, collection: str, feature_ids: list, writer: io.BytesIO, properties: list = None):
+        """The features with the given ids in the order asked for, ids the collection doesn't have are left out."""
+        if collection not in self.erddap_collections.meta.get_catalogue():
+            return APIResponse(None, HTTP_RESPONSES["NOT_FOUND"])
+
+        query = ItemsQuery(properties)
+        try:
+            coll = self.get_queried_collection(collection, query)
+        except UpstreamBusy as err:
+            return upstream_busy(err)
+        except cql2.FilterError:
+            return APIResponse(None, HTTP_RESPONSES["BAD_REQUEST"])
+        except requests.HTTPError as err:
+            if refused_query(err, query):
+                return APIResponse(None, HTTP_RESPONSES["BAD_REQUEST"])
+            raise
+
+        writer.write(b'{"type":"FeatureCollection","features":[')
+        num_features = 0
+        for feature_id in feature_ids:
+            coll_index = coll.by_id.get(feature_id)
+            if coll_index is None:
+                continue
+
+            if num_features > 0:
+                writer.write(b',')
+
+            if properties is None:
+                writer.write(coll.encoded_feature(coll_index))
+            else:
+                writer.write(coll.encode_feature(coll_index, properties).encode('utf8'))
+
+            num_features += 1
+
+        writer.write(bytearray(str.format('],"numberReturned":{0}}}', num_features), 'utf8'))
 
-        if feature_id not in coll.by_id:
+        return APIResponse(writer.getvalue(), None, freshness_headers(coll))
+
+    def get_live_stream(self, collection: str):
+        """The Server-Sent Events of the collection's new features, subscribed when first iterated."""
+        if collection not in self.erddap_collections.meta.get_catalogue():
             return APIResponse(None, HTTP_RESPONSES["NOT_FOUND"])
 
-        writer = io.BytesIO()
-        coll_index = coll.by_id[feature_id]
-        writer.write(bytearray(coll.feature[coll_index], encoding='utf8'))
+        return APIResponse(self.live_tail.stream(collection), None)
 
-        feature = geojson.loads(writer.getvalue().decode('utf8'))
+    def search(self, bbox: s2sphere.LatLngRect, time_range: cql2.TimeRange, limit: int, writer: io.BytesIO):
+        """Features of every loaded collection in bbox and time_range, each with its collection id."""
+        catalogue = self.erddap_collections.meta.get_catalogue()
+        matches, unloaded = self.search_index.search(catalogue, dict(self.erddap_collections.cache), bbox,
+                                                     time_range)
 
-        return APIResponse(feature, None)
+        writer.write(b'{"type":"FeatureCollection","features":[')
+        num_features = 0
+        for collection_id, coll, selected in matches:
+            # the stored feature with a collection member spliced in, so it isn't decoded
+            prefix = b'{"collection":' + json.dumps(collection_id, ensure_ascii=False).encode('utf8') + b','
+            for i in selected[:limit - num_features]:
+                if num_features > 0:
+                    writer.write(b',')
+                writer.write(prefix)
+                writer.write(coll.encoded_feature(i)[1:])
+                num_features += 1
+
+        collections = [dict(id=collection_id, title=catalogue[collection_id].title, numberMatched=len(selected))
+                       for collection_id, _, selected in matches]
+        # not loaded, their catalogue extent may match but their features aren't searched
+        collections += [dict(id=collection_id, title=catalogue[collection_id].title, numberMatched=None)
+                        for collection_id in unloaded]
+
+        writer.write(b'],')
+        footer = dict(collections=collections,
+                      numberMatched=sum(len(selected) for _, _, selected in matches),
+                      numberReturned=num_features)
+        # compact like the items footer
+        writer.write(json.dumps(footer, ensure_ascii=False, separators=(',', ':')).encode('utf8')[1:])
+
+        return APIResponse(writer.getvalue(), None)
 
     # def reload_if_changed(self, collection_metadata: CollectionMetadata):
     #     response = read_collection(collection_metadata.name, collection_metadata.path,
@@ -167,10 +312,103 @@ class Index:
     #         self.reload_if_changed(collection)
 
 
-def make_index(collections: dict, public_path: str):
+def upstream_busy(err: UpstreamBusy) -> APIResponse:
+    # the collection isn't loaded and ERDDAP can't take the request now, tell the client when to come back
+    return APIResponse(None, HTTP_RESPONSES["UPSTREAM_BUSY"], {"Retry-After": str(err.retry_after)})
+
+
+def query_variables(query: ItemsQuery) -> list[str]:
+    """The variables besides the coordinates the query's properties and filter name."""
+    variables = list(query.properties or [])
+    if query.filter is not None:
+        variables += sorted(query.filter.properties() - set(variables))
+    return [variable for variable in variables if variable not in COORDINATES]
+
+
+def refused_query(err: requests.HTTPError, query: ItemsQuery) -> bool:
+    """Whether ERDDAP turned down the variables a query asked for, rather than failing to serve the dataset."""
+    if len(query_variables(query)) == 0:
+        return False
+    return err.response is not None and 400 <= err.response.status_code < 500
+
+
+def freshness_headers(coll: Collection) -> dict:
+    """How long ago the collection's data came from ERDDAP, it may be served stale while it is refreshed."""
+    if coll.fetched_at is None:
+        return {}
+    return {"Age": str(int(coll.age()))}
+
+
+def select_features(coll: Collection, bbox: s2sphere.LatLngRect, item_filter=None) -> np.ndarray:
+    """Indices of the features inside bbox and matching the filter, in collection order."""
+    count = len(coll.feature)
+    if count == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    mask = np.ones(count, dtype=bool)
+    if not bbox.is_empty():
+        if "latitude" in coll.columns and "longitude" in coll.columns:
+            # the same closed intervals s2 tests, including boxes across the antimeridian
+            lat = np.radians(coll.columns["latitude"].astype(np.float64))
+            lng = np.radians(coll.columns["longitude"].astype(np.float64))
+            mask &= geometry.bbox_mask(lat, lng, bbox.lat().lo(), bbox.lng().lo(), bbox.lat().hi(), bbox.lng().hi())
+        else:
+            mask &= geometry.bounds_mask(geometry.bounds_array(coll.bbox), bbox)
+
+    if item_filter is not None:
+        mask &= item_filter.mask(coll.columns, count)
+
+    return np.flatnonzero(mask)
+
+
+def thin_features(coll: Collection, selected: np.ndarray, interval: float = None, max_features: int = None):
+    """The first of the selected features in each time bucket, buckets are interval seconds from 1970 apart.
+
+    With max_features instead, the selected time span is cut into that many buckets.
+    """
+    if interval is None and (max_features is None or len(selected) <= max_features):
+        return selected
+
+    times = coll.columns["time"][selected]
+    # features without a time can't be placed in a bucket
+    timed = np.flatnonzero(~np.isnan(times))
+    if len(timed) == 0:
+        return selected[:0]
+    times = times[timed]
+
+    if interval is not None:
+        buckets = np.floor(times / interval)
+    else:
+        start, span = times.min(), times.max() - times.min()
+        if span == 0:
+            return selected[timed[:1]]
+        # the last feature is at the end of the span, it belongs in the last bucket
+        buckets = np.minimum(np.floor((times - start) / span * max_features), max_features - 1)
+
+    first = np.unique(buckets, return_index=True)[1]
+    return selected[timed[np.sort(first)]]
+
+
+def make_index(collections: dict, public_path: str, warmup: bool = WARMUP_ENV):
     index = Index()
     index.public_path = public_path
 
+    if ACCESS_COUNTS_FILE:
+        from apscheduler.schedulers.background import BackgroundScheduler
+
+        access_counts = index.erddap_collections.access_counts
+        access_counts.load(ACCESS_COUNTS_FILE)
+
+        scheduler = BackgroundScheduler(daemon=True)
+        scheduler.add_job(access_counts.save, "interval", seconds=ACCESS_COUNTS_SAVE_INTERVAL,
+                          args=[ACCESS_COUNTS_FILE])
+        scheduler.start()
+        atexit.register(access_counts.save, ACCESS_COUNTS_FILE)
+
+    if warmup:
+        index.warmer = CacheWarmer(index.erddap_collections)
+        index.warmer.start()
+
     # for name, path in collections.items():
     #     response = read_collection(name, path, datetime.min)
     #     index.collections[name] = response.content
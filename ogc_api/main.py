@@ -1,11 +1,17 @@
 import logging
 import os
+import time
 
-from fastapi import FastAPI
+# first, to time everything the app imports
+from ogc_api.startup import REPORT as STARTUP_REPORT
+from fastapi import FastAPI, Query
 from fastapi.openapi.utils import get_openapi
 from starlette.middleware.cors import CORSMiddleware
-from starlette.responses import Response
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
 
+from ogc_api import metrics
+from ogc_api.profiling import RequestProfiler
 from ogc_api.index import make_index
 from ogc_api.server_handler import json_dumps_for_response, DEFAULT_LIMIT
 from ogc_api.server_handler import make_web_server
@@ -15,6 +21,26 @@ app.add_middleware(
     CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]
 )
 
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    duration = time.perf_counter() - start
+
+    # label by route template, not by path, to keep the number of series bounded
+    route = request.scope.get("route")
+    endpoint = route.path if route is not None else "unmatched"
+
+    metrics.HTTP_REQUEST_SECONDS.observe(duration, endpoint=endpoint, method=request.method,
+                                         status=response.status_code)
+    metrics.HTTP_RESPONSE_BYTES.observe(int(response.headers.get("content-length", 0)), endpoint=endpoint)
+    STARTUP_REPORT.record_request(request.url.path, duration)
+
+    return response
+
+profiler = RequestProfiler()
+
 COLLECTIONS_ENV = os.environ.get('COLLECTIONS')
 PORT_ENV = os.environ.get('PORT')
 
@@ -40,11 +66,15 @@ INDEX_MESSAGE = f'{SHORT_INDEX_MESSAGE}' \
                 '<li><i>/collections/{collection}</i></li>' \
                 '<li><i>/collections/{collection}/items</i></li>' \
                 '<li><i>/collections{collection}/items/{feature_id}</i></li>' \
+                '<li><i>/collections/{collection}/live</i></li>' \
                 '</ol>' \
                 '<ol>' \
                 '<strong><i>Other Endpoints: </i></strong><br/>' \
                 '<li><i>/tiles/{collection}/{zoom}/{x}/{y}.png</i></li>' \
                 '<li><i>/tiles/{collection}/{zoom}/{x}/{y}/{a}/{b}.geojson</i></li>' \
+                '<li><i>/search</i></li>' \
+                '<li><i>/ready</i></li>' \
+                '<li><i>/metrics</i></li>' \
                 '</ol>'
 
 
@@ -64,6 +94,8 @@ def main():
     idx = make_index(collections, WEB_HOST_URL)
     server = make_web_server(idx)
 
+    profiler.install(app)
+
     @app.get("/")
     def landing_page():
         api_response = server.handle_landing_request()
@@ -74,8 +106,31 @@ def main():
                             "content-length": str(len(api_response.content))
                         })
 
+    @app.get("/ready")
+    def readiness():
+        api_response = server.handle_ready_request()
+        status_code = 200 if api_response.http_response is None else api_response.http_response.status_code
+
+        return Response(content=api_response.content,
+                        status_code=status_code,
+                        headers={
+                            "content-type": "application/json",
+                            "content-length": str(len(api_response.content))
+                        })
+
+    @app.get("/metrics", include_in_schema=False)
+    def get_metrics():
+        content = metrics.render()
+
+        return Response(content=content,
+                        headers={
+                            "content-type": metrics.CONTENT_TYPE,
+                            "content-length": str(len(content))
+                        })
+
     # region OGC API endpoints
     @app.get("/collections")
+    @profiler.profile
     def get_collections():
         api_response = server.handle_collections_request()
 
@@ -86,11 +141,13 @@ def main():
                         })
 
     @app.get("/collections/{collection}")
+    @profiler.profile
     def get_collection(collection: str):
         api_response = server.handle_collections_request(collection)
 
         if api_response.http_response is not None:
-            return Response(content=None, status_code=api_response.http_response.status_code)
+            return Response(content=None, status_code=api_response.http_response.status_code,
+                            headers=api_response.headers)
 
         return Response(content=api_response.content,
                         headers={
@@ -99,24 +156,61 @@ def main():
                         })
 
     @app.get("/collections/{collection}/items")
+    @profiler.profile
     def get_collection_items(collection: str, bbox: str = '', limit=DEFAULT_LIMIT,
-                             start_id: str = '', start: int = 0):
-        api_response = server.handle_items_request(collection, start_id, start, bbox, limit)
+                             start_id: str = '', start: int = 0, properties: str = '', datetime: str = '',
+                             filter: str = '', filter_lang: str = Query('', alias='filter-lang'), ids: str = '',
+                             result_type: str = Query('', alias='resultType'), thin: str = ''):
+        if len(ids) > 0:
+            # a batch of known features, bbox, paging and filters don't apply
+            api_response = server.handle_items_by_id_request(collection, ids, properties)
+        else:
+            api_response = server.handle_items_request(collection, start_id, start, bbox, limit, properties,
+                                                       filter, filter_lang, datetime, result_type, thin)
 
         if api_response.http_response is not None:
-            return Response(content=None, status_code=api_response.http_response.status_code)
+            return Response(content=None, status_code=api_response.http_response.status_code,
+                            headers=api_response.headers)
 
         return Response(content=api_response.content,
                         headers={
                             "content-type": "application/geo+json",
-                            "content-length": str(len(api_response.content))
-
+                            "content-length": str(len(api_response.content)),
+                            **api_response.headers
                         })
 
+    @app.get("/collections/{collection}/live")
+    def get_live_features(collection: str):
+        api_response = server.handle_live_request(collection)
+
+        if api_response.http_response is not None:
+            return Response(content=None, status_code=api_response.http_response.status_code)
+
+        # new features as they surface, until the client disconnects
+        return StreamingResponse(api_response.content, media_type="text/event-stream",
+                                 headers={"cache-control": "no-cache", "x-accel-buffering": "no"})
+
     @app.get("/collections/{collection}/items/{feature_id}")
+    @profiler.profile
     def get_feature_info(collection: str, feature_id: str):
         api_response = server.handle_item_request(collection, feature_id)
 
+        if api_response.http_response is not None:
+            return Response(content=None, status_code=api_response.http_response.status_code,
+                            headers=api_response.headers)
+
+        return Response(content=api_response.content,
+                        headers={
+                            "content-type": "application/geo+json",
+                            "content-length": str(len(api_response.content)),
+                            **api_response.headers
+                        })
+
+    @app.get("/search")
+    @profiler.profile
+    def search(bbox: str = '', datetime: str = '', limit=DEFAULT_LIMIT):
+        api_response = server.handle_search_request(bbox, datetime, limit)
+
         if api_response.http_response is not None:
             return Response(content=None, status_code=api_response.http_response.status_code)
 
@@ -163,3 +257,4 @@ def main():
 
 if __name__ == 'ogc_api.main':
     main()
+    STARTUP_REPORT.imported()
@@ -0,0 +1,185 @@
+import math
+import threading
+import time
+
+# Seconds, from a fast cache hit to a multi minute ERDDAP download
+DEFAULT_TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+DEFAULT_SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REGISTRY = []
+
+
+class Metric:
+    name: str
+    documentation: str
+    labelnames: ()
+    kind: str
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+        (REGISTRY if registry is None else registry).append(self)
+
+    def _key(self, labels: dict):
+        if set(labels.keys()) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels.keys())}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def remove(self, **labels):
+        with self.lock:
+            self.values.pop(self._key(labels), None)
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            values = dict(self.values)
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_TIME_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+            bucket_counts, _, _ = entry = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    bucket_counts[i] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def time(self, **labels):
+        return HistogramTimer(self, labels)
+
+    def get_count(self, **labels) -> int:
+        entry = self.values.get(self._key(labels))
+        return 0 if entry is None else entry[1]
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            values = {key: (list(entry[0]), entry[1], entry[2]) for key, entry in self.values.items()}
+        for key, (bucket_counts, count, total) in sorted(values.items()):
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                labels = format_labels(self.labelnames + ("le",), key + (format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            labels = format_labels(self.labelnames + ("le",), key + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class HistogramTimer:
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+def format_labels(names, values) -> str:
+    if len(names) == 0:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def render(registry=None) -> bytes:
+    lines = []
+    for metric in (REGISTRY if registry is None else registry):
+        lines.extend(metric.collect())
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+ERDDAP_DOWNLOAD_SECONDS = Histogram("erddap_download_seconds",
+                                    "Time spent downloading from ERDDAP", ["kind"])
+ERDDAP_DOWNLOAD_BYTES = Histogram("erddap_download_bytes",
+                                  "Size of ERDDAP response bodies", ["kind"], buckets=DEFAULT_SIZE_BUCKETS)
+CONVERT_SECONDS = Histogram("convert_to_collection_seconds",
+                            "Time spent converting a downloaded dataset into a collection")
+HTTP_REQUEST_SECONDS = Histogram("http_request_seconds",
+                                 "Time spent serving a request", ["endpoint", "method", "status"])
+HTTP_RESPONSE_BYTES = Histogram("http_response_bytes",
+                                "Size of response bodies", ["endpoint"], buckets=DEFAULT_SIZE_BUCKETS)
+UPSTREAM_QUEUED = Gauge("upstream_queued_requests",
+                        "ERDDAP requests waiting for a free slot", ["host"])
+UPSTREAM_REJECTED = Counter("upstream_rejected_total",
+                            "ERDDAP requests refused because too many were queued", ["host"])
+UPSTREAM_RETRIES = Counter("upstream_retries_total",
+                           "ERDDAP requests retried after a connection error, timeout or 5xx", ["host"])
+CACHE_HITS = Counter("collection_cache_hits_total",
+                     "Requests served from an already loaded collection", ["collection"])
+CACHE_MISSES = Counter("collection_cache_misses_total",
+                       "Requests that had to load the collection from ERDDAP", ["collection"])
+CACHE_EVICTIONS = Counter("collection_cache_evictions_total",
+                          "Collections dropped from the cache", ["collection"])
+STARTUP_IMPORT_SECONDS = Gauge("startup_import_seconds",
+                               "Time taken to import the app and build its routes")
+STARTUP_FIRST_REQUEST_SECONDS = Gauge("startup_first_request_seconds",
+                                      "Time taken to answer the first request after startup")
+COLLECTION_REFRESHES = Counter("collection_refreshes_total",
+                               "Background downloads of a new version of a cached collection",
+                               ["collection", "outcome"])
+LIVE_SUBSCRIBERS = Gauge("live_subscribers",
+                         "Clients following a collection's new features", ["collection"])
+LIVE_EVENTS = Counter("live_events_total",
+                      "Polls that found new features and sent them to the subscribers", ["collection"])
+CACHE_RESIDENT_BYTES = Gauge("collection_cache_resident_bytes",
+                             "Estimated memory held by a cached collection", ["collection"])
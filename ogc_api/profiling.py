@@ -0,0 +1,159 @@
+import contextvars
+import cProfile
+import functools
+import io
+import marshal
+import os
+import pstats
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+PROFILING_ENV = os.environ.get("PROFILING", "").lower() in ("1", "true", "yes")
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "20"))
+
+PROFILE_HEADER = "x-profile"
+PROFILE_PARAMETER = "profile"
+REPORT_LINES = 60
+
+# set by the middleware for requests asking to be profiled, copied into the endpoint's worker thread
+_requested = contextvars.ContextVar("profile_requested", default=False)
+
+
+class ProfileReport:
+    id: str
+    path: str
+    seconds: float
+    stats: bytes
+
+    def __init__(self, profile_id: str, path: str, seconds: float, profiler: cProfile.Profile):
+        self.id = profile_id
+        self.path = path
+        self.seconds = seconds
+        profiler.create_stats()
+        self.stats = marshal.dumps(profiler.stats)
+
+    def to_text(self) -> str:
+        out = io.StringIO()
+        out.write(f"Profile {self.id} of {self.path}, {self.seconds * 1000:.1f} ms\n\n")
+
+        stats = pstats.Stats(_MarshalledStats(self.stats), stream=out)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(REPORT_LINES)
+        return out.getvalue()
+
+
+class _MarshalledStats:
+    """Lets pstats.Stats load a profile kept in memory instead of a file."""
+
+    def __init__(self, data: bytes):
+        self.stats = marshal.loads(data)
+
+    def create_stats(self):
+        pass
+
+
+class RequestProfiler:
+    """Opt-in cProfile traces of single requests, asked for with a header or query parameter.
+
+    One request is profiled at a time. From Python 3.12 the trace covers every thread of the process while
+    it runs, so requests served alongside the profiled one show up in its report.
+    """
+
+    def __init__(self, enabled: bool = PROFILING_ENV, keep: int = PROFILE_KEEP, directory: str = PROFILE_DIR):
+        self.enabled = enabled
+        self.keep = keep
+        self.directory = directory
+        self.reports = OrderedDict()
+        self.lock = threading.Lock()
+        # cProfile captures the whole process on Python 3.12+, a second one at the same time fails
+        self.running = threading.Lock()
+
+    def install(self, app):
+        """Adds the middleware and report endpoint, nothing is added when profiling is off."""
+        if not self.enabled:
+            return
+
+        @app.middleware("http")
+        async def mark_profiled_requests(request: Request, call_next):
+            if request.headers.get(PROFILE_HEADER) or request.query_params.get(PROFILE_PARAMETER):
+                token = _requested.set(True)
+                try:
+                    return await call_next(request)
+                finally:
+                    _requested.reset(token)
+            return await call_next(request)
+
+        @app.get("/profiles/{profile_id}", include_in_schema=False)
+        def get_profile(profile_id: str, format: str = "text"):
+            report = self.get(profile_id)
+            if report is None:
+                return Response(content=None, status_code=404)
+
+            if format == "prof":
+                # the pstats file format, for snakeviz or pstats.Stats(path)
+                return Response(content=report.stats,
+                                headers={
+                                    "content-type": "application/octet-stream",
+                                    "content-disposition": f'attachment; filename="{report.id}.prof"',
+                                })
+
+            content = report.to_text().encode("utf8")
+            return Response(content=content,
+                            headers={
+                                "content-type": "text/plain; charset=utf-8",
+                                "content-length": str(len(content))
+                            })
+
+    def profile(self, func):
+        """Decorates an endpoint returning a Response, returns it untouched when profiling is off."""
+        if not self.enabled:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _requested.get():
+                return func(*args, **kwargs)
+
+            if not self.running.acquire(blocking=False):
+                # another request is being profiled, this one is served as usual
+                response = func(*args, **kwargs)
+                response.headers["x-profile-skipped"] = "busy"
+                return response
+
+            try:
+                profiler = cProfile.Profile()
+                start = time.perf_counter()
+                response = profiler.runcall(func, *args, **kwargs)
+                seconds = time.perf_counter() - start
+            finally:
+                self.running.release()
+
+            report = self.add(func.__name__, seconds, profiler)
+            response.headers["x-profile-id"] = report.id
+            return response
+
+        return wrapper
+
+    def add(self, path: str, seconds: float, profiler: cProfile.Profile) -> ProfileReport:
+        report = ProfileReport(uuid.uuid4().hex[:16], path, seconds, profiler)
+
+        with self.lock:
+            self.reports[report.id] = report
+            while len(self.reports) > self.keep:
+                self.reports.popitem(last=False)
+
+        if self.directory:
+            with open(os.path.join(self.directory, report.id + ".txt"), "w") as file:
+                file.write(report.to_text())
+            profiler.dump_stats(os.path.join(self.directory, report.id + ".prof"))
+
+        return report
+
+    def get(self, profile_id: str):
+        with self.lock:
+            return self.reports.get(profile_id)
@@ -0,0 +1,155 @@
+"""Search across collections for features in a bbox and time range.
+
+Each collection has an extent: from its cached columns once it is loaded, from
+the catalogue otherwise. A search skips every collection whose extent can't
+match without looking at its features. In the loaded ones the time range is
+found by binary search on the time column, which ERDDAP returns sorted, and
+only that slice is checked against the bbox. Collections that aren't loaded are
+never downloaded by a search; the ones whose catalogue extent matches are
+listed without counts.
+"""
+import math
+import threading
+
+import numpy as np
+import s2sphere
+
+from ogc_api import geometry
+from ogc_api.cql2 import TimeRange
+from ogc_api.data_structures import Collection, CollectionMetadata
+
+
+class Extent:
+    """Bounds of a collection's features, any part can be None for unknown."""
+
+    def __init__(self, rect: s2sphere.LatLngRect = None, start: float = None, end: float = None,
+                 time_sorted: bool = False):
+        self.rect = rect
+        self.start = start
+        self.end = end
+        # the time column is in order, so a time range is a slice of it
+        self.time_sorted = time_sorted
+
+    @classmethod
+    def from_collection(cls, coll: Collection):
+        lat = coll.columns["latitude"].astype(np.float64)
+        lon = coll.columns["longitude"].astype(np.float64)
+        time = coll.columns["time"]
+
+        with np.errstate(invalid="ignore"):
+            # an extent ignoring missing positions would leave those features out, keep it unknown instead
+            rect = None if np.isnan(lat).any() or np.isnan(lon).any() else \
+                make_rect(lat.min(), lon.min(), lat.max(), lon.max())
+            time_sorted = bool(np.all(time[1:] >= time[:-1]))
+
+        if np.isnan(time).any():
+            return cls(rect)
+        return cls(rect, float(time.min()), float(time.max()), time_sorted)
+
+    @classmethod
+    def from_metadata(cls, metadata: CollectionMetadata):
+        rect = None
+        if metadata.bbox is not None:
+            min_lon, min_lat, max_lon, max_lat = metadata.bbox
+            rect = make_rect(min_lat, min_lon, max_lat, max_lon)
+
+        start = end = None
+        if metadata.interval is not None:
+            start, end = [None if t is None else t.timestamp() for t in metadata.interval]
+        return cls(rect, start, end)
+
+    def may_match(self, bbox: s2sphere.LatLngRect, time_range: TimeRange) -> bool:
+        if not bbox.is_empty() and self.rect is not None and not bbox.intersects(self.rect):
+            return False
+        if time_range is None:
+            return True
+        if time_range.start is not None and self.end is not None and self.end < time_range.start:
+            return False
+        if time_range.end is not None and self.start is not None and self.start > time_range.end:
+            return False
+        return True
+
+
+class SearchIndex:
+    """Extents of the loaded collections, computed once per loaded version."""
+
+    def __init__(self):
+        # collection id -> (the Collection the extent is of, Extent)
+        self.extents = {}
+        self.lock = threading.Lock()
+
+    def extent(self, collection_id: str, coll: Collection) -> Extent:
+        entry = self.extents.get(collection_id)
+        if entry is not None and entry[0] is coll:
+            return entry[1]
+
+        extent = Extent.from_collection(coll)
+        with self.lock:
+            self.extents[collection_id] = (coll, extent)
+        return extent
+
+    def prune(self, loaded: dict):
+        """Forget the extents of collections no longer loaded."""
+        with self.lock:
+            for collection_id in list(self.extents.keys()):
+                if collection_id not in loaded:
+                    del self.extents[collection_id]
+
+    def search(self, catalogue: dict, loaded: dict, bbox: s2sphere.LatLngRect, time_range: TimeRange):
+        """The matching feature indices of each loaded collection, and the other collections that may match.
+
+        Returns ([(collection id, Collection, indices)], [collection id]), in catalogue order.
+        """
+        self.prune(loaded)
+
+        matches = []
+        unloaded = []
+        for collection_id, metadata in catalogue.items():
+            coll = loaded.get(collection_id)
+            if coll is None:
+                if Extent.from_metadata(metadata).may_match(bbox, time_range):
+                    unloaded.append(collection_id)
+                continue
+
+            if len(coll.feature) == 0:
+                continue
+
+            extent = self.extent(collection_id, coll)
+            if not extent.may_match(bbox, time_range):
+                continue
+
+            selected = select(coll, extent, bbox, time_range)
+            if len(selected) > 0:
+                matches.append((collection_id, coll, selected))
+
+        return matches, unloaded
+
+
+def select(coll: Collection, extent: Extent, bbox: s2sphere.LatLngRect, time_range: TimeRange) -> np.ndarray:
+    """Indices of the features in bbox and time_range, in collection order."""
+    lo, hi = 0, len(coll.feature)
+    if time_range is not None and extent.time_sorted:
+        time = coll.columns["time"]
+        if time_range.start is not None:
+            lo = int(np.searchsorted(time, time_range.start, "left" if time_range.include_start else "right"))
+        if time_range.end is not None:
+            hi = int(np.searchsorted(time, time_range.end, "right" if time_range.include_end else "left"))
+        if lo >= hi:
+            return np.zeros(0, dtype=np.int64)
+
+    columns = {name: coll.columns[name][lo:hi] for name in ("time", "latitude", "longitude")}
+    mask = np.ones(hi - lo, dtype=bool)
+    if time_range is not None and not extent.time_sorted:
+        mask &= time_range.mask(columns, hi - lo)
+    if not bbox.is_empty():
+        lat = np.radians(columns["latitude"].astype(np.float64))
+        lng = np.radians(columns["longitude"].astype(np.float64))
+        mask &= geometry.bbox_mask(lat, lng, bbox.lat().lo(), bbox.lng().lo(), bbox.lat().hi(), bbox.lng().hi())
+
+    return np.flatnonzero(mask) + lo
+
+
+def make_rect(min_lat, min_lon, max_lat, max_lon) -> s2sphere.LatLngRect:
+    # built from its intervals, from_point_pair would take the short way round across the antimeridian
+    return s2sphere.LatLngRect(s2sphere.LineInterval(math.radians(min_lat), math.radians(max_lat)),
+                               s2sphere.SphereInterval(math.radians(min_lon), math.radians(max_lon)))
@@ -1,14 +1,21 @@
 import io
 import json
+import re
+from urllib.parse import quote
 
 import s2sphere
 
-from ogc_api import index, geometry
-from ogc_api.data_structures import WFSLink, APIResponse, HTTP_RESPONSES
+from ogc_api import cql2, index, geometry
+from ogc_api.data_structures import ItemsQuery, WFSLink, APIResponse, HTTP_RESPONSES
 
 DEFAULT_LIMIT = 10
 MAX_LIMIT = 1000
 MAX_SIGNATURE_WIDTH = 8.0
+PROPERTY_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+# ISO 8601 durations of weeks, days, hours, minutes and seconds, years and months aren't a fixed length
+DURATION = re.compile(r"^P(?:(?P<W>\d+(?:\.\d+)?)W)?(?:(?P<D>\d+(?:\.\d+)?)D)?"
+                      r"(?:T(?:(?P<H>\d+(?:\.\d+)?)H)?(?:(?P<M>\d+(?:\.\d+)?)M)?(?:(?P<S>\d+(?:\.\d+)?)S)?)?$")
+DURATION_SECONDS = {"W": 604800, "D": 86400, "H": 3600, "M": 60, "S": 1}
 
 
 class WebServer:
@@ -76,6 +83,12 @@ class WebServer:
 
         return APIResponse(content=content, http_response=None)
 
+    def handle_ready_request(self):
+        api_response = self.index.get_readiness()
+        api_response.content = json_dumps_for_response(api_response.content)
+
+        return api_response
+
     def handle_collections_request(self, collection_parameter: str = None):
         collections = []
 
@@ -95,14 +108,19 @@ class WebServer:
             id: str
             title: str
             links: [] = []
+            extent: dict
 
             def __init__(self):
                 self.links = []
                 self.title = ""
                 self.id = ""
+                self.extent = None
 
             def to_json(self):
-                return dict(id=self.id, title=self.title, links=self.links)
+                result = dict(id=self.id, title=self.title, links=self.links)
+                if self.extent is not None:
+                    result["extent"] = self.extent
+                return result
 
         class WFSCollectionResponse:
             links: [] = []
@@ -129,7 +147,8 @@ class WebServer:
 
             wfs_collection = WFSCollection()
             wfs_collection.id = collection.name
-            wfs_collection.title = "A collection of " + collection.name + " features"
+            wfs_collection.title = collection.title or "A collection of " + collection.name + " features"
+            wfs_collection.extent = collection.extent_to_json()
 
             # print(link.to_json())
             # print(items_link.to_json())
@@ -158,12 +177,19 @@ class WebServer:
 
         return APIResponse(content, None)
 
-    def handle_items_request(self, collection: str, start_id: str, start: int, bbox: str, limit: str):
+    def handle_items_request(self, collection: str, start_id: str, start: int, bbox: str, limit: str,
+                             properties: str = '', filter: str = '', filter_lang: str = '', datetime: str = '',
+                             result_type: str = '', thin: str = ''):
         response = parse_bbox(bbox)
 
         if response.http_response is not None:
             return APIResponse(None, response.http_response)
 
+        query_response = parse_items_query(properties, filter, filter_lang, datetime, result_type, thin)
+
+        if query_response.http_response is not None:
+            return APIResponse(None, query_response.http_response)
+
         features = io.BytesIO()
         if type(limit) is not int:
             if limit.isdigit():
@@ -177,17 +203,51 @@ class WebServer:
             return APIResponse(None, HTTP_RESPONSES["BAD_REQUEST"])
 
         include_links = True
-        api_response = self.index.get_items(collection, start_id, start, limit, response.content, include_links,
-                                            features)
-        api_response.content = json_dumps_for_response(api_response.content, without_indent=True)
-
-        return api_response
+        return self.index.get_items(collection, start_id, start, limit, response.content, include_links,
+                                    features, query_response.content)
 
     def handle_item_request(self, collection: str, feature_id: str):
-        api_response = self.index.get_item(collection, feature_id)
-        api_response.content = json_dumps_for_response(api_response.content)
+        # already encoded, sent as stored
+        return self.index.get_item(collection, feature_id)
 
-        return api_response
+    def handle_items_by_id_request(self, collection: str, ids: str, properties: str = ''):
+        ids_response = parse_ids(ids)
+
+        if ids_response.http_response is not None:
+            return APIResponse(None, ids_response.http_response)
+
+        properties_response = parse_properties(properties)
+
+        if properties_response.http_response is not None:
+            return APIResponse(None, properties_response.http_response)
+
+        return self.index.get_items_by_id(collection, ids_response.content, io.BytesIO(),
+                                          properties_response.content)
+
+    def handle_live_request(self, collection: str):
+        return self.index.get_live_stream(collection)
+
+    def handle_search_request(self, bbox: str, datetime: str, limit: str):
+        bbox_response = parse_bbox(bbox)
+
+        if bbox_response.http_response is not None:
+            return APIResponse(None, bbox_response.http_response)
+
+        datetime_response = parse_datetime(datetime)
+
+        if datetime_response.http_response is not None:
+            return APIResponse(None, datetime_response.http_response)
+
+        if type(limit) is not int:
+            if limit.isdigit():
+                limit = int(limit)
+            else:
+                return APIResponse(None, HTTP_RESPONSES["BAD_REQUEST"])
+
+        if not (0 < limit <= MAX_LIMIT):
+            return APIResponse(None, HTTP_RESPONSES["BAD_REQUEST"])
+
+        return self.index.search(bbox_response.content, datetime_response.content, limit, io.BytesIO())
 
 
 def make_web_server(idx: index.Index):
@@ -230,7 +290,129 @@ def parse_bbox(bbox_string: str):
     return APIResponse(s2sphere.LatLngRect(), HTTP_RESPONSES["BAD_REQUEST"])
 
 
-def format_items_url(path: str, collection: str, start_id: str, start: int, bbox: s2sphere.LatLngRect, limit: int):
+def parse_properties(properties_string: str):
+    properties_string = str.strip(properties_string)
+
+    if len(properties_string) == 0:
+        return APIResponse(None, None)
+
+    properties = []
+
+    for name in str.split(properties_string, ","):
+        name = str.strip(name)
+
+        if not PROPERTY_NAME.match(name):
+            return APIResponse(None, HTTP_RESPONSES["BAD_REQUEST"])
+
+        if name not in properties:
+            properties.append(name)
+
+    return APIResponse(properties, None)
+
+
+def parse_ids(ids_string: str):
+    feature_ids = [feature_id for feature_id in map(str.strip, str.split(ids_string, ",")) if len(feature_id) > 0]
+
+    if not (0 < len(feature_ids) <= MAX_LIMIT):
+        return APIResponse(None, HTTP_RESPONSES["BAD_REQUEST"])
+
+    return APIResponse(feature_ids, None)
+
+
+def parse_datetime(datetime_string: str):
+    """An instant or interval, "start/end" with ".." or nothing for an open end, as a time filter."""
+    datetime_string = str.strip(datetime_string)
+
+    if len(datetime_string) == 0:
+        return APIResponse(None, None)
+
+    bounds = str.split(datetime_string, "/")
+    if len(bounds) > 2:
+        return APIResponse(None, HTTP_RESPONSES["BAD_REQUEST"])
+
+    try:
+        times = [None if bound in ("", "..") else cql2.parse_time(bound) for bound in bounds]
+    except cql2.FilterError:
+        return APIResponse(None, HTTP_RESPONSES["BAD_REQUEST"])
+
+    return APIResponse(cql2.TimeRange(times[0], times[-1]), None)
+
+
+def parse_items_query(properties: str, filter_string: str, filter_lang: str, datetime_string: str,
+                      result_type: str = '', thin: str = ''):
+    result_type = str.strip(result_type)
+
+    if result_type not in ("", "results", "hits"):
+        return APIResponse(None, HTTP_RESPONSES["BAD_REQUEST"])
+
+    thin_response = parse_thin(thin)
+
+    if thin_response.http_response is not None:
+        return APIResponse(None, thin_response.http_response)
+
+    properties_response = parse_properties(properties)
+
+    if properties_response.http_response is not None:
+        return APIResponse(None, properties_response.http_response)
+
+    datetime_response = parse_datetime(datetime_string)
+
+    if datetime_response.http_response is not None:
+        return APIResponse(None, datetime_response.http_response)
+
+    item_filter = None
+    link_params = []
+
+    if len(str.strip(filter_string)) > 0:
+        try:
+            item_filter = cql2.parse(filter_string, filter_lang)
+        except cql2.FilterError:
+            return APIResponse(None, HTTP_RESPONSES["BAD_REQUEST"])
+
+        link_params.append(("filter", filter_string))
+        if len(filter_lang) > 0:
+            link_params.append(("filter-lang", filter_lang))
+
+    if datetime_response.content is not None:
+        link_params.append(("datetime", str.strip(datetime_string)))
+
+    if result_type == "hits":
+        link_params.append(("resultType", result_type))
+
+    thin_interval, thin_max = thin_response.content
+    if thin_interval is not None or thin_max is not None:
+        link_params.append(("thin", str.strip(thin)))
+
+    query = ItemsQuery(properties_response.content, cql2.combine([item_filter, datetime_response.content]),
+                       link_params, result_type == "hits", thin_interval, thin_max)
+    return APIResponse(query, None)
+
+
+def parse_thin(thin: str):
+    """(interval seconds, None) from a duration such as PT6H, (None, max features) from a count."""
+    thin = str.strip(thin)
+
+    if len(thin) == 0:
+        return APIResponse((None, None), None)
+
+    if thin.isdigit():
+        if int(thin) <= 0:
+            return APIResponse(None, HTTP_RESPONSES["BAD_REQUEST"])
+        return APIResponse((None, int(thin)), None)
+
+    match = DURATION.match(thin.upper())
+    if match is None:
+        return APIResponse(None, HTTP_RESPONSES["BAD_REQUEST"])
+
+    seconds = sum(float(value) * DURATION_SECONDS[unit] for unit, value in match.groupdict().items()
+                  if value is not None)
+    if seconds <= 0:
+        return APIResponse(None, HTTP_RESPONSES["BAD_REQUEST"])
+    return APIResponse((seconds, None), None)
+
+
+def format_items_url(path: str, collection: str, start_id: str, start: int, bbox: s2sphere.LatLngRect, limit: int,
+                     query: ItemsQuery = None):
     params = []
 
     if len(start_id) > 0:
@@ -247,6 +429,13 @@ def format_items_url(path: str, collection: str, start_id: str, start: int, bbox
     if limit != DEFAULT_LIMIT:
         params.append(str.format("limit={0}", str(limit)))
 
+    if query is not None and query.properties is not None:
+        params.append(str.format("properties={0}", ",".join(query.properties)))
+
+    if query is not None:
+        for name, value in query.link_params:
+            params.append(str.format("{0}={1}", name, quote(value, safe="")))
+
     url = str.format("{0}collections/{1}/items", path, collection)
 
     if len(params) > 0:
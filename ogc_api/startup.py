@@ -0,0 +1,105 @@
+"""Startup timing: how long the app took to import and to answer its first request.
+
+Run as `python -m ogc_api.startup` to check a fresh import against STARTUP_BUDGET,
+it exits with 1 when the import is over budget or pulled in a deferred module.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from ogc_api import metrics
+
+# imported first by ogc_api.main, so this is about when the app started importing
+IMPORT_STARTED = time.perf_counter()
+
+STARTUP_BUDGET = float(os.environ.get("STARTUP_BUDGET", "1.0"))
+# imported on first use instead, erddapy brings pandas, Geometry brings pkg_resources
+DEFERRED_MODULES = ("pandas", "erddapy", "ceotr_erddap_proxy", "Geometry", "pkg_resources", "apscheduler")
+
+logger = logging.getLogger(__name__)
+
+
+class StartupReport:
+    import_seconds: float
+    first_request_seconds: float
+    first_request_path: str
+
+    def __init__(self, started: float = IMPORT_STARTED):
+        self.started = started
+        self.import_seconds = None
+        self.first_request_seconds = None
+        self.first_request_path = None
+        # time from the start of the import to the end of the first request
+        self.ready_seconds = None
+        self.lock = threading.Lock()
+
+    def imported(self):
+        self.import_seconds = time.perf_counter() - self.started
+        metrics.STARTUP_IMPORT_SECONDS.set(self.import_seconds)
+        logger.info("Imported in %.0f ms", self.import_seconds * 1000)
+
+    def record_request(self, path: str, seconds: float):
+        if self.first_request_seconds is not None:
+            return
+
+        with self.lock:
+            if self.first_request_seconds is not None:
+                return
+            self.first_request_path = path
+            self.first_request_seconds = seconds
+            self.ready_seconds = time.perf_counter() - self.started
+
+        metrics.STARTUP_FIRST_REQUEST_SECONDS.set(seconds)
+        logger.info("First request to %s took %.0f ms, %.0f ms after the import started",
+                    path, seconds * 1000, self.ready_seconds * 1000)
+
+    def loaded_deferred_modules(self) -> list[str]:
+        return [name for name in DEFERRED_MODULES if name in sys.modules]
+
+    def to_json(self):
+        return dict(import_seconds=self.import_seconds,
+                    first_request_path=self.first_request_path,
+                    first_request_seconds=self.first_request_seconds,
+                    ready_seconds=self.ready_seconds,
+                    deferred_modules_loaded=self.loaded_deferred_modules())
+
+
+REPORT = StartupReport()
+
+
+def check(budget: float = STARTUP_BUDGET, path: str = "/") -> int:
+    """Imports the app, makes one request to it and prints the report, 1 when over budget."""
+    # run as __main__ this module is a copy, the app reports to the ogc_api.startup one
+    from ogc_api import startup, main
+    from fastapi.testclient import TestClient
+
+    deferred_after_import = startup.REPORT.loaded_deferred_modules()
+
+    # the middleware fills in the first request part of the report
+    TestClient(main.app).get(path)
+
+    report = startup.REPORT.to_json()
+    report["deferred_modules_loaded"] = deferred_after_import
+    report["budget_seconds"] = budget
+    print(json.dumps(report, indent=2))
+
+    if report["import_seconds"] > budget:
+        print(f"Import took {report['import_seconds']:.3f} s, over the {budget} s budget", file=sys.stderr)
+        return 1
+    if len(deferred_after_import) > 0:
+        print(f"Imported at startup: {', '.join(deferred_after_import)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check the app imports within the startup budget")
+    parser.add_argument("--budget", type=float, default=STARTUP_BUDGET, help="seconds allowed for the import")
+    parser.add_argument("--path", default="/", help="path of the first request")
+    args = parser.parse_args()
+
+    sys.exit(check(args.budget, args.path))
@@ -0,0 +1,21 @@
+import pytest
+
+import ogc_api.index
+import ogc_api.server_handler
+from benchmarks.stub_erddap import StubERDDAP
+
+
+@pytest.fixture
+def stub_server(monkeypatch):
+    """Makes the web server for a StubERDDAP, or for several by name served as ERDDAP_SERVERS."""
+
+    def create(stub: StubERDDAP = None, **stubs: StubERDDAP):
+        if stub is not None:
+            monkeypatch.setenv("ERDDAP", stub.url)
+            monkeypatch.delenv("ERDDAP_SERVERS", raising=False)
+        else:
+            monkeypatch.setenv("ERDDAP_SERVERS", ",".join(f"{name}={stub.url}" for name, stub in stubs.items()))
+        return ogc_api.server_handler.make_web_server(
+            ogc_api.index.make_index({}, "https://test.example.org/wfs/", warmup=False))
+
+    return create
@@ -0,0 +1,111 @@
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from erddap_proxy.cache_warmer import CacheWarmer
+from erddap_proxy.erddap_matadata import ERDDAPCollections
+from ogc_api import metrics
+from ogc_api.data_structures import Collection, CollectionMetadata
+
+
+def create_test_collections(ends: dict):
+    collections = ERDDAPCollections("https://erddap.example.org/erddap/")
+    collections.meta.catalogue = {
+        dataset_id: CollectionMetadata(dataset_id, dataset_id, None, interval=[None, end])
+        for dataset_id, end in ends.items()
+    }
+    collections.meta.dataset_types = {dataset_id: "latlon" for dataset_id in ends}
+    collections.meta.catalogue_time = time.monotonic()
+
+    loads = []
+
+    def get_erddap_as_collection(dataset_id, collection, dataset_type=None, extra_variables=()):
+        loads.append(dataset_id)
+        return collection
+
+    collections.data.get_erddap_as_collection = get_erddap_as_collection
+    return collections, loads
+
+
+class TestCacheWarmer:
+    def test_order_by_access_then_active_mission(self):
+        now = datetime.now(timezone.utc)
+        collections, _ = create_test_collections({
+            "old": now - timedelta(days=400),
+            "active": now - timedelta(hours=3),
+            "popular": now - timedelta(days=100),
+            "unknown": None,
+        })
+        collections.access_counts.record("popular")
+
+        warmer = CacheWarmer(collections)
+
+        assert warmer.order_datasets() == ["popular", "active", "old", "unknown"]
+
+    def test_warm_up_loads_hot_set(self):
+        now = datetime.now(timezone.utc)
+        collections, loads = create_test_collections({
+            "a": now, "b": now - timedelta(days=1), "c": now - timedelta(days=2)
+        })
+        warmer = CacheWarmer(collections, workers=2, hot_set_size=2)
+
+        assert not warmer.progress()["ready"]
+
+        warmer.start()
+        warmer.thread.join(timeout=10)
+
+        assert warmer.progress() == dict(state="done", ready=True, hot_set=2, loaded=2, failed=0)
+        assert sorted(loads) == ["a", "b"]
+        assert sorted(collections.cache.keys()) == ["a", "b"]
+        # background loads don't count as popularity
+        assert collections.access_counts.get("a") == 0
+
+    def test_warm_up_counts_failures(self):
+        collections, _ = create_test_collections({"a": None})
+
+        def fail(dataset_id, collection, dataset_type=None, extra_variables=()):
+            raise ValueError("broken dataset")
+
+        collections.data.get_erddap_as_collection = fail
+        warmer = CacheWarmer(collections)
+        warmer.run()
+
+        assert warmer.progress()["failed"] == 1 and warmer.is_ready()
+
+    def test_dataset_loaded_once(self):
+        collections, loads = create_test_collections({"a": None})
+
+        collections.get_collection_as_data("a", background=True)
+        collections.get_collection_as_data("a")
+
+        assert loads == ["a"] and isinstance(collections.cache["a"], Collection)
+        assert collections.access_counts.get("a") == 1
+        assert metrics.CACHE_HITS.get(collection="a") >= 1
+
+    def test_evict_datasets_gone_from_catalogue(self):
+        collections, _ = create_test_collections({"a": None, "b": None})
+        collections.get_collection_as_data("a")
+        collections.get_collection_as_data("b")
+        evictions = metrics.CACHE_EVICTIONS.get(collection="b")
+
+        del collections.meta.catalogue["b"]
+        collections.get_collections()
+
+        assert list(collections.cache.keys()) == ["a"]
+        assert metrics.CACHE_EVICTIONS.get(collection="b") == evictions + 1
+
+
+class TestAccessCounts:
+    def test_save_and_load_with_decay(self, tmp_path):
+        path = os.path.join(tmp_path, "access_counts.json")
+        collections, _ = create_test_collections({})
+        for _ in range(4):
+            collections.access_counts.record("a")
+        collections.access_counts.save(path)
+
+        restarted, _ = create_test_collections({})
+        restarted.access_counts.load(path)
+        restarted.access_counts.record("b")
+
+        assert restarted.access_counts.get("a") == 2
+        assert restarted.access_counts.get("b") == 1
@@ -0,0 +1,102 @@
+import threading
+import time
+
+import geojson
+import pytest
+
+from benchmarks.stub_erddap import StubERDDAP
+from erddap_proxy import conversion
+from erddap_proxy.conversion import Converter
+from erddap_proxy.erddap_matadata import ERDDAPCollections
+from erddap_proxy.shared_cache import MappedBounds, MappedPoints
+from ogc_api import geometry
+
+
+def load(stub: StubERDDAP, dataset_id: str, converter: Converter, chunk_seconds: float = float("inf")):
+    collections = ERDDAPCollections(stub.url)
+    collections.data.converter = converter
+    collections.data.chunk_seconds = chunk_seconds
+    return collections.get_collection_as_data(dataset_id)
+
+
+class TestConverter:
+    def test_worker_same_as_thread(self):
+        # every conversion goes to the one worker process
+        process_converter = Converter(workers=1, offload_bytes=0)
+        with StubERDDAP({"glider_50": 50}) as stub:
+            in_thread = load(stub, "glider_50", Converter(workers=0))
+            try:
+                in_worker = load(stub, "glider_50", process_converter)
+            finally:
+                process_converter.shutdown()
+
+        assert in_worker.id == in_thread.id and in_worker.by_id == in_thread.by_id
+        assert list(in_worker.feature) == list(in_thread.feature)
+        assert [geometry.encode_bbox(rect) for rect in in_worker.bbox] == \
+               [geometry.encode_bbox(rect) for rect in in_thread.bbox]
+        assert geometry.points_array(in_worker.web_mercator).tolist() == \
+               geometry.points_array(in_thread.web_mercator).tolist()
+        for name, column in in_thread.columns.items():
+            assert in_worker.columns[name].tolist() == column.tolist()
+        assert in_worker.metadata.name == "glider_50"
+        assert in_worker.resident_bytes() > 0
+
+    def test_bounds_and_points_computed_in_batch(self):
+        with StubERDDAP({"glider_50": 50}) as stub:
+            collection = load(stub, "glider_50", Converter(workers=0))
+
+        # arrays, not a rect and a point per feature
+        assert isinstance(collection.bbox, MappedBounds) and isinstance(collection.web_mercator, MappedPoints)
+        lat, lon = collection.columns["latitude"], collection.columns["longitude"]
+        for i in range(len(collection.id)):
+            rect = geometry.compute_bounds(geojson.Point((float(lon[i]), float(lat[i])), precision=15))
+            center = geometry.project_web_mercator(rect.get_center())
+            assert geometry.encode_bbox(collection.bbox[i]) == pytest.approx(geometry.encode_bbox(rect))
+            point = collection.web_mercator[i]
+            assert (point.x, point.y) == pytest.approx((center.x, center.y))
+
+    def test_chunks_converted_in_workers(self):
+        process_converter = Converter(workers=2, offload_bytes=0)
+        with StubERDDAP({"glider_50": 50}) as stub:
+            single = load(stub, "glider_50", Converter(workers=0))
+            try:
+                chunked = load(stub, "glider_50", process_converter, chunk_seconds=86400)
+            finally:
+                process_converter.shutdown()
+
+        assert chunked.id == single.id
+        assert list(chunked.feature) == list(single.feature)
+        assert [geometry.encode_bbox(rect) for rect in chunked.bbox] == \
+               [geometry.encode_bbox(rect) for rect in single.bbox]
+        assert chunked.columns["time"].tolist() == single.columns["time"].tolist()
+
+    def test_concurrent_conversions_capped(self, monkeypatch):
+        converter = Converter(workers=0, max_conversions=2)
+        convert_geojson = conversion.convert_geojson
+        running = []
+        most = []
+        lock = threading.Lock()
+
+        def slow_convert(content, collection, default_properties=None):
+            with lock:
+                running.append(content)
+                most.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(content)
+            return convert_geojson(content, collection, default_properties)
+
+        monkeypatch.setattr(conversion, "convert_geojson", slow_convert)
+        with StubERDDAP({"glider_10": 10}) as stub:
+            collections = ERDDAPCollections(stub.url)
+            collections.data.converter = converter
+            threads = [threading.Thread(target=collections.data.get_erddap_as_collection,
+                                        args=("glider_10", collections.meta.create_erddap_collection("glider_10")))
+                       for _ in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert len(most) == 6
+        assert max(most) == 2
@@ -0,0 +1,126 @@
+import math
+
+import numpy as np
+import pytest
+
+from ogc_api import cql2
+
+SEPT_12 = 1662940800.0
+HOUR = 3600.0
+
+COLUMNS = {
+    "time": np.array([SEPT_12 + i * HOUR for i in range(6)], dtype=np.float64),
+    "latitude": np.array([44.0, 44.5, 45.0, 45.5, -10.0, 10.0]),
+    "longitude": np.array([-63.0, -62.5, -62.0, -61.5, 179.5, -179.5]),
+    "temperature": np.array([10.0, 12.5, np.nan, 15.0, 20.0, 8.0]),
+    "profile_id": np.array([1, 2, 3, 4, 5, 6], dtype=np.int64),
+    "platform": np.array(["otn200", "otn201", None, "unit_1", "otn200", "cabot"], dtype=object),
+}
+
+
+def matches(text, lang=""):
+    return np.flatnonzero(cql2.parse(text, lang).mask(COLUMNS, 6)).tolist()
+
+
+class TestText:
+    def test_comparisons(self):
+        assert matches("temperature > 12") == [1, 3, 4]
+        assert matches("12 < temperature") == [1, 3, 4]
+        assert matches("profile_id = 3") == [2]
+        assert matches("temperature <> 10") == [1, 3, 4, 5]
+        assert matches("platform = 'otn200'") == [0, 4]
+
+    def test_logical(self):
+        assert matches("temperature >= 12.5 AND profile_id <= 4") == [1, 3]
+        assert matches("profile_id = 1 or (profile_id = 6 and temperature < 10)") == [0, 5]
+        assert matches("NOT profile_id < 5") == [4, 5]
+
+    def test_predicates(self):
+        assert matches("profile_id BETWEEN 2 AND 4") == [1, 2, 3]
+        assert matches("profile_id NOT BETWEEN 2 AND 4") == [0, 4, 5]
+        assert matches("profile_id IN (1, 5, 9)") == [0, 4]
+        assert matches("temperature IS NULL") == [2]
+        assert matches("platform IS NOT NULL") == [0, 1, 3, 4, 5]
+        assert matches("platform LIKE 'otn%'") == [0, 1, 4]
+        assert matches("platform LIKE 'unit_1'") == [3]
+
+    def test_spatial(self):
+        assert matches("S_INTERSECTS(geometry, BBOX(-62.6, 44.4, -61.0, 46.0))") == [1, 2, 3]
+        # across the antimeridian
+        assert matches("S_INTERSECTS(geometry, BBOX(179, -20, -179, 20))") == [4, 5]
+
+    def test_temporal(self):
+        assert matches("T_AFTER(time, TIMESTAMP('2022-09-12T03:00:00Z'))") == [4, 5]
+        assert matches("T_BEFORE(time, TIMESTAMP('2022-09-12T01:00:00Z'))") == [0]
+        assert matches("T_INTERSECTS(time, INTERVAL('2022-09-12T01:00:00Z', '2022-09-12T02:00:00Z'))") == [1, 2]
+        assert matches("T_DURING(time, INTERVAL('2022-09-12T04:00:00Z', '..'))") == [4, 5]
+        assert matches("time >= TIMESTAMP('2022-09-12T05:00:00Z')") == [5]
+        assert matches("time < '2022-09-12T01:00:00Z'") == [0]
+
+    @pytest.mark.parametrize("text", ["temperature >", "temperature > 1 AND", "(profile_id = 1",
+                                      "profile_id = 1 profile_id = 2", "1 = 2", "temperature ~ 1",
+                                      "T_AFTER(time, 5)", "S_INTERSECTS(geometry, 5)"])
+    def test_malformed(self, text):
+        with pytest.raises(cql2.FilterError):
+            cql2.parse(text)
+
+    def test_unknown_property(self):
+        with pytest.raises(cql2.FilterError):
+            matches("salinity > 30")
+
+
+class TestJSON:
+    def test_same_as_text(self):
+        expression = '{"op": "and", "args": [' \
+                     '{"op": ">", "args": [{"property": "temperature"}, 12]},' \
+                     '{"op": "s_intersects", "args": [{"property": "geometry"}, {"bbox": [-63, 44, -61, 46]}]},' \
+                     '{"op": "t_intersects", "args": [{"property": "time"},' \
+                     ' {"interval": ["2022-09-12T00:00:00Z", ".."]}]}]}'
+        assert matches(expression, "cql2-json") == matches(expression) == [1, 3]
+
+    def test_in_like_null(self):
+        assert matches('{"op": "in", "args": [{"property": "profile_id"}, [2, 3]]}') == [1, 2]
+        assert matches('{"op": "like", "args": [{"property": "platform"}, "%200"]}') == [0, 4]
+        assert matches('{"op": "not", "args": [{"op": "isNull", "args": [{"property": "temperature"}]}]}') == \
+               [0, 1, 3, 4, 5]
+
+    def test_malformed(self):
+        for text in ['{"op": "and"', '{"args": []}', '{"op": "near", "args": []}']:
+            with pytest.raises(cql2.FilterError):
+                cql2.parse(text, "cql2-json")
+
+    def test_unsupported_language(self):
+        with pytest.raises(cql2.FilterError):
+            cql2.parse("temperature > 1", "ecql")
+
+
+class TestConstraints:
+    def test_conjunction_pushed_down(self):
+        expression = cql2.parse("temperature > 12 AND profile_id BETWEEN 2 AND 4 AND platform LIKE 'otn%' AND "
+                                "S_INTERSECTS(geometry, BBOX(-63, 44, -61, 46)) AND "
+                                "T_AFTER(time, TIMESTAMP('2022-09-12T03:00:00Z'))")
+        constraints = dict(expression.constraints())
+
+        assert constraints["temperature>"] == 12
+        assert constraints["profile_id>="] == 2 and constraints["profile_id<="] == 4
+        assert constraints["platform=~"] == "otn.*"
+        assert constraints["latitude>="] == 44 and constraints["longitude<="] == -61
+        assert constraints["time>"].timestamp() == SEPT_12 + 3 * HOUR
+
+    def test_only_exact_parts_pushed_down(self):
+        assert cql2.parse("profile_id = 1 OR profile_id = 2").constraints() == []
+        assert cql2.parse("NOT profile_id = 1").constraints() == []
+        assert cql2.parse("profile_id IN (1, 2)").constraints() == []
+        assert cql2.parse("profile_id = 1 AND (profile_id = 2 OR temperature IS NULL)").constraints() == \
+               [("profile_id=", 1)]
+        # longitude across the antimeridian is left to the mask
+        assert [key for key, _ in cql2.parse("S_INTERSECTS(geometry, BBOX(179, -20, -179, 20))").constraints()] == \
+               ["latitude>=", "latitude<="]
+
+    def test_combine(self):
+        assert cql2.combine([None, None]) is None
+        time_range = cql2.TimeRange(SEPT_12 + 4 * HOUR)
+        assert cql2.combine([None, time_range]) is time_range
+        combined = cql2.combine([cql2.parse("profile_id < 6"), time_range])
+        assert np.flatnonzero(combined.mask(COLUMNS, 6)).tolist() == [4]
+        assert not math.isnan(combined.constraints()[0][1])
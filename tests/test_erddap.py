@@ -0,0 +1,626 @@
+import io
+import json
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+import requests
+import s2sphere
+
+import ogc_api.index
+import ogc_api.server_handler
+from benchmarks.stub_erddap import StubERDDAP
+from erddap_proxy import erddap_matadata, upstream
+from erddap_proxy.erddap_matadata import ERDDAPCollections
+from ogc_api import geometry
+
+ALL_DATASETS = {
+    "table": {
+        "columnNames": erddap_matadata.CATALOGUE_VARIABLES,
+        "rows": [
+            ["allDatasets", "* The List of All Active Datasets in this ERDDAP *",
+             -180.0, 180.0, -90.0, 90.0, None, None],
+            ["otn200_20220912_116_delayed", "OTN glider otn200 mission 116",
+             -63.6, -62.1, 43.9, 44.6, "2022-09-12T15:01:22Z", "2022-10-01T10:44:13Z"],
+            ["bonavista_20230601", "Bonavista line", None, None, None, None, "2023-06-01T00:00:00Z", None],
+        ]
+    }
+}
+
+
+def categorize(*dataset_ids):
+    return {"table": {"columnNames": ["Accessible", "Title", "Dataset ID"],
+                      "rows": [["public", dataset_id, dataset_id] for dataset_id in dataset_ids]}}
+
+
+class FakeResponse:
+    def __init__(self, payload, status_code=200):
+        self.payload = payload
+        self.status_code = status_code
+        self.content = json.dumps(payload).encode("utf8")
+
+    def json(self):
+        return self.payload
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(str(self.status_code))
+
+
+def fake_erddap(monkeypatch, responses: dict):
+    calls = []
+
+    def get(url, **kwargs):
+        calls.append(url)
+        for path, payload in responses.items():
+            if path in url:
+                if isinstance(payload, Exception):
+                    raise payload
+                return FakeResponse(payload)
+        return FakeResponse({}, status_code=404)
+
+    monkeypatch.setattr(erddap_matadata.requests, "get", get)
+    return calls
+
+
+class TestCatalogue:
+    def test_catalogue_from_all_datasets(self, monkeypatch):
+        calls = fake_erddap(monkeypatch, {"/tabledap/allDatasets.json": ALL_DATASETS})
+        collections = ERDDAPCollections("https://erddap.example.org/erddap/")
+
+        catalogue = collections.meta.get_catalogue()
+        collections.meta.get_catalogue()
+
+        assert len([call for call in calls if "allDatasets" in call]) == 1
+        assert list(catalogue.keys()) == ["otn200_20220912_116_delayed", "bonavista_20230601"]
+
+        glider = catalogue["otn200_20220912_116_delayed"]
+        assert glider.title == "OTN glider otn200 mission 116"
+        assert glider.bbox == [-63.6, 43.9, -62.1, 44.6]
+        assert glider.interval[0].isoformat() == "2022-09-12T15:01:22+00:00"
+
+        line = catalogue["bonavista_20230601"]
+        assert line.bbox is None
+        assert line.interval[1] is None
+
+    def test_catalogue_refresh_failure_keeps_previous(self, monkeypatch):
+        fake_erddap(monkeypatch, {"/tabledap/allDatasets.json": ALL_DATASETS})
+        collections = ERDDAPCollections("https://erddap.example.org/erddap/")
+        collections.meta.get_catalogue()
+
+        fake_erddap(monkeypatch, {"/tabledap/allDatasets.json": requests.ConnectionError("down")})
+        collections.meta.refresh_catalogue()
+
+        assert "otn200_20220912_116_delayed" in collections.meta.get_catalogue()
+
+    def test_stale_catalogue_served_while_refreshing(self, monkeypatch):
+        fake_erddap(monkeypatch, {"/tabledap/allDatasets.json": ALL_DATASETS})
+        meta = ERDDAPCollections("https://erddap.example.org/erddap/").meta
+        first = meta.get_catalogue()
+        meta.catalogue_time -= meta.ttl + 1
+
+        # ERDDAP is down, allDatasets answers 404 once released
+        calls = fake_erddap(monkeypatch, {})
+        get = erddap_matadata.requests.get
+        release = threading.Event()
+
+        def slow_get(url, **kwargs):
+            release.wait(5)
+            return get(url, **kwargs)
+
+        monkeypatch.setattr(erddap_matadata.requests, "get", slow_get)
+        assert meta.get_catalogue() is first
+        assert meta.get_catalogue() is first
+        release.set()
+        meta.refreshing.result(5)
+
+        assert meta.failed_at is not None
+        assert meta.get_catalogue() is first
+        # not asked again until REFRESH_RETRY_INTERVAL has passed
+        assert len([call for call in calls if "allDatasets" in call]) == 1
+
+    def test_failed_first_catalogue_not_retried_at_once(self, monkeypatch):
+        calls = fake_erddap(monkeypatch, {})
+        meta = ERDDAPCollections("https://erddap.example.org/erddap/").meta
+
+        assert meta.get_catalogue() == {}
+        assert meta.get_catalogue() == {}
+        assert len([call for call in calls if "allDatasets" in call]) == 1
+
+        meta.failed_at -= erddap_matadata.REFRESH_RETRY_INTERVAL
+        fake_erddap(monkeypatch, {"/tabledap/allDatasets.json": ALL_DATASETS})
+        assert "bonavista_20230601" in meta.get_catalogue()
+        assert meta.failed_at is None
+
+    def test_collections_include_extent(self, monkeypatch):
+        calls = fake_erddap(monkeypatch, {"/tabledap/allDatasets.json": ALL_DATASETS})
+        server = ogc_api.server_handler.make_web_server(
+            ogc_api.index.make_index({}, "https://test.example.org/wfs/"))
+
+        response = json.loads(server.handle_collections_request().content)
+        collection = response["collections"][0]
+
+        assert len([call for call in calls if "allDatasets" in call]) == 1
+        assert collection["title"] == "OTN glider otn200 mission 116"
+        assert collection["extent"]["spatial"]["bbox"] == [[-63.6, 43.9, -62.1, 44.6]]
+        assert collection["extent"]["temporal"]["interval"] == [["2022-09-12T15:01:22Z", "2022-10-01T10:44:13Z"]]
+        assert "spatial" not in response["collections"][1]["extent"]
+
+
+class TestDatasetTypes:
+    def test_types_resolved_with_catalogue(self, monkeypatch):
+        calls = fake_erddap(monkeypatch, {
+            "/tabledap/allDatasets.json": ALL_DATASETS,
+            "/categorize/variableName/m_gps_lat/": categorize("otn200_20220912_116_delayed", "not_in_catalogue"),
+            "/categorize/variableName/profile_id/": categorize("otn200_20220912_116_delayed"),
+        })
+        collections = ERDDAPCollections("https://erddap.example.org/erddap/")
+        collections.meta.get_catalogue()
+
+        assert len(calls) == 3
+        assert collections.get_dataset_type("otn200_20220912_116_delayed") == "m_gps"
+        assert collections.get_dataset_type("bonavista_20230601") == "latlon"
+        assert len(calls) == 3
+
+    def test_types_fall_back_to_dataset_info(self, monkeypatch):
+        calls = fake_erddap(monkeypatch, {
+            "/tabledap/allDatasets.json": ALL_DATASETS,
+            "/categorize/": requests.ConnectionError("down"),
+            "/info/bonavista_20230601/index.json": {"table": {
+                "columnNames": ["Row Type", "Variable Name", "Attribute Name", "Data Type", "Value"],
+                "rows": [["attribute", "NC_GLOBAL", "title", "String", "m_gps_lat"],
+                         ["variable", "profile_id", "", "int", ""],
+                         ["variable", "time", "", "double", ""]]}},
+        })
+        collections = ERDDAPCollections("https://erddap.example.org/erddap/")
+        collections.meta.get_catalogue()
+
+        assert collections.get_dataset_type("bonavista_20230601") == "profile_id"
+        assert collections.get_dataset_type("bonavista_20230601") == "profile_id"
+        assert len([call for call in calls if "/info/" in call]) == 1
+
+        # a refresh that can't reach the categorize service keeps the type found before
+        collections.meta.refresh_catalogue()
+        assert collections.meta.get_dataset_type("bonavista_20230601") == "profile_id"
+
+
+class TestStubERDDAP:
+    def test_load_collection_from_stub(self, stub_server):
+        with StubERDDAP({"glider_50": 50}) as stub:
+            index = stub_server(stub).index
+
+            min_lon, max_lon, min_lat, max_lat = stub.datasets["glider_50"].extent()
+            bbox = s2sphere.LatLngRect.from_point_pair(s2sphere.LatLng.from_degrees(min_lat, min_lon),
+                                                       s2sphere.LatLng.from_degrees(max_lat, max_lon))
+            response = index.get_items("glider_50", "", 0, 20, bbox, True, io.BytesIO())
+
+        content = json.loads(response.content)
+        features = content["features"]
+        assert len(features) == 20
+        assert features[0]["properties"] == {"time": "2022-09-12T00:00:00Z", "profile_id": 1}
+        assert [link["rel"] for link in content["links"]] == ["self", "next"]
+        assert index.erddap_collections.get_dataset_type("glider_50") == "m_gps"
+
+
+class TestProperties:
+    def test_configured_variables_not_encoded_by_default(self, monkeypatch, stub_server):
+        monkeypatch.setattr(erddap_matadata, "EXTRA_VARIABLES", "glider_*=temperature,salinity;other=depth")
+
+        with StubERDDAP({"glider_10": 10}) as stub:
+            server = stub_server(stub)
+            response = server.handle_items_request("glider_10", "", 0, "", "5")
+            selected = server.handle_items_request("glider_10", "", 0, "", "5", "salinity,temperature")
+
+        collection = server.index.erddap_collections.cache["glider_10"]
+        assert sorted(collection.columns.keys()) == ["latitude", "longitude", "profile_id", "salinity",
+                                                     "temperature", "time"]
+        assert json.loads(response.content)["features"][0]["properties"] == \
+               {"time": "2022-09-12T00:00:00Z", "profile_id": 1}
+
+        feature = json.loads(selected.content)["features"][1]
+        assert list(feature["properties"].keys()) == ["salinity", "temperature"]
+        assert feature["properties"]["temperature"] == 10.1
+        assert feature["geometry"] == json.loads(response.content)["features"][1]["geometry"]
+        # everything was in the first download
+        assert len([r for r in stub.requests if "/tabledap/glider_10." in r]) == 1
+
+    def test_requested_variables_fetched_as_columns(self, stub_server):
+        with StubERDDAP({"glider_10": 10}) as stub:
+            server = stub_server(stub)
+            first = server.handle_items_request("glider_10", "", 0, "", "3", "time,temperature")
+            second = server.handle_items_request("glider_10", "", 0, "", "3", "temperature")
+
+        downloads = [r for r in stub.requests if "/tabledap/glider_10." in r]
+        assert len(downloads) == 2
+        assert downloads[1].startswith("/erddap/tabledap/glider_10.json?time,temperature&")
+
+        features = json.loads(first.content)["features"]
+        assert features[2]["properties"] == {"time": "2022-09-12T06:00:00Z", "temperature": 10.2}
+        assert json.loads(second.content)["links"][0]["href"].endswith("properties=temperature")
+        assert server.index.erddap_collections.get_extra_variables("glider_10") == ["temperature"]
+
+    def test_unknown_or_malformed_property(self, stub_server):
+        with StubERDDAP({"glider_10": 10}) as stub:
+            server = stub_server(stub)
+            unknown = server.handle_items_request("glider_10", "", 0, "", "3", "no_such_variable")
+            malformed = server.handle_items_request("glider_10", "", 0, "", "3", "time&depth>5")
+            collections = server.index.erddap_collections
+            collections.evict("glider_10")
+            # the refused variable isn't asked for again
+            reloaded = server.handle_items_request("glider_10", "", 0, "", "3")
+            filtered = server.handle_items_request("glider_10", "", 0, "", "3", "", "profile_id <= 2")
+
+        assert unknown.http_response.status_code == 400
+        assert malformed.http_response.status_code == 400
+        assert collections.get_extra_variables("glider_10") == []
+        assert reloaded.http_response is None
+        assert filtered.http_response is None
+
+    def test_erddap_error_not_a_bad_request(self, stub_server):
+        with StubERDDAP({"glider_10": 10}) as stub:
+            server = stub_server(stub)
+            handle = stub.handle
+
+            def fail(path, query):
+                if "/tabledap/glider_10." in path:
+                    return 500, "text/plain", b"Error {\n    code=500;\n}"
+                return handle(path, query)
+
+            stub.handle = fail
+            # the server answers a 500 for these, not a 400 blaming the request
+            with pytest.raises(requests.HTTPError):
+                server.handle_items_request("glider_10", "", 0, "", "3")
+            with pytest.raises(requests.HTTPError):
+                server.handle_items_request("glider_10", "", 0, "", "3", "temperature")
+            with pytest.raises(requests.HTTPError):
+                server.handle_items_request("glider_10", "", 0, "", "3", "", "profile_id <= 2")
+            refused = server.handle_items_request("glider_10", "", 0, "", "3", "", '{"op":"=","args":'
+                                                  '[{"property":"no such"},1]}', "cql2-json")
+
+        assert refused.http_response.status_code == 400
+
+    def test_bad_start(self, stub_server):
+        with StubERDDAP({"glider_10": 10}) as stub:
+            server = stub_server(stub)
+            negative = server.handle_items_request("glider_10", "", -2, "", "3")
+            unknown = server.handle_items_request("glider_10", "no-such-id", 0, "", "3")
+            last = server.handle_items_request("glider_10", "", 9, "", "3")
+
+        assert negative.http_response.status_code == 400
+        assert unknown.http_response.status_code == 400
+        assert len(json.loads(last.content)["features"]) == 1
+
+
+class TestFilter:
+    def test_uncached_filter_pushed_to_erddap(self, stub_server):
+        with StubERDDAP({"glider_50": 50}) as stub:
+            server = stub_server(stub)
+            response = server.handle_items_request("glider_50", "", 0, "", "100", "",
+                                                   "temperature > 12 AND profile_id <= 30")
+
+        downloads = [r for r in stub.requests if "/tabledap/glider_50." in r]
+        assert len(downloads) == 1
+        assert "&temperature>12" in downloads[0] and "&profile_id<=30" in downloads[0]
+        assert "glider_50" not in server.index.erddap_collections.cache
+
+        features = json.loads(response.content)["features"]
+        expected = [row["profile_id"] for row in stub.datasets["glider_50"].rows
+                    if row["temperature"] > 12 and row["profile_id"] <= 30]
+        assert len(expected) > 0
+        assert [feature["properties"]["profile_id"] for feature in features] == expected
+        # the filter's variables are loaded to evaluate it, not returned
+        assert list(features[0]["properties"].keys()) == ["time", "profile_id"]
+
+    def test_cached_filter_evaluated_locally(self, stub_server):
+        with StubERDDAP({"glider_50": 50}) as stub:
+            server = stub_server(stub)
+            server.handle_items_request("glider_50", "", 0, "", "1")
+            first = server.handle_items_request("glider_50", "", 0, "", "5", "",
+                                                "profile_id > 20 AND T_BEFORE(time, TIMESTAMP('2022-09-16T00:00:00Z'))")
+            second = json.loads(first.content)["links"][1]["href"]
+            page = server.handle_items_request("glider_50", second.partition("start_id=")[2].partition("&")[0],
+                                               5, "", "5", "", "profile_id > 20",
+                                               datetime="../2022-09-16T00:00:00Z")
+
+        # 2022-09-16 is 32 surfacings after the start
+        assert [f["properties"]["profile_id"] for f in json.loads(first.content)["features"]] == [21, 22, 23, 24, 25]
+        assert [f["properties"]["profile_id"] for f in json.loads(page.content)["features"]] == [26, 27, 28, 29, 30]
+        assert "filter=profile_id%20%3E%2020%20AND%20T_BEFORE" in second
+        assert len([r for r in stub.requests if "/tabledap/glider_50." in r]) == 1
+
+    def test_cached_filter_on_new_variable(self, stub_server):
+        with StubERDDAP({"glider_10": 10}) as stub:
+            server = stub_server(stub)
+            server.handle_items_request("glider_10", "", 0, "", "1")
+            response = server.handle_items_request("glider_10", "", 0, "", "10", "",
+                                                   '{"op": ">=", "args": [{"property": "temperature"}, 10.1]}',
+                                                   "cql2-json")
+
+        features = json.loads(response.content)["features"]
+        assert [feature["properties"]["profile_id"] for feature in features] == list(range(2, 11))
+        assert "temperature" in server.index.erddap_collections.cache["glider_10"].columns
+
+    def test_empty_and_bad_filters(self, stub_server):
+        with StubERDDAP({"glider_10": 10}) as stub:
+            server = stub_server(stub)
+            empty = server.handle_items_request("glider_10", "", 0, "", "10", "", "profile_id > 100")
+            unknown = server.handle_items_request("glider_10", "", 0, "", "10", "", "no_such_variable > 1")
+            malformed = server.handle_items_request("glider_10", "", 0, "", "10", "", "profile_id >")
+            bad_time = server.handle_items_request("glider_10", "", 0, "", "10", datetime="yesterday")
+
+        assert json.loads(empty.content)["features"] == []
+        assert unknown.http_response.status_code == 400
+        assert malformed.http_response.status_code == 400
+        assert bad_time.http_response.status_code == 400
+
+
+class TestItemsById:
+    def test_single_item(self, stub_server):
+        with StubERDDAP({"glider_10": 10}) as stub:
+            server = stub_server(stub)
+            response = server.handle_item_request("glider_10", "1662940800")
+            missing = server.handle_item_request("glider_10", "123")
+            no_collection = server.handle_item_request("no_such_glider", "1662940800")
+
+        collection = server.index.erddap_collections.cache["glider_10"]
+        assert response.content == collection.feature[0].encode("utf8")
+        assert json.loads(response.content)["properties"] == {"time": "2022-09-12T00:00:00Z", "profile_id": 1}
+        assert missing.http_response.status_code == 404
+        assert no_collection.http_response.status_code == 404
+
+    def test_many_items(self, stub_server):
+        with StubERDDAP({"glider_10": 10}) as stub:
+            server = stub_server(stub)
+            collection = server.index.erddap_collections.get_collection_as_data("glider_10")
+            ids = [collection.id[7], "123", collection.id[2], collection.id[7]]
+            response = server.handle_items_by_id_request("glider_10", ",".join(ids))
+            selected = server.handle_items_by_id_request("glider_10", collection.id[3], "temperature")
+
+        features = json.loads(response.content)
+        assert features["numberReturned"] == 3
+        assert [feature["properties"]["profile_id"] for feature in features["features"]] == [8, 3, 8]
+        assert json.loads(selected.content)["features"][0]["properties"] == {"temperature": 10.3}
+
+    def test_bad_ids(self, stub_server):
+        with StubERDDAP({"glider_10": 10}) as stub:
+            server = stub_server(stub)
+            empty = server.handle_items_by_id_request("glider_10", " , ")
+            too_many = server.handle_items_by_id_request("glider_10", ",".join(map(str, range(1001))))
+
+        assert empty.http_response.status_code == 400
+        assert too_many.http_response.status_code == 400
+
+
+class TestCounts:
+    def test_number_matched_and_returned(self, stub_server):
+        with StubERDDAP({"glider_50": 50}) as stub:
+            server = stub_server(stub)
+            first = json.loads(server.handle_items_request("glider_50", "", 0, "", "20").content)
+            last = json.loads(server.handle_items_request("glider_50", "", 40, "", "20").content)
+            filtered = json.loads(server.handle_items_request("glider_50", "", 0, "", "20", "",
+                                                              "profile_id BETWEEN 11 AND 15").content)
+
+        assert (first["numberMatched"], first["numberReturned"]) == (50, 20)
+        assert (last["numberMatched"], last["numberReturned"]) == (50, 10)
+        assert (filtered["numberMatched"], filtered["numberReturned"]) == (5, 5)
+
+    def test_hits(self, stub_server):
+        with StubERDDAP({"glider_50": 50}) as stub:
+            server = stub_server(stub)
+            hits = json.loads(server.handle_items_request("glider_50", "", 0, "", "10",
+                                                          datetime="2022-09-13T00:00:00Z/..",
+                                                          result_type="hits").content)
+            bad = server.handle_items_request("glider_50", "", 0, "", "10", result_type="count")
+
+        # a surfacing every 3 hours, the first 8 are on the 12th
+        assert (hits["numberMatched"], hits["numberReturned"]) == (42, 0)
+        assert hits["features"] == []
+        assert [link["rel"] for link in hits["links"]] == ["self"]
+        assert hits["links"][0]["href"].endswith("resultType=hits")
+        assert bad.http_response.status_code == 400
+
+
+def create_refreshing_collections(**kwargs):
+    collections = ERDDAPCollections("https://erddap.example.org/erddap/", **kwargs)
+    collections.meta.catalogue = {"glider": erddap_matadata.CollectionMetadata("glider", "glider", None)}
+    collections.meta.dataset_types = {"glider": "latlon"}
+    collections.meta.catalogue_time = time.monotonic()
+
+    release = threading.Event()
+    release.set()
+    loads = []
+
+    def get_erddap_as_collection(dataset_id, collection, dataset_type=None, extra_variables=()):
+        release.wait(5)
+        loads.append(dataset_id)
+        collection.id = [str(len(loads))]
+        return collection
+
+    collections.data.get_erddap_as_collection = get_erddap_as_collection
+    return collections, loads, release
+
+
+class TestRefresh:
+    def test_stale_served_while_refreshing(self):
+        collections, loads, release = create_refreshing_collections(ttl=60, max_staleness=3600)
+        first = collections.get_collection_as_data("glider")
+        first.fetched_at -= 120
+
+        release.clear()
+        stale = collections.get_collection_as_data("glider")
+        again = collections.get_collection_as_data("glider")
+        assert stale is first and again is first
+
+        release.set()
+        refreshed = collections.refreshes.get("glider").result(5)
+
+        assert loads == ["glider", "glider"]
+        assert refreshed.id == ["2"] and collections.cache["glider"] is refreshed
+        # the old version readers may still hold is left alone
+        assert first.id == ["1"]
+        assert collections.get_collection_as_data("glider") is refreshed
+
+    def test_too_stale_waits_for_new_version(self):
+        collections, loads, _ = create_refreshing_collections(ttl=60, max_staleness=600)
+        collections.get_collection_as_data("glider").fetched_at -= 1000
+
+        assert collections.get_collection_as_data("glider").id == ["2"]
+
+    def test_failed_refresh_keeps_stale(self, monkeypatch):
+        collections, loads, _ = create_refreshing_collections(ttl=60, max_staleness=3600)
+        first = collections.get_collection_as_data("glider")
+        first.fetched_at -= 120
+
+        def fail(dataset_id, collection, dataset_type=None, extra_variables=()):
+            raise requests.ConnectionError("ERDDAP is down")
+
+        collections.data.get_erddap_as_collection = fail
+        assert collections.schedule_refresh("glider").result(5) is first
+        # not retried right away
+        assert collections.schedule_refresh("glider").done()
+        assert collections.get_collection_as_data("glider") is first
+
+    def test_unexpected_refresh_error_keeps_stale(self):
+        collections, loads, _ = create_refreshing_collections(ttl=60, max_staleness=600)
+        first = collections.get_collection_as_data("glider")
+        first.fetched_at -= 1000
+        load = collections.data.get_erddap_as_collection
+
+        def fail(dataset_id, collection, dataset_type=None, extra_variables=()):
+            raise BrokenProcessPool("a conversion worker exited")
+
+        collections.data.get_erddap_as_collection = fail
+        # past the staleness limit the request waits for the refresh, and gets the old version
+        assert collections.get_collection_as_data("glider") is first
+        assert "glider" not in collections.refreshes
+
+        collections.refresh_failures.clear()
+        collections.data.get_erddap_as_collection = load
+        assert collections.get_collection_as_data("glider").id == ["2"]
+
+    def test_freshness_header(self, stub_server):
+        with StubERDDAP({"glider_10": 10}) as stub:
+            server = stub_server(stub)
+            server.handle_items_request("glider_10", "", 0, "", "1")
+            server.index.erddap_collections.cache["glider_10"].fetched_at -= 30
+            response = server.handle_items_request("glider_10", "", 0, "", "1")
+            item = server.handle_item_request("glider_10", "1662940800")
+
+        assert 30 <= int(response.headers["Age"]) < 40
+        assert "Age" in item.headers
+
+
+class TestUpstreamBusy:
+    def test_503_with_retry_after(self, monkeypatch, stub_server):
+        with StubERDDAP({"glider_10": 10}) as stub:
+            server = stub_server(stub)
+            server.index.erddap_collections.meta.get_catalogue()
+            # nothing can be queued, every download is refused
+            monkeypatch.setattr(upstream, "UPSTREAM", upstream.Upstream(concurrency=0, queue_depth=0))
+            response = server.handle_items_request("glider_10", "", 0, "", "10")
+            item = server.handle_item_request("glider_10", "1662940800")
+
+        assert response.http_response.status_code == 503
+        assert int(response.headers["Retry-After"]) >= 1
+        assert item.http_response.status_code == 503
+
+
+class TestChunkedDownload:
+    def test_time_windows(self):
+        rows = erddap_matadata.table_rows(ALL_DATASETS)
+        metadata = erddap_matadata.parse_catalogue_row(rows[1])
+        windows = erddap_matadata.time_windows(metadata, 7 * 86400)
+
+        assert len(windows) == 3
+        assert windows[0][0] is None and windows[-1][1] is None
+        assert windows[0][1] == windows[1][0] and windows[1][1] == windows[2][0]
+        assert erddap_matadata.time_windows(metadata, 30 * 86400) == [(None, None)]
+        assert len(erddap_matadata.time_windows(metadata, 3600, max_chunks=8)) == 8
+        # no coverage in the catalogue, nothing to split
+        open_ended = erddap_matadata.parse_catalogue_row(rows[2])
+        assert erddap_matadata.time_windows(open_ended, 3600) == [(None, None)]
+
+    def test_chunked_same_as_single_download(self, stub_server):
+        with StubERDDAP({"glider_50": 50}) as stub:
+            server = stub_server(stub)
+            collections = server.index.erddap_collections
+            single = collections.get_collection_as_data("glider_50")
+            collections.evict("glider_50")
+
+            collections.data.chunk_seconds = 86400
+            chunked = collections.get_collection_as_data("glider_50")
+
+        downloads = [r for r in stub.requests if "/tabledap/glider_50." in r]
+        # one plain download, then a window per day of the mission
+        assert len(downloads) == 1 + 7
+        assert chunked is not single
+        assert chunked.id == single.id
+        assert chunked.by_id == single.by_id
+        assert list(chunked.feature) == list(single.feature)
+        assert geometry.bounds_array(chunked.bbox).tolist() == geometry.bounds_array(single.bbox).tolist()
+        assert geometry.points_array(chunked.web_mercator).tolist() == \
+               geometry.points_array(single.web_mercator).tolist()
+        assert chunked.columns.keys() == single.columns.keys()
+        for name, column in single.columns.items():
+            assert chunked.columns[name].tolist() == column.tolist()
+        assert chunked.metadata.name == "glider_50"
+
+    def test_failed_window_retried_alone(self, stub_server):
+        with StubERDDAP({"glider_50": 50}) as stub:
+            server = stub_server(stub)
+            collections = server.index.erddap_collections
+            collections.data.chunk_seconds = 86400
+            windows = erddap_matadata.time_windows(collections.get_collection_as_meta("glider_50").metadata, 86400)
+            failing = f"time<{windows[2][1]}"
+
+            handle = stub.handle
+            failures = []
+
+            def fail_once(path, query):
+                if failing in query and len(failures) == 0:
+                    failures.append(query)
+                    stub.requests.append(path + "?" + query)
+                    return 500, "text/plain", b"Error"
+                return handle(path, query)
+
+            stub.handle = fail_once
+            collection = collections.get_collection_as_data("glider_50")
+
+        downloads = [r for r in stub.requests if "/tabledap/glider_50." in r]
+        assert len(failures) == 1
+        assert len(downloads) == len(windows) + 1
+        assert len([r for r in downloads if failing in r]) == 2
+        assert len(collection.id) == 50
+
+
+class TestThinning:
+    def test_one_feature_per_bucket(self, stub_server):
+        with StubERDDAP({"glider_50": 50}) as stub:
+            server = stub_server(stub)
+            response = server.handle_items_request("glider_50", "", 0, "", "10", thin="PT6H")
+            first_day = server.handle_items_request("glider_50", "", 0, "", "100", datetime="2022-09-12T00:00:00Z/"
+                                                    "2022-09-12T23:59:59Z", thin="PT6H")
+            bad = server.handle_items_request("glider_50", "", 0, "", "10", thin="P1M")
+
+        content = json.loads(response.content)
+        # surfacings every 3 hours, every other one is kept
+        assert content["numberMatched"] == 25 and content["numberReturned"] == 10
+        assert [f["properties"]["profile_id"] for f in content["features"]] == list(range(1, 21, 2))
+        next_link = content["links"][1]["href"]
+        assert "thin=PT6H" in next_link and "start=10" in next_link
+
+        assert [f["properties"]["time"][11:13] for f in json.loads(first_day.content)["features"]] == \
+               ["00", "06", "12", "18"]
+        assert bad.http_response.status_code == 400
+
+    def test_at_most_count_over_time(self, stub_server):
+        with StubERDDAP({"glider_50": 50}) as stub:
+            server = stub_server(stub)
+            response = server.handle_items_request("glider_50", "", 0, "", "100", thin="10")
+            few = server.handle_items_request("glider_50", "", 0, "", "100", filter="profile_id <= 5", thin="10")
+
+        profile_ids = [f["properties"]["profile_id"] for f in json.loads(response.content)["features"]]
+        # the first of each tenth of the mission
+        assert profile_ids == list(range(1, 50, 5))
+        assert json.loads(few.content)["numberMatched"] == 5
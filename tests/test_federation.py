@@ -0,0 +1,104 @@
+import json
+import time
+
+import pytest
+
+from benchmarks.stub_erddap import StubERDDAP
+from erddap_proxy import federation
+from erddap_proxy.shared_cache import safe_name
+
+
+class TestServers:
+    def test_parse_servers(self):
+        servers = federation.parse_servers(" otn=https://erddap.oceantrack.org/erddap/, ioos=https://gliders.ioos.us/erddap/,")
+
+        assert servers == {"otn": "https://erddap.oceantrack.org/erddap/", "ioos": "https://gliders.ioos.us/erddap/"}
+        assert federation.parse_servers("") == {}
+
+    @pytest.mark.parametrize("value", ["https://erddap.oceantrack.org/erddap/", "o:tn=https://a/erddap/",
+                                       "otn=", "otn=https://a/erddap/,otn=https://b/erddap/"])
+    def test_bad_servers(self, value):
+        with pytest.raises(ValueError):
+            federation.parse_servers(value)
+
+    def test_ids(self):
+        assert federation.split_id(federation.join_id("otn", "glider_10")) == ("otn", "glider_10")
+        assert federation.split_id("glider_10") == ("", "glider_10")
+        assert safe_name("a:b_c") != safe_name("a_b:c")
+
+
+class TestFederation:
+    def test_namespaced_collections(self, stub_server):
+        with StubERDDAP({"glider_10": 10}) as otn, StubERDDAP({"glider_10": 10, "glider_20": 20}) as ioos:
+            server = stub_server(otn=otn, ioos=ioos)
+            collections = server.handle_collections_request()
+            otn_items = server.handle_items_request("otn:glider_10", "", 0, "", "100")
+            ioos_items = server.handle_items_request("ioos:glider_20", "", 0, "", "5")
+            missing = server.handle_items_request("glider_10", "", 0, "", "5")
+            link = json.loads(ioos_items.content)["links"][1]["href"]
+
+        ids = [collection["id"] for collection in json.loads(collections.content)["collections"]]
+        assert sorted(ids) == ["ioos:glider_10", "ioos:glider_20", "otn:glider_10"]
+        assert len(json.loads(otn_items.content)["features"]) == 10
+        assert "/collections/ioos:glider_20/items" in link
+        assert missing.http_response.status_code == 404
+        # each dataset came from its own server
+        assert any("/tabledap/glider_20." in r for r in ioos.requests)
+        assert not any("/tabledap/glider_20." in r for r in otn.requests)
+        assert len([r for r in otn.requests if "/tabledap/glider_10." in r]) == 1
+
+    def test_slow_server_doesnt_hold_up_catalogue(self, stub_server):
+        with StubERDDAP({"glider_10": 10}) as fast, StubERDDAP({"glider_20": 20}, latency=0.5) as slow:
+            server = stub_server(fast=fast, slow=slow)
+            meta = server.index.erddap_collections.meta
+            meta.timeout = 0.1
+
+            start = time.perf_counter()
+            first = meta.get_catalogue()
+            seconds = time.perf_counter() - start
+
+            meta.refreshes["slow"].result(10)
+            second = meta.get_catalogue()
+
+        assert seconds < 0.5
+        assert list(first.keys()) == ["fast:glider_10"]
+        assert sorted(second.keys()) == ["fast:glider_10", "slow:glider_20"]
+        assert second["slow:glider_20"].title == "Synthetic glider glider_20"
+        # nothing changed since, the merged catalogue is reused
+        assert meta.get_catalogue() is second
+
+    def test_refresh_doesnt_hold_up_requests(self, stub_server):
+        with StubERDDAP({"glider_10": 10}) as fast, StubERDDAP({"glider_20": 20}) as slow:
+            server = stub_server(fast=fast, slow=slow)
+            meta = server.index.erddap_collections.meta
+            meta.timeout = 1
+            first = meta.get_catalogue()
+
+            slow.latency = 0.5
+            meta.members["slow"].catalogue_time -= meta.members["slow"].ttl + 1
+            start = time.perf_counter()
+            second = meta.get_catalogue()
+            seconds = time.perf_counter() - start
+            meta.members["slow"].refreshing.result(10)
+
+        assert seconds < 0.5
+        assert second is first and "slow:glider_20" in second
+
+    def test_failed_server_not_waited_for_again(self, stub_server):
+        with StubERDDAP({"glider_10": 10}) as up, StubERDDAP({"glider_20": 20}) as down:
+            calls = []
+
+            def fail(path, query):
+                calls.append(path)
+                return 500, "text/plain", b"Error"
+
+            down.handle = fail
+            server = stub_server(up=up, down=down)
+            meta = server.index.erddap_collections.meta
+            first = meta.get_catalogue()
+            second = meta.get_catalogue()
+
+        assert list(first.keys()) == list(second.keys()) == ["up:glider_10"]
+        assert meta.members["down"].failed_at is not None
+        # backing off, the failed download isn't started again for every request
+        assert len([path for path in calls if "allDatasets" in path]) == 1
@@ -1,3 +1,5 @@
+import geojson
+import numpy as np
 import s2sphere
 from Geometry import Point
 
@@ -36,3 +38,93 @@ class TestGeometry:
         delta = received.__sub__(expected)
 
         # assert math.fabs(delta.x)+math.fabs(delta.y) > 1e-9
+
+    def test_compute_bounds_point(self):
+        received = ogc_api.geometry.encode_bbox(ogc_api.geometry.compute_bounds(geojson.Point((8.9, 45.3))))
+
+        assert [round(edge, 6) for edge in received] == [8.9, 45.3, 8.9, 45.3]
+
+    def test_compute_bounds_multi_point(self):
+        received = ogc_api.geometry.encode_bbox(
+            ogc_api.geometry.compute_bounds(geojson.MultiPoint([(1.4, 49.2), (8.9, 45.3)])))
+
+        assert [round(edge, 6) for edge in received] == [1.4, 45.3, 8.9, 49.2]
+
+
+def rect_bounds(rect: s2sphere.LatLngRect):
+    return [rect.lat().lo(), rect.lat().hi(), rect.lng().lo(), rect.lng().hi()]
+
+
+class TestBatchGeometry:
+    rng = np.random.default_rng(0)
+    lat = rng.uniform(-85, 85, 200)
+    lon = rng.uniform(-180, 180, 200)
+
+    def test_compute_line_bounds_accumulates(self):
+        received = ogc_api.geometry.encode_bbox(
+            ogc_api.geometry.compute_line_bounds([(1.4, 49.2), (8.9, 45.3), (4.0, 47.0)]))
+
+        assert [round(edge, 6) for edge in received] == [1.4, 45.3, 8.9, 49.2]
+
+    def test_point_bounds(self):
+        received = ogc_api.geometry.compute_point_bounds_batch(self.lat, self.lon)
+        expected = [rect_bounds(ogc_api.geometry.compute_bounds(geojson.Point((lon, lat), precision=15)))
+                    for lat, lon in zip(self.lat, self.lon)]
+
+        np.testing.assert_allclose(received, expected, rtol=0, atol=1e-15)
+
+    def test_line_bounds(self):
+        lines = [[(-63.1, 44.0), (-62.8, 44.2), (-63.4, 43.9)],
+                 [(179.5, 10.0), (-179.5, 11.0), (179.9, 10.5)],
+                 [],
+                 [(12.0, -5.0)],
+                 [(-10.0, 0.0), (10.0, 1.0)]]
+        # random walks, like glider tracks
+        for start in range(0, 200, 40):
+            lines.append(list(zip(np.cumsum(self.rng.uniform(-2, 2, 40)) + self.lon[start],
+                                  np.clip(np.cumsum(self.rng.uniform(-1, 1, 40)) + self.lat[start] / 2, -89, 89))))
+        offsets = np.cumsum([0] + [len(line) for line in lines])
+        lon = [point[0] for line in lines for point in line]
+        lat = [point[1] for line in lines for point in line]
+
+        received = ogc_api.geometry.compute_line_bounds_batch(lat, ((np.array(lon) + 180) % 360) - 180, offsets)
+        expected = [rect_bounds(ogc_api.geometry.compute_line_bounds([((x + 180) % 360 - 180, y) for x, y in line]))
+                    for line in lines]
+
+        np.testing.assert_allclose(received, expected, rtol=0, atol=1e-12)
+        # across the antimeridian the interval is inverted
+        assert received[1][2] > received[1][3]
+
+    def test_bounds_mask(self):
+        rects = [ogc_api.geometry.compute_line_bounds([(self.lon[i], self.lat[i]), (self.lon[i + 1], self.lat[i + 1])])
+                 for i in range(0, 198, 2)]
+        rects.append(s2sphere.LatLngRect())
+        bounds = ogc_api.geometry.bounds_array(rects)
+
+        for bbox in ("-70,40,-60,50", "170,-20,-170,20", "-180,-90,180,90", "0,0,0.001,0.001"):
+            rect = ogc_api.server_handler.parse_bbox(bbox).content
+            received = ogc_api.geometry.bounds_mask(bounds, rect)
+            assert received.tolist() == [rect.intersects(feature) for feature in rects]
+
+    def test_bbox_mask(self):
+        for min_lon, max_lon in ((-70, -60), (170, -170)):
+            rect = ogc_api.server_handler.parse_bbox(f"{min_lon},-30,{max_lon},30").content
+            received = ogc_api.geometry.bbox_mask(self.lat, self.lon, -30, min_lon, 30, max_lon)
+            expected = [rect.contains(s2sphere.LatLng.from_degrees(lat, lon)) for lat, lon in zip(self.lat, self.lon)]
+            assert received.tolist() == expected
+
+    def test_project_web_mercator(self):
+        x, y = ogc_api.geometry.project_web_mercator_batch(self.lat, self.lon)
+        expected = [ogc_api.geometry.project_web_mercator(s2sphere.LatLng.from_degrees(lat, lon))
+                    for lat, lon in zip(self.lat, self.lon)]
+
+        np.testing.assert_allclose(x, [point.x for point in expected], rtol=1e-12)
+        np.testing.assert_allclose(y, [point.y for point in expected], rtol=1e-12)
+
+    def test_unproject_web_mercator(self):
+        tiles = self.rng.integers(0, 2 ** 12, (100, 2))
+        lat, lon = ogc_api.geometry.unproject_web_mercator_batch(12, tiles[:, 0], tiles[:, 1])
+        expected = [ogc_api.geometry.unproject_web_mercator(12, float(x), float(y)) for x, y in tiles]
+
+        np.testing.assert_allclose(lat, [point.lat().degrees for point in expected], rtol=0, atol=1e-9)
+        np.testing.assert_allclose(lon, [point.lng().degrees for point in expected], rtol=0, atol=1e-9)
@@ -1,38 +1,36 @@
 import io
-import os.path
+import json
 
 import s2sphere
 
 import ogc_api.index
+from benchmarks.stub_erddap import StubERDDAP
 from ogc_api.data_structures import HTTP_RESPONSES
 
 
-def create_test_index():
-    collection_castles = os.path.join("tests", "test_data", "castles.geojson")
-    collection_lakes = os.path.join("tests", "test_data", "lakes.geojson")
-
-    public_path = r"https://test.example.org/wfs/"
-    index = ogc_api.index.make_index({"castles": collection_castles, "lakes": collection_lakes}, public_path)
-
-    return index
-
-
 class TestIndex:
-    def test_get_item_existing_item(self):
-        index = create_test_index()
-        received = index.get_item("castles", "W418392510")
-
-        assert received.content is not None and received.content.properties["name"] == "Castello Scaligero"
-
-    def test_get_item_no_such_collection(self):
-        index = create_test_index()
-        received = index.get_item("no-such-collection", "123")
+    def test_get_item_existing_item(self, stub_server):
+        with StubERDDAP({"glider_10": 10}) as stub:
+            index = stub_server(stub).index
+            received = index.get_item("glider_10", "1662940800")
+
+        # the stored feature as encoded, from the collection loaded into the ERDDAP cache
+        assert isinstance(received.content, bytes)
+        assert "glider_10" in index.erddap_collections.cache
+        feature = json.loads(received.content)
+        assert feature["id"] == "1662940800" and feature["properties"]["profile_id"] == 1
+
+    def test_get_item_no_such_collection(self, stub_server):
+        with StubERDDAP({"glider_10": 10}) as stub:
+            index = stub_server(stub).index
+            received = index.get_item("no-such-collection", "123")
 
         assert received.http_response is not None and received.http_response == HTTP_RESPONSES["NOT_FOUND"]
 
-    def test_get_item_no_such_item(self):
-        index = create_test_index()
-        received = index.get_item("castles", "no-such-feature-id")
+    def test_get_item_no_such_item(self, stub_server):
+        with StubERDDAP({"glider_10": 10}) as stub:
+            index = stub_server(stub).index
+            received = index.get_item("glider_10", "no-such-feature-id")
 
         assert received.http_response is not None and received.http_response == HTTP_RESPONSES["NOT_FOUND"]
 
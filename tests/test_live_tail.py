@@ -0,0 +1,128 @@
+import asyncio
+import json
+import time
+
+from benchmarks.stub_erddap import StubERDDAP
+from erddap_proxy.erddap_matadata import ERDDAPCollections
+from erddap_proxy.live_tail import LiveTail, Subscription
+
+
+def grow(stub: StubERDDAP, dataset_id: str, size: int):
+    glider = stub.datasets[dataset_id]
+    glider.size = size
+    glider._rows = None
+
+
+def event_features(event: str) -> list:
+    data = [line for line in event.splitlines() if line.startswith("data: ")][0]
+    return json.loads(data[len("data: "):])["features"]
+
+
+class TestLiveTail:
+    def test_subscribers_share_one_poll(self):
+        async def run(stub):
+            loop = asyncio.get_running_loop()
+            # polled by hand below, the poller's own thread would only start after an hour
+            tail = LiveTail(ERDDAPCollections(stub.url), interval=3600)
+            first = tail.subscribe("glider_10", loop)
+            second = tail.subscribe("glider_10", loop)
+            poller = tail.pollers["glider_10"]
+
+            nothing = await loop.run_in_executor(None, poller.poll)
+            grow(stub, "glider_10", 13)
+            downloads = len([r for r in stub.requests if "/tabledap/glider_10." in r])
+            new = await loop.run_in_executor(None, poller.poll)
+
+            events = [await asyncio.wait_for(first.queue.get(), 1), await asyncio.wait_for(second.queue.get(), 1)]
+            tail.unsubscribe(first)
+            tail.unsubscribe(second)
+            return nothing, new, downloads, events, poller, tail
+
+        with StubERDDAP({"glider_10": 10}) as stub:
+            nothing, new, downloads, events, poller, tail = asyncio.run(run(stub))
+            polls = [r for r in stub.requests if "/tabledap/glider_10." in r]
+
+        assert nothing == 0 and new == 3
+        # one request to ERDDAP for both subscribers
+        assert len(polls) == downloads + 1
+        assert events[0] is events[1]
+        assert [f["properties"]["profile_id"] for f in event_features(events[0])] == [11, 12, 13]
+        assert events[0].startswith(f"id: {event_features(events[0])[-1]['id']}\nevent: features\n")
+        assert poller.stopped.is_set() and tail.pollers == {}
+
+    def test_stream(self):
+        async def run(stub):
+            tail = LiveTail(ERDDAPCollections(stub.url), interval=0.05)
+            stream = tail.stream("glider_10", heartbeat=0.02)
+            chunks = [await anext(stream)]
+            grow(stub, "glider_10", 12)
+            while len(chunks) < 10 and not chunks[-1].startswith("id:"):
+                chunks.append(await asyncio.wait_for(anext(stream), 5))
+            await stream.aclose()
+            return chunks, tail
+
+        with StubERDDAP({"glider_10": 10}) as stub:
+            chunks, tail = asyncio.run(run(stub))
+
+        assert chunks[0] == ": subscribed\n\n"
+        assert ": keep-alive\n\n" in chunks
+        assert len(event_features(chunks[-1])) == 2
+        # closing the stream unsubscribed it
+        assert tail.pollers == {}
+
+    def test_subscribing_doesnt_block_the_loop(self):
+        async def run(stub):
+            collections = ERDDAPCollections(stub.url)
+            get_catalogue = collections.meta.get_catalogue
+
+            def slow_catalogue():
+                time.sleep(0.3)
+                return get_catalogue()
+
+            collections.meta.get_catalogue = slow_catalogue
+            tail = LiveTail(collections, interval=3600)
+            ticks = []
+
+            async def tick():
+                while True:
+                    ticks.append(time.perf_counter())
+                    await asyncio.sleep(0.01)
+
+            ticker = asyncio.create_task(tick())
+            stream = tail.stream("glider_10")
+            first = await anext(stream)
+            ticker.cancel()
+            await stream.aclose()
+            return first, ticks
+
+        with StubERDDAP({"glider_10": 10}) as stub:
+            first, ticks = asyncio.run(run(stub))
+
+        assert first == ": subscribed\n\n"
+        # other tasks ran while the new poller waited for the catalogue
+        assert len(ticks) > 5
+
+    def test_unsubscribed_before_added(self):
+        async def run():
+            tail = LiveTail(ERDDAPCollections("https://erddap.example.org/erddap/"), interval=3600)
+            subscription = Subscription("glider_10", asyncio.get_running_loop())
+            # the client went away while its subscription was being set up
+            tail.unsubscribe(subscription)
+            tail.add(subscription)
+            return tail
+
+        assert asyncio.run(run()).pollers == {}
+
+    def test_slow_subscriber_dropped(self):
+        async def run():
+            subscription = Subscription("glider_10", asyncio.get_running_loop(), queue_size=2)
+            for i in range(3):
+                subscription.deliver(f"event {i}")
+            await asyncio.sleep(0)
+            return [subscription.queue.get_nowait() for _ in range(subscription.queue.qsize())], subscription
+
+        events, subscription = asyncio.run(run())
+
+        # the stream ends after what it could hold
+        assert events == ["event 1", None]
+        assert subscription.dropped
@@ -0,0 +1,43 @@
+import random
+
+from benchmarks import load_test
+from benchmarks.stub_erddap import SyntheticGlider
+
+
+class TestSessions:
+    def test_synthetic_session(self):
+        extents = {"glider_0": SyntheticGlider("glider_0", 200).extent()}
+        session = load_test.synthetic_session(random.Random(0), extents, pans=3, limit=50, pages=2)
+
+        assert [step["path"] for step in session[:3]] == ["/", "/collections", "/collections/glider_0"]
+        items = session[3:]
+        assert len(items) == 4
+        assert all(step["path"].startswith("/collections/glider_0/items?bbox=") and step["pages"] == 2
+                   for step in items)
+        assert [load_test.endpoint(step["path"]) for step in session] == \
+               ["landing", "collections", "collection"] + ["items"] * 4
+
+    def test_recorded_sessions(self, tmp_path):
+        path = tmp_path / "sessions.json"
+        path.write_text('[["/", "/collections/otn200/items?limit=10"], [{"path": "/collections/bona", "pages": 1}]]')
+
+        sessions = load_test.read_sessions(str(path))
+
+        assert sessions[0][1] == {"path": "/collections/otn200/items?limit=10"}
+        assert load_test.session_collections(sessions) == ["otn200", "bona"]
+
+
+class TestLoadTest:
+    def test_cold_and_warm_run(self):
+        extents = {"glider_0": SyntheticGlider("glider_0", 200).extent()}
+        rng = random.Random(0)
+        sessions = [load_test.synthetic_session(rng, extents, pans=1, limit=50, pages=2) for _ in range(2)]
+
+        report = load_test.run([2], sessions, {"glider_0": 200}, ["cold", "warm"])
+
+        results = report["results"]
+        for scenario in ("cold", "warm"):
+            assert results[f"load_error_rate/{scenario}/c=2"] == 0
+            assert results[f"load_requests_per_second/{scenario}/c=2"] > 0
+            assert results[f"load_latency_seconds/{scenario}/c=2/items/p99"] >= \
+                   results[f"load_latency_seconds/{scenario}/c=2/items/p50"]
@@ -0,0 +1,47 @@
+import pytest
+
+from ogc_api import metrics
+
+
+class TestMetrics:
+    def test_histogram_render(self):
+        registry = []
+        histogram = metrics.Histogram("test_seconds", "Test timings", ["endpoint"], buckets=(0.1, 1.0),
+                                      registry=registry)
+        histogram.observe(0.05, endpoint="/items")
+        histogram.observe(0.5, endpoint="/items")
+        histogram.observe(5, endpoint="/items")
+
+        received = metrics.render(registry).decode("utf8").splitlines()
+        expected = ['# HELP test_seconds Test timings',
+                    '# TYPE test_seconds histogram',
+                    'test_seconds_bucket{endpoint="/items",le="0.1"} 1',
+                    'test_seconds_bucket{endpoint="/items",le="1"} 2',
+                    'test_seconds_bucket{endpoint="/items",le="+Inf"} 3',
+                    'test_seconds_sum{endpoint="/items"} 5.55',
+                    'test_seconds_count{endpoint="/items"} 3']
+
+        assert received == expected
+
+    def test_counter_and_gauge(self):
+        registry = []
+        counter = metrics.Counter("test_total", "Test counter", ["collection"], registry=registry)
+        gauge = metrics.Gauge("test_bytes", "Test gauge", ["collection"], registry=registry)
+
+        counter.inc(collection='a"b')
+        counter.inc(2, collection='a"b')
+        gauge.set(10, collection="a")
+        gauge.set(20, collection="b")
+        gauge.remove(collection="a")
+
+        received = metrics.render(registry).decode("utf8")
+
+        assert 'test_total{collection="a\\"b"} 3' in received
+        assert 'test_bytes{collection="a"}' not in received
+        assert 'test_bytes{collection="b"} 20' in received
+
+    def test_wrong_labels(self):
+        counter = metrics.Counter("test_total", "Test counter", ["collection"], registry=[])
+
+        with pytest.raises(ValueError):
+            counter.inc(dataset="a")
@@ -0,0 +1,98 @@
+import threading
+import warnings
+
+from fastapi import FastAPI
+from starlette.responses import Response
+
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore")
+    from starlette.testclient import TestClient
+
+from ogc_api.profiling import RequestProfiler
+
+
+def slow_part_of_the_request():
+    return sum(i * i for i in range(10000))
+
+
+def create_test_app(profiler: RequestProfiler):
+    app = FastAPI()
+    profiler.install(app)
+
+    @app.get("/collections/{collection}/items")
+    @profiler.profile
+    def get_collection_items(collection: str, limit: int = 10):
+        slow_part_of_the_request()
+        return Response(content=f"{collection} {limit}")
+
+    return TestClient(app)
+
+
+class TestProfiling:
+    def test_profile_requested_by_header(self):
+        client = create_test_app(RequestProfiler(enabled=True))
+
+        response = client.get("/collections/castles/items?limit=5", headers={"X-Profile": "1"})
+        report = client.get("/profiles/" + response.headers["x-profile-id"])
+        raw = client.get("/profiles/" + response.headers["x-profile-id"] + "?format=prof")
+
+        assert response.content == b"castles 5"
+        assert report.status_code == 200
+        assert "slow_part_of_the_request" in report.content.decode("utf8")
+        assert raw.headers["content-type"] == "application/octet-stream"
+
+    def test_profile_requested_by_parameter(self):
+        client = create_test_app(RequestProfiler(enabled=True))
+
+        assert "x-profile-id" in client.get("/collections/castles/items?profile=1").headers
+        assert "x-profile-id" not in client.get("/collections/castles/items").headers
+
+    def test_oldest_reports_dropped(self):
+        client = create_test_app(RequestProfiler(enabled=True, keep=1))
+
+        first = client.get("/collections/castles/items?profile=1").headers["x-profile-id"]
+        client.get("/collections/castles/items?profile=1")
+
+        assert client.get("/profiles/" + first).status_code == 404
+
+    def test_disabled_adds_nothing(self):
+        profiler = RequestProfiler(enabled=False)
+        client = create_test_app(profiler)
+
+        response = client.get("/collections/castles/items", headers={"X-Profile": "1"})
+
+        assert "x-profile-id" not in response.headers
+        assert client.get("/profiles/abc").status_code == 404
+        assert profiler.profile(slow_part_of_the_request) is slow_part_of_the_request
+
+    def test_one_profile_at_a_time(self):
+        profiler = RequestProfiler(enabled=True)
+        client = create_test_app(profiler)
+
+        # as if another request were being profiled
+        profiler.running.acquire()
+        try:
+            busy = client.get("/collections/castles/items?profile=1")
+        finally:
+            profiler.running.release()
+        after = client.get("/collections/castles/items?profile=1")
+
+        assert busy.content == b"castles 10"
+        assert "x-profile-id" not in busy.headers and busy.headers["x-profile-skipped"] == "busy"
+        assert "x-profile-id" in after.headers
+
+    def test_concurrent_profiles(self):
+        client = create_test_app(RequestProfiler(enabled=True))
+        responses = []
+
+        def request():
+            responses.append(client.get("/collections/castles/items?profile=1"))
+
+        threads = [threading.Thread(target=request) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert [response.status_code for response in responses] == [200] * 8
+        assert any("x-profile-id" in response.headers for response in responses)
@@ -0,0 +1,96 @@
+import json
+
+import numpy as np
+import s2sphere
+
+import ogc_api.server_handler
+from benchmarks.stub_erddap import StubERDDAP, iso_time
+from ogc_api import search
+from ogc_api.cql2 import TimeRange
+from ogc_api.data_structures import CollectionMetadata, Collection
+
+
+class TestExtent:
+    def test_prune(self):
+        extent = search.Extent(search.make_rect(43, -64, 45, -62), 100.0, 200.0)
+        inside = ogc_api.server_handler.parse_bbox("-63,44,-62.5,44.5").content
+        outside = ogc_api.server_handler.parse_bbox("10,10,11,11").content
+        everywhere = s2sphere.LatLngRect()
+
+        assert extent.may_match(inside, None)
+        assert not extent.may_match(outside, None)
+        assert extent.may_match(everywhere, TimeRange(150.0, None))
+        assert not extent.may_match(everywhere, TimeRange(201.0, None))
+        assert not extent.may_match(everywhere, TimeRange(None, 99.0))
+        # unknown parts never prune
+        assert search.Extent().may_match(outside, TimeRange(201.0, None))
+
+    def test_across_antimeridian(self):
+        extent = search.Extent.from_metadata(CollectionMetadata("a", "a", None, bbox=[-179.5, -10, 179.5, 10]))
+        bbox = ogc_api.server_handler.parse_bbox("170,-5,-170,5").content
+
+        assert extent.may_match(bbox, None)
+        assert extent.may_match(ogc_api.server_handler.parse_bbox("0,0,1,1").content, None)
+
+    def test_unsorted_time(self):
+        coll = Collection()
+        coll.feature = ["{}"] * 4
+        coll.columns = {"time": np.array([30.0, 10.0, 40.0, 20.0]),
+                        "latitude": np.array([1.0, 1.0, 1.0, 1.0]),
+                        "longitude": np.array([1.0, 1.0, 1.0, 1.0])}
+        extent = search.Extent.from_collection(coll)
+
+        assert not extent.time_sorted
+        assert search.select(coll, extent, s2sphere.LatLngRect(), TimeRange(15.0, 30.0)).tolist() == [0, 3]
+
+
+class TestSearch:
+    def test_search_loaded_collections(self, stub_server):
+        with StubERDDAP({"glider_50": 50, "glider_20": 20, "glider_10": 10}) as stub:
+            server = stub_server(stub)
+            collections = server.index.erddap_collections
+            collections.get_collection_as_data("glider_50")
+            collections.get_collection_as_data("glider_20")
+            downloads = len(stub.requests)
+
+            rows = stub.datasets["glider_50"].rows
+            start, end = rows[5]["time"], rows[14]["time"]
+            response = server.handle_search_request("", f"{iso_time(start)}/{iso_time(end)}", "100")
+            min_lon, max_lon, min_lat, max_lat = stub.datasets["glider_20"].extent()
+            in_bbox = server.handle_search_request(f"{min_lon},{min_lat},{max_lon},{max_lat}", "", "5")
+            bad = server.handle_search_request("1,2,3", "", "10")
+
+            assert len(stub.requests) == downloads
+
+        # written as compactly as the items responses
+        assert b'],"collections":[{"id":"glider_50","title":' in response.content
+        assert b'"numberMatched":20,"numberReturned":20}' in response.content
+
+        content = json.loads(response.content)
+        # the same mission times for each glider, both loaded ones match
+        assert [c["id"] for c in content["collections"]] == ["glider_50", "glider_20", "glider_10"]
+        assert [c["numberMatched"] for c in content["collections"]] == [10, 10, None]
+        assert content["numberMatched"] == 20 and content["numberReturned"] == 20
+        assert [f["collection"] for f in content["features"]] == ["glider_50"] * 10 + ["glider_20"] * 10
+        assert content["features"][0]["id"] == str(int(start))
+        assert content["features"][0]["type"] == "Feature"
+
+        content = json.loads(in_bbox.content)
+        matched = {c["id"]: c["numberMatched"] for c in content["collections"]}
+        assert matched["glider_20"] == 20
+        assert content["numberReturned"] == 5
+        assert bad.http_response.status_code == 400
+
+    def test_pruned_collections_not_scanned(self, monkeypatch, stub_server):
+        with StubERDDAP({"glider_50": 50}) as stub:
+            server = stub_server(stub)
+            server.index.erddap_collections.get_collection_as_data("glider_50")
+
+            calls = []
+            select = search.select
+            monkeypatch.setattr(search, "select", lambda *args: calls.append(args) or select(*args))
+            response = server.handle_search_request("", "2030-01-01T00:00:00Z/..", "10")
+            server.handle_search_request("", "2022-09-12T00:00:00Z/..", "10")
+
+        assert json.loads(response.content)["collections"] == []
+        assert len(calls) == 1
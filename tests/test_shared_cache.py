@@ -0,0 +1,146 @@
+import io
+import threading
+import time
+
+import geojson
+import numpy as np
+import s2sphere
+
+from erddap_proxy.erddap_matadata import ERDDAPCollections
+from erddap_proxy.shared_cache import SnapshotStore
+from ogc_api import geometry
+from ogc_api.data_structures import Collection, CollectionMetadata, FeatureArena, make_column
+
+
+def create_test_collection(size: int):
+    collection = Collection()
+    collection.metadata = CollectionMetadata("glider", "glider", None)
+    for i in range(size):
+        feature = geojson.Feature(id=str(i), geometry=geojson.Point((-63.0 + i * 0.01, 44.0)),
+                                  properties={"time": "2022-09-12T00:00:00Z", "name": "é" * i})
+        collection.id.append(str(i))
+        collection.by_id[str(i)] = i
+        collection.feature.append(geojson.dumps(feature, ensure_ascii=False, separators=(',', ':')))
+        collection.bbox.append(geometry.compute_bounds(feature.geometry))
+        collection.web_mercator.append(geometry.project_web_mercator(collection.bbox[i].get_center()))
+    collection.columns = {"time": make_column([1662940800.0 + i for i in range(size)]),
+                          "profile_id": make_column(list(range(size))),
+                          "platform": make_column(["otn200"] * size)}
+    return collection
+
+
+def create_test_collections(directory, fetches: list):
+    collections = ERDDAPCollections("https://erddap.example.org/erddap/", shared_cache_dir=directory)
+    collections.meta.catalogue = {"glider": CollectionMetadata("glider", "glider", None)}
+    collections.meta.dataset_types = {"glider": "latlon"}
+    collections.meta.catalogue_time = time.monotonic()
+
+    def get_erddap_as_collection(dataset_id, collection, dataset_type=None, extra_variables=()):
+        fetches.append(dataset_id)
+        time.sleep(0.05)
+        return create_test_collection(3)
+
+    collections.data.get_erddap_as_collection = get_erddap_as_collection
+    return collections
+
+
+class TestSnapshotStore:
+    def test_save_and_load(self, tmp_path):
+        store = SnapshotStore(str(tmp_path))
+        original = create_test_collection(5)
+
+        store.save("glider", original)
+        loaded = store.load("glider", Collection())
+
+        assert isinstance(loaded.feature, FeatureArena) and loaded.feature.mapped
+        assert list(loaded.feature) == original.feature
+        assert loaded.encoded_feature(4) == original.encoded_feature(4) == original.feature[4].encode("utf8")
+        assert loaded.id == original.id and loaded.by_id == original.by_id
+        assert [geometry.encode_bbox(rect) for rect in loaded.bbox] == \
+               [geometry.encode_bbox(rect) for rect in original.bbox]
+        assert [(p.x, p.y) for p in loaded.web_mercator] == [(p.x, p.y) for p in original.web_mercator]
+        for name, column in original.columns.items():
+            assert loaded.columns[name].dtype == column.dtype
+            assert np.array_equal(loaded.columns[name], column)
+
+    def test_empty_bounds_round_trip(self, tmp_path):
+        store = SnapshotStore(str(tmp_path))
+        original = create_test_collection(1)
+        original.bbox[0] = s2sphere.LatLngRect()
+
+        store.save("glider", original)
+
+        assert store.load("glider", Collection()).bbox[0].is_empty()
+
+    def test_missing_and_expired(self, tmp_path):
+        store = SnapshotStore(str(tmp_path), max_age=0)
+        assert store.load("glider", Collection()) is None
+
+        store.save("glider", create_test_collection(1))
+        assert store.load("glider", Collection()) is None
+
+    def test_refresh_skips_older_snapshots(self, tmp_path):
+        store = SnapshotStore(str(tmp_path))
+        original = create_test_collection(1)
+        original.fetched_at = time.time() - 10
+
+        store.save("glider", original)
+
+        assert store.load("glider", Collection()).fetched_at == original.fetched_at
+        assert store.load("glider", Collection(), newer_than=original.fetched_at) is None
+        assert store.load("glider", Collection(), newer_than=original.fetched_at - 1) is not None
+
+
+class TestFeatureArena:
+    def test_features_and_runs(self):
+        arena = FeatureArena.from_encoded([b'{"id":"0"}', '{"id":"é"}'.encode("utf8"), b'{"id":"2"}', b'{"id":"3"}'])
+
+        assert len(arena) == 4
+        assert arena[1] == '{"id":"é"}' and arena.encoded(-1) == b'{"id":"3"}'
+        assert bytes(arena.run(1, 3)) == '{"id":"é"},{"id":"2"}'.encode("utf8")
+
+        writer = io.BytesIO()
+        arena.write(writer, np.array([0, 1, 3]))
+        assert writer.getvalue() == '{"id":"0"},{"id":"é"},{"id":"3"}'.encode("utf8")
+
+    def test_page_is_views_of_the_buffer(self):
+        arena = FeatureArena.from_encoded([str(i).encode("utf8") for i in range(10)])
+        writes = []
+
+        class Writer:
+            def write(self, data):
+                writes.append(data)
+
+        arena.write(Writer(), [2, 3, 4, 7, 8])
+
+        # two runs, each a single slice of the arena
+        assert [bytes(data) for data in writes] == [b"2,3,4", b",", b"7,8"]
+        assert all(data.obj is arena.buffer.obj for data in writes if data != b",")
+
+    def test_concatenate(self):
+        collection = create_test_collection(3)
+        arena = FeatureArena.concatenate([collection.feature, FeatureArena.from_encoded([b"{}"]), []])
+
+        assert list(arena) == collection.feature + ["{}"]
+        assert bytes(arena.buffer) == ",".join(list(arena)).encode("utf8") + b","
+
+
+class TestSharedCache:
+    def test_one_fetch_for_all_workers(self, tmp_path):
+        fetches = []
+        workers = [create_test_collections(str(tmp_path), fetches) for _ in range(3)]
+        results = {}
+
+        def load(i):
+            results[i] = workers[i].get_collection_as_data("glider")
+
+        threads = [threading.Thread(target=load, args=(i,)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert fetches == ["glider"]
+        assert all(result.feature.mapped for result in results.values())
+        assert results[0].feature[2] == results[2].feature[2]
+        assert results[1].metadata.name == "glider"
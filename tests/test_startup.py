@@ -0,0 +1,32 @@
+import json
+import os
+import subprocess
+import sys
+
+from ogc_api.startup import StartupReport
+
+
+class TestStartupReport:
+    def test_only_first_request_recorded(self):
+        report = StartupReport(started=0.0)
+        report.record_request("/collections", 0.25)
+        report.record_request("/ready", 0.01)
+
+        assert report.first_request_path == "/collections"
+        assert report.first_request_seconds == 0.25
+        assert report.ready_seconds > 0.25
+
+
+class TestStartupBudget:
+    def test_heavy_modules_deferred(self):
+        # a fresh interpreter, the test run has already imported everything
+        env = dict(os.environ, ERDDAP="http://127.0.0.1:9/erddap/", WARMUP="false")
+        env.pop("ACCESS_COUNTS_FILE", None)
+        # a loose budget, the test runner is too noisy to time, run python -m ogc_api.startup alone for the real one
+        result = subprocess.run([sys.executable, "-m", "ogc_api.startup", "--budget", "10"],
+                                capture_output=True, text=True, env=env, timeout=120)
+
+        assert result.returncode == 0, result.stderr
+        report = json.loads(result.stdout)
+        assert report["deferred_modules_loaded"] == []
+        assert report["first_request_path"] == "/"
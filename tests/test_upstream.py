@@ -0,0 +1,107 @@
+import threading
+import time
+
+import pytest
+import requests
+
+from erddap_proxy import upstream
+from erddap_proxy.upstream import BACKGROUND, INTERACTIVE, HostLimiter, Upstream, UpstreamBusy
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def fake_get(monkeypatch, results: list):
+    calls = []
+
+    def get(url, **kwargs):
+        calls.append(url)
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setattr(upstream.requests, "get", get)
+    return calls
+
+
+class TestHostLimiter:
+    def test_interactive_before_background(self):
+        limiter = HostLimiter("erddap", concurrency=1, queue_depth=10)
+        limiter.acquire(INTERACTIVE, 1)
+
+        order = []
+
+        def wait(name, priority):
+            limiter.acquire(priority, 5)
+            order.append(name)
+            limiter.release(0.01)
+
+        threads = [threading.Thread(target=wait, args=("warmer", BACKGROUND))]
+        threads[0].start()
+        while len(limiter.waiting) < 1:
+            time.sleep(0.001)
+        threads.append(threading.Thread(target=wait, args=("user", INTERACTIVE)))
+        threads[1].start()
+        while len(limiter.waiting) < 2:
+            time.sleep(0.001)
+
+        limiter.release(0.01)
+        for thread in threads:
+            thread.join(5)
+
+        assert order == ["user", "warmer"]
+
+    def test_full_queue_rejected(self):
+        limiter = HostLimiter("erddap", concurrency=1, queue_depth=0)
+        limiter.acquire(INTERACTIVE, 1)
+
+        with pytest.raises(UpstreamBusy) as busy:
+            limiter.acquire(INTERACTIVE, 1)
+
+        assert busy.value.retry_after >= 1
+
+    def test_queue_timeout(self):
+        limiter = HostLimiter("erddap", concurrency=1, queue_depth=5)
+        limiter.acquire(INTERACTIVE, 1)
+
+        with pytest.raises(UpstreamBusy):
+            limiter.acquire(INTERACTIVE, 0.05)
+
+        assert limiter.waiting == []
+        limiter.release(0.01)
+        limiter.acquire(INTERACTIVE, 0.05)
+
+
+class TestUpstream:
+    def test_retry_with_backoff(self, monkeypatch):
+        calls = fake_get(monkeypatch, [requests.ConnectionError("reset"), FakeResponse(503), FakeResponse(200)])
+
+        res = Upstream(retries=2, backoff=0.01).get("http://erddap.example.org/erddap/x.json", timeout=1)
+
+        assert res.status_code == 200
+        assert len(calls) == 3
+
+    def test_gives_up_after_retries(self, monkeypatch):
+        fake_get(monkeypatch, [FakeResponse(502), FakeResponse(502)])
+        res = Upstream(retries=1, backoff=0.01).get("http://erddap.example.org/erddap/x.json", timeout=1)
+        assert res.status_code == 502
+
+        fake_get(monkeypatch, [requests.Timeout("slow"), requests.Timeout("slow")])
+        with pytest.raises(requests.Timeout):
+            Upstream(retries=1, backoff=0.01).get("http://erddap.example.org/erddap/x.json", timeout=1)
+
+    def test_client_errors_not_retried(self, monkeypatch):
+        calls = fake_get(monkeypatch, [FakeResponse(404)])
+
+        assert Upstream(retries=3).get("http://erddap.example.org/erddap/x.json", timeout=1).status_code == 404
+        assert len(calls) == 1
+
+    def test_limits_per_host(self):
+        pool = Upstream(concurrency=2)
+
+        assert pool.get_limiter("a.example.org") is pool.get_limiter("a.example.org")
+        assert pool.get_limiter("a.example.org") is not pool.get_limiter("b.example.org")